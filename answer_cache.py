@@ -0,0 +1,176 @@
+"""Cache of the assistant answers to repeated help inquiries."""
+
+import asyncio
+import re
+import time
+from collections import OrderedDict
+
+from config import ANSWER_CACHE_MIN_RATING, ANSWER_CACHE_PREFERRED_RATING, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL
+
+
+def answer_cache_key(question, language, knowledge_version):
+    """
+        Builds the key that identical inquiries share.
+
+        Args:
+            question (str): The inquiry.
+            language (str): The language code of the inquiry.
+            knowledge_version (str): The date of the last knowledge file update.
+
+        Returns:
+            key (tuple): The question with case, punctuation and spacing removed, the language and the knowledge version.
+    """
+    return " ".join(re.findall(r"\w+", question.lower())), language, knowledge_version
+
+
+class AnswerCache:
+    """
+        Answers indexed by answer_cache_key with LRU eviction and a time to live.
+
+        Every answer remembers the threads it was sent in so the ratings and corrections of those threads decide if it
+        may be served again: answers with a correction or a low average rating are dropped, and answers rated at least
+        ANSWER_CACHE_PREFERRED_RATING never expire and are the last to be evicted. While an inquiry is being answered,
+        identical inquiries wait for that answer instead of starting their own run. If it ends without an answer, one
+        of them takes over and the others keep waiting.
+    """
+
+    def __init__(self, conversation_store, size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL):
+        self.conversation_store = conversation_store
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+
+    def _rating(self, entry):
+        """
+            Looks up the reviews of the threads an answer was sent in.
+
+            Returns:
+                rating (float | None): The average rating of the threads, None if no thread was rated.
+                corrected (bool): Whether any of the threads received a correction.
+        """
+        ratings = []
+        for thread_id in entry["thread_ids"]:
+            if not self.conversation_store.has_thread(thread_id):
+                continue
+            thread_log = self.conversation_store.get_thread(thread_id)
+            if "correction information" in thread_log:
+                return None, True
+            if thread_log["rating"] is not None:
+                ratings.append(thread_log["rating"])
+        return (sum(ratings) / len(ratings) if ratings else None), False
+
+    def _is_preferred(self, entry):
+        rating, corrected = self._rating(entry)
+        return not corrected and rating is not None and rating >= ANSWER_CACHE_PREFERRED_RATING
+
+    def add_thread(self, key, thread_id):
+        """
+            Records that a cached answer was sent in another thread, so that thread's review counts as well.
+
+            Args:
+                key (tuple): The key of the answer.
+                thread_id (int): The discord thread id.
+        """
+        if key in self.entries:
+            self.entries[key]["thread_ids"].append(thread_id)
+
+    def begin(self, key):
+        """
+            Marks an inquiry as being answered so identical inquiries wait for it (see get).
+
+            Args:
+                key (tuple): The key of the inquiry.
+        """
+        self.in_flight[key] = asyncio.get_running_loop().create_future()
+
+    def clear(self):
+        """
+            Drops every cached answer, e.g. after the knowledge files changed.
+        """
+        self.entries.clear()
+
+    def end(self, key):
+        """
+            Releases the inquiries waiting on an inquiry that finished without storing an answer.
+
+            Args:
+                key (tuple): The key of the inquiry.
+        """
+        in_flight = self.in_flight.pop(key, None)
+        if in_flight is not None and not in_flight.done():
+            in_flight.set_result(None)
+
+    async def get(self, key):
+        """
+            Retrieves a cached answer, waiting for an identical inquiry that is being answered.
+
+            On a miss the inquiry is marked as being answered (see begin), so the caller has to store its answer or
+            call end once it is done.
+
+            Args:
+                key (tuple): The key of the inquiry.
+
+            Returns:
+                answer (dict | None): The thread title, answer and citations, None if the inquiry must be answered.
+        """
+        while True:
+            entry = self.lookup(key)
+            if entry is not None:
+                return entry
+            if key not in self.in_flight:
+                # the first waiter to wake up after an inquiry ended without an answer takes over the key, the
+                # others find the new future and keep waiting
+                self.begin(key)
+                return None
+            await asyncio.shield(self.in_flight[key])
+
+    def lookup(self, key):
+        """
+            Retrieves a cached answer that may still be served.
+
+            Args:
+                key (tuple): The key of the inquiry.
+
+            Returns:
+                answer (dict | None): The thread title, answer and citations, None on a miss.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        rating, corrected = self._rating(entry)
+        preferred = rating is not None and rating >= ANSWER_CACHE_PREFERRED_RATING
+        expired = time.monotonic() - entry["created"] > self.ttl and not preferred
+        if corrected or expired or (rating is not None and rating < ANSWER_CACHE_MIN_RATING):
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key, title, answer, citations, thread_id):
+        """
+            Caches an answer and hands it to the identical inquiries waiting for it.
+
+            Args:
+                key (tuple): The key of the inquiry.
+                title (str): The title of the discord thread of the inquiry.
+                answer (str): The answer sent to discord.
+                citations (list): The citations logged with the answer.
+                thread_id (int): The discord thread id the answer was sent in.
+        """
+        entry = {
+            "title": title,
+            "answer": answer,
+            "citations": citations,
+            "thread_ids": [thread_id],
+            "created": time.monotonic(),
+        }
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            # evict the least recently used answer that is not highly rated, if there is one
+            evicted_key = next((k for k, e in self.entries.items() if not self._is_preferred(e)), next(iter(self.entries)))
+            del self.entries[evicted_key]
+        in_flight = self.in_flight.pop(key, None)
+        if in_flight is not None and not in_flight.done():
+            in_flight.set_result(entry)
@@ -0,0 +1,372 @@
+"""
+Microbenchmarks for the utils.py functions that run on every message.
+
+Discord and OpenAI are replaced by small local fakes so no network access (or token) is needed. Conversation logs
+are generated in a temporary directory. Results are printed and written as JSON (see --output) so two runs can be
+compared with --compare, which reports every benchmark that got slower than --threshold.
+
+    python benchmark_utils.py --sizes 1000 10000 --output before.json
+    python benchmark_utils.py --sizes 1000 10000 --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+# messages.py reads the date of the last knowledge file update when it is imported
+os.environ.setdefault("LAST_KNOWLEDGE_FILE_UPDATE", "01-01-2000")
+
+import utils
+from config import CONVERSATION_FILE, MAX_PIXEL_DIM
+from messages import THREAD_CATEGORY
+
+SAMPLE_QUESTIONS = [
+    "How do I install the seed generator and the randomizer mod with the mod manager?",
+    "My tracker will not load after updating, it just shows a black window",
+    "¿Cómo puedo instalar el randomizer en la versión de Steam del juego?",
+    "Comment est-ce que je peux activer les indices dans le générateur de seed?",
+    "Wie installiere ich den Randomizer mit dem OpenKH Mod Manager?",
+    "What does the level up stat bias setting do?",
+]
+
+
+class FakeAuthor:
+    def __init__(self, name):
+        self.name = name
+        self.display_name = name
+        self.roles = []
+
+
+class FakeChannel:
+    def __init__(self, channel_id, threads=()):
+        self.id = channel_id
+        self.name = "ailios"
+        self.threads = list(threads)
+        self.sent = 0
+
+    async def send(self, content):
+        self.sent += len(content)
+        return SimpleNamespace(content=content)
+
+
+class FakeThread(FakeChannel):
+    def __init__(self, thread_id, name, parent=None):
+        super().__init__(thread_id)
+        self.name = name
+        self.parent = parent
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, channel, attachments=()):
+        self.id = message_id
+        self.content = content
+        self.channel = channel
+        self.author = FakeAuthor("benchmark-user")
+        self.attachments = list(attachments)
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.status = 200
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.body
+
+
+class FakeSession:
+    """
+        Serves the images of the fake attachments instead of the discord CDN.
+    """
+
+    closed = False
+
+    def __init__(self, images):
+        self.images = images
+
+    def get(self, url):
+        return FakeResponse(self.images[url])
+
+
+class FakeFiles:
+    async def retrieve(self, file_id):
+        return SimpleNamespace(id=file_id, filename=f"{file_id}.json")
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.files = FakeFiles()
+
+
+def summarize(name, params, durations):
+    """
+        Summarizes the durations of one benchmark in microseconds.
+    """
+    durations = sorted(durations)
+    return {
+        "name": name,
+        "params": params,
+        "iterations": len(durations),
+        "mean_us": statistics.fmean(durations) * 1e6,
+        "median_us": statistics.median(durations) * 1e6,
+        "p95_us": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1e6,
+        "min_us": durations[0] * 1e6,
+    }
+
+
+def time_calls(call, iterations):
+    durations = []
+    for index in range(iterations):
+        start = time.perf_counter()
+        call(index)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+async def time_async_calls(call, iterations):
+    durations = []
+    for index in range(iterations):
+        start = time.perf_counter()
+        await call(index)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def write_conversation_file(thread_count):
+    """
+        Writes a conversation log file in the format used before the conversation database.
+    """
+    conversations = {}
+    for thread_id in range(1, thread_count + 1):
+        message_log = []
+        for _ in range(random.randint(1, 3)):
+            message_log.append({"role": "user", "content": random.choice(SAMPLE_QUESTIONS)})
+            message_log.append({"role": "assistant", "content": "An answer. " * random.randint(20, 200)})
+        conversations[str(thread_id)] = {
+            "cost_in_dollars": {"input_cost": 0.001, "output_cost": 0.002, "image_cost": 0, "total_cost": 0.003},
+            "message_author": "benchmark-user",
+            "message_content_summary": "Benchmark thread",
+            "message_language": "en",
+            "message_log": message_log,
+            "rating": None,
+        }
+    with open(CONVERSATION_FILE, "w", encoding="utf-8") as file:
+        json.dump(conversations, file)
+
+
+def benchmark_conversation_logs(thread_count, iterations):
+    """
+        Times opening the conversation store and logging messages with *thread_count* logged threads.
+    """
+    results = []
+    params = {"threads": thread_count}
+    write_conversation_file(thread_count)
+
+    start = time.perf_counter()
+    conversation_store = utils.setup_conversation_logs()
+    results.append(summarize("setup_conversation_logs.migrate", params, [time.perf_counter() - start]))
+    conversation_store.close()
+
+    # closing waits for the writer thread to flush, so only opening is timed
+    durations = []
+    for _ in range(max(1, iterations // 100)):
+        start = time.perf_counter()
+        conversation_store = utils.setup_conversation_logs()
+        durations.append(time.perf_counter() - start)
+        conversation_store.close()
+    results.append(summarize("setup_conversation_logs.open", params, durations))
+
+    conversation_store = utils.setup_conversation_logs()
+    channel = FakeChannel(0)
+    new_thread_ids = range(thread_count + 1, thread_count + 1 + iterations)
+
+    def log_new_thread(index):
+        thread = FakeThread(new_thread_ids[index], f"{THREAD_CATEGORY}: Benchmark", channel)
+        message = FakeMessage(thread.id, random.choice(SAMPLE_QUESTIONS), thread)
+        utils.log_conversation(conversation_store, message, thread, "en", "user", message.content, False)
+
+    def log_existing_thread(index):
+        thread = FakeThread(random.randint(1, thread_count), f"{THREAD_CATEGORY}: Benchmark", channel)
+        message = FakeMessage(index, random.choice(SAMPLE_QUESTIONS), thread)
+        utils.log_conversation(conversation_store, message, thread, "en", "user", message.content, True)
+
+    def count_messages(_):
+        utils.thread_message_counts(conversation_store, FakeThread(random.randint(1, thread_count), "", channel))
+
+    results.append(summarize("log_conversation.new_thread", params, time_calls(log_new_thread, iterations)))
+    results.append(summarize("log_conversation.existing_thread", params, time_calls(log_existing_thread, iterations)))
+    results.append(summarize("thread_message_counts", params, time_calls(count_messages, iterations)))
+    conversation_store.close()
+    os.remove(CONVERSATION_FILE + ".migrated")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(conversation_store.database + suffix):
+            os.remove(conversation_store.database + suffix)
+    return results
+
+
+def benchmark_message_has_thread(thread_count, iterations):
+    threads = [FakeThread(thread_id, "", None) for thread_id in range(thread_count)]
+    channel = FakeChannel(-1, threads)
+    # the worst case: the message has no thread so every thread is checked
+    message = FakeMessage(-2, "", channel)
+    return [summarize("message_has_thread", {"threads": thread_count}, time_calls(
+        lambda _: utils.message_has_thread(message), iterations
+    ))]
+
+
+def benchmark_send_response(iterations):
+    results = []
+    for length in (500, 5000, 50000):
+        thread = FakeThread(0, "", None)
+        response = ("An answer sentence. " * (length // 20 + 1))[:length]
+        durations = asyncio.run(time_async_calls(lambda _: utils.send_response_to_discord(thread, response), iterations))
+        results.append(summarize("send_response_to_discord", {"characters": length}, durations))
+    return results
+
+
+def benchmark_extract_citations(iterations):
+    results = []
+    openai_client = FakeOpenAI()
+    for annotation_count in (10, 100, 1000):
+        def extract(_):
+            annotations = [
+                SimpleNamespace(text=f"【4:{index}†source】", file_citation=SimpleNamespace(file_id=f"file-{index % 50}"))
+                for index in range(annotation_count)
+            ]
+            message = SimpleNamespace(value=" ".join(["Some answer text."] + [a.text for a in annotations]), annotations=annotations)
+            return utils.extract_citations(openai_client, message)
+        utils.KNOWLEDGE_FILES.clear()
+        durations = asyncio.run(time_async_calls(extract, iterations))
+        results.append(summarize("extract_citations", {"annotations": annotation_count}, durations))
+    return results
+
+
+def benchmark_detect_message_language(iterations):
+    utils.setup_language_detection()
+    questions = [f"{random.choice(SAMPLE_QUESTIONS)} {index}" for index in range(iterations)]
+    utils.detect_message_language.cache_clear()
+    cold = time_calls(lambda index: utils.detect_message_language(questions[index]), iterations)
+    warm = time_calls(lambda index: utils.detect_message_language(questions[index]), iterations)
+    return [
+        summarize("detect_message_language", {"cache": "cold"}, cold),
+        summarize("detect_message_language", {"cache": "warm"}, warm),
+    ]
+
+
+def benchmark_attachments(iterations):
+    results = []
+    for width, height in ((MAX_PIXEL_DIM, MAX_PIXEL_DIM), (1920, 1080), (3840, 2160)):
+        image = io.BytesIO()
+        Image.new("RGB", (width, height), "navy").save(image, format="PNG")
+        url = f"https://cdn.invalid/{width}x{height}.png"
+        utils.ATTACHMENT_SESSION = FakeSession({url: image.getvalue()})
+        attachment = SimpleNamespace(
+            filename=f"{width}x{height}.png", url=url, width=width, height=height,
+            size=len(image.getvalue()), content_type="image/png"
+        )
+        thread = FakeThread(0, "", None)
+        message = FakeMessage(0, "", thread, [attachment, attachment])
+        durations = asyncio.run(time_async_calls(
+            lambda _: utils.process_discord_message_attachments(message, thread), max(1, iterations // 10)
+        ))
+        results.append(summarize("process_discord_message_attachments", {"images": 2, "pixels": f"{width}x{height}"}, durations))
+    utils.ATTACHMENT_SESSION = None
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file, threshold):
+    """
+        Prints the benchmarks whose median got slower than the baseline by more than *threshold*.
+
+        Returns:
+            regressions (int): The number of regressions found.
+    """
+    with open(baseline_file, "r", encoding="utf-8") as file:
+        baseline = {(result["name"], json.dumps(result["params"], sort_keys=True)): result for result in json.load(file)["results"]}
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if previous and result["median_us"] > previous["median_us"] * (1 + threshold):
+            regressions += 1
+            print(f"REGRESSION {result['name']} {result['params']}: "
+                  f"{previous['median_us']:.1f}us -> {result['median_us']:.1f}us")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="numbers of logged threads (and channel threads) to benchmark with")
+    parser.add_argument("--iterations", type=int, default=1000, help="calls timed per benchmark")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    output_file = os.path.abspath(args.output)
+    baseline_file = os.path.abspath(args.compare) if args.compare else None
+    results = []
+    # the conversation store files are relative to the working directory, so keep them out of the real logs
+    with tempfile.TemporaryDirectory() as benchmark_dir:
+        working_dir = os.getcwd()
+        os.chdir(benchmark_dir)
+        try:
+            for size in args.sizes:
+                results += benchmark_conversation_logs(size, args.iterations)
+                results += benchmark_message_has_thread(size, args.iterations)
+        finally:
+            os.chdir(working_dir)
+    results += benchmark_send_response(args.iterations)
+    results += benchmark_extract_citations(args.iterations // 10 or 1)
+    results += benchmark_detect_message_language(args.iterations)
+    results += benchmark_attachments(args.iterations)
+
+    for result in results:
+        print(f"{result['name']:<40} {json.dumps(result['params']):<40} "
+              f"median {result['median_us']:>12.1f}us  p95 {result['p95_us']:>12.1f}us")
+
+    with open(output_file, "w", encoding="utf-8") as file:
+        json.dump({
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results,
+        }, file, indent=4)
+    print(f"Results written to {output_file}")
+
+    if baseline_file and compare(results, baseline_file, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,201 +2,435 @@
 
 # pylint: disable=wildcard-import, unused-wildcard-import, broad-exception-caught
 
+import asyncio
 import os
-import json
 import logging
-import asyncio
-import subprocess
-import datetime as dt
 
 import discord
-from dotenv import load_dotenv, set_key
+from dotenv import load_dotenv
 
 import openai
-from openai import OpenAI
 
+from answer_cache import AnswerCache, answer_cache_key
+from command_queue import CommandQueue
 from config import *
 from messages import *
+from metrics import METRICS
+from openai_scheduler import OPENAI_SCHEDULER, DailyBudgetExceeded, estimate_cost, estimate_prompt_tokens
 from utils import *
 
 load_dotenv(override=True)
 
-intents = discord.Intents.all()
-discord_client = discord.Client(intents=intents)
+# timing and counting cost next to nothing while disabled, so the instrumentation stays in place
+if os.getenv("METRICS_ENABLED"):
+    METRICS.enable()
+
+class AiliosClient(discord.Client):
+    """
+        The discord client of the bot, which also closes the connections the commands opened when it shuts down.
+    """
+
+    async def close(self):
+        await close_attachment_session()
+        await super().close()
+
+# only subscribe to the gateway events the commands use: guild/thread metadata (role names, thread cache),
+# guild messages and their content. member lists, presences and typing events are never needed.
+intents = discord.Intents.none()
+intents.guilds = True
+intents.guild_messages = True
+intents.message_content = True
+discord_client = AiliosClient(
+    intents=intents,
+    member_cache_flags=discord.MemberCacheFlags.none(),
+    chunk_guilds_at_startup=False,
+    max_messages=None,
+    http_trace=RATE_LIMIT_TRACKER.trace_config(),
+)
 permissions = discord.Permissions(8)
 
 openai.organization = os.getenv("ORG")
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+conversation_store = setup_conversation_logs()
+answer_cache = AnswerCache(conversation_store)
+# inquiries run on a bounded number of workers while the light commands have workers of their own
+command_queue = CommandQueue("commands", COMMAND_WORKERS)
+fast_lane = CommandQueue("fast_lane", COMMAND_FAST_LANE_WORKERS)
+# a knowledge refresh takes minutes, so it runs on a lane of its own: one at a time with at most one more waiting
+update_lane = CommandQueue("update", 1, size=1)
+KNOWLEDGE_UPDATE_KEY = "knowledge_files"
+openai_client = create_openai_client()
+setup_language_detection()
+load_knowledge_file_manifest()
+KNOWLEDGE_INDEX.load()
+
 logging.basicConfig(
     filename='app.log',
     level=logging.ERROR,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-@discord_client.event
-async def on_ready():
-    """
-        Tasks to perform upon bot server startup.
+async def send_cached_answer(discord_message, text, text_language, cache_key, cached_answer):
     """
-    print(f'Logged in as {discord_client.user}')
-
-
-@discord_client.event
-async def on_message(discord_message):
+        Answers an inquiry with the cached answer to an identical earlier inquiry.
+
+        Args:
+            discord_message (discord.Message): The discord message containing the inquiry.
+            text (str): The inquiry without the command.
+            text_language (str): The language code of the inquiry.
+            cache_key (tuple): The answer cache key of the inquiry.
+            cached_answer (dict): The cached thread title, answer and citations.
     """
-        Tasks to perform when the discord server receives a message.
+    discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, discord_thread_name=cached_answer["title"])
+    await send_initial_discord_response(discord_thread, existing_thread, discord_message, text_language)
+    log_conversation(conversation_store, discord_message, discord_thread, text_language, "user", text, existing_thread)
+    log_conversation(conversation_store, discord_message, discord_thread, text_language, "assistant", cached_answer["answer"] + '\n' + '\n'.join(cached_answer["citations"]), True)
+    # reviews and corrections of this thread now decide if the answer is served again
+    answer_cache.add_thread(cache_key, discord_thread.id)
+    citations = cached_answer["citations"]
+    await send_response_to_discord(discord_thread, cached_answer["answer"] + ('\n\n' + '\n'.join(citations) if citations else ''))
+
+async def handle_help_command(discord_message):
     """
-    await asyncio.sleep(.1)
-
-    load_dotenv(override=True)
-
-    conversations_logs = setup_conversation_logs()
-
-    if discord_message.content.startswith(HELP_COMMAND):
+        Answers an inquiry made with the help command.
 
-        if knowledge_file_needs_update():
-            await update_knowledge_files(discord_message)
-            return
+        Args:
+            discord_message (discord.Message): The discord message containing the inquiry.
+    """
+    if knowledge_file_needs_update():
+        # the refresh runs in the background so this worker is free for the next inquiry right away
+        if KNOWLEDGE_UPDATE_KEY in update_lane.jobs:
+            await discord_message.channel.send(KNOWLEDGE_UPDATED_NEEDED_MESSAGE)
+        else:
+            update_lane.submit(KNOWLEDGE_UPDATE_KEY, lambda: run_command(handle_knowledge_refresh_command, discord_message))
+        return
 
-        discord_thread = None
-        openai_client = OpenAI()
+    discord_thread = None
 
-        # remove command from query
-        text = discord_message.content.removeprefix(HELP_COMMAND + " ")
+    # remove command from query
+    text = discord_message.content.removeprefix(HELP_COMMAND + " ")
 
+    with METRICS.span("detect_language"):
         text_language = detect_message_language(text)
+    cache_key = None
+    storage_task = None
+    header_task = None
+    title_task = None
+    # the thread this inquiry started, logged under its placeholder title until the summarized title is ready
+    created_thread_id = None
 
-        try:
+    try:
 
-            # check if memory is getting close to server limit
-            await storage_check(discord_client)
+        # check if memory is getting close to server limit (nothing below depends on it)
+        storage_task = asyncio.create_task(storage_check(discord_client))
 
-            # handle rate limits
+        # handle the rate limit of the request the inquiry starts with: creating its thread or posting in its thread
+        if is_discord_thread(discord_message, discord_thread):
             remaining, reset = check_rate_limit(f"channels/{discord_message.channel.id}/messages")
-            rate_limit_met = await handle_rate_limit(discord_message, float(remaining), float(reset), is_discord_thread(discord_message, discord_thread))
-            if rate_limit_met:
-                return
-
-            if len(text) > MAX_CHARS_DISCORD:
-                await discord_thread.send(TOO_LONG_DISCORD_MESSAGE_ERROR_MESSAGE)
-                return
+        else:
+            remaining, reset = check_rate_limit(f"channels/{discord_message.channel.id}/messages/{discord_message.id}/threads")
+        rate_limit_met = await handle_rate_limit(discord_message, remaining, reset, is_discord_thread(discord_message, discord_thread))
+        if rate_limit_met:
+            return
 
-            discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, message_content=text)
-            await send_initial_discord_response(discord_thread, existing_thread, discord_message, text_language)
-            conversations_logs = log_conversation(conversations_logs, discord_message, discord_thread, text_language, "user", text, existing_thread)
+        if len(text) > MAX_CHARS_DISCORD:
+            await discord_thread.send(TOO_LONG_DISCORD_MESSAGE_ERROR_MESSAGE)
+            return
 
-            if thread_message_counts(conversations_logs, discord_thread) > MAX_MESSAGES_ALLOWED_IN_THREAD:
-                await send_response_to_discord(discord_thread, MAX_MESSAGES_REACHED_MESSAGE)
+        # only a new inquiry without images has an answer that does not depend on anything but its text
+        if not is_discord_thread(discord_message) and not discord_message.attachments:
+            key = answer_cache_key(text, text_language, os.getenv("LAST_KNOWLEDGE_FILE_UPDATE"))
+            cached_answer = await answer_cache.get(key)
+            METRICS.increment("cache_requests_total", cache="answer", result="miss" if cached_answer is None else "hit")
+            if cached_answer is not None:
+                await send_cached_answer(discord_message, text, text_language, key, cached_answer)
                 return
+            # on a miss this inquiry answers the key for the identical inquiries that arrive meanwhile
+            cache_key = key
+
+        # the pipeline below is a small dependency graph: every step starts as soon as the steps it needs are done,
+        # so the answer is only delayed by the slowest chain of steps instead of their sum
+        #
+        #   title summary ------------------------------------------------------------> rename thread
+        #   create thread -> header and separator -------------------------> stream answer
+        #                 -> log inquiry -> OpenAI thread ----> OpenAI message -->
+        #                 -> attachment download and upload -->
+        if not is_discord_thread(discord_message):
+            # the summarized title replaces the placeholder title once it is ready
+            title_task = asyncio.create_task(generate_thread_title(openai_client, text))
+        discord_thread, existing_thread = await get_discord_thread(
+            openai_client, discord_message, discord_thread_name=placeholder_thread_title(text)
+        )
+        header_task = asyncio.create_task(send_initial_discord_response(discord_thread, existing_thread, discord_message, text_language))
+        log_conversation(conversation_store, discord_message, discord_thread, text_language, "user", text, existing_thread)
+        if not existing_thread:
+            created_thread_id = discord_thread.id
+
+        if thread_message_counts(conversation_store, discord_thread) > MAX_MESSAGES_ALLOWED_IN_THREAD:
+            await header_task
+            await send_response_to_discord(discord_thread, MAX_MESSAGES_REACHED_MESSAGE)
+            return
 
-            # establish existing conversation thread for context
-            openai_conversation = openai_client.conversations.create(
-                messages = conversations_logs[discord_thread.id]["message_log"]
+        # establish existing conversation thread for context (the current message is added below with its images)
+        # while the text and image content to send to the assistant is created
+        message_log = conversation_store.get_thread(discord_thread.id)["message_log"][:-1]
+        with METRICS.span("openai_thread"):
+            openai_thread, (text_content, image_content) = await asyncio.gather(
+                openai_client.beta.threads.create(messages=message_log),
+                populate_multimodal_data_for_openai(openai_client, discord_message, discord_thread, text),
             )
-
-            # create text and image content to send to assistant
-            text_content, image_content = await populate_multimodal_data_for_openai(openai_client, discord_message, discord_thread, text)
-            _ = openai_client.responses.create(
-                prompt={ "id": os.getenvb}
+            _ = await openai_client.beta.threads.messages.create(
+                thread_id=openai_thread.id,
                 role="user",
                 content=text_content + image_content
             )
 
-            # attempt to extract response
-            run = openai_client.beta.threads.runs.create_and_poll(
-                thread_id=openai_thread.id,
-                assistant_id=os.getenv("OPENAI_ASSISTANT_ID"),
-                max_completion_tokens=MAX_COMPLETION_TOKENS,
+        # stream the response into discord while it is generated (after the header so the messages stay in order)
+        await header_task
+        with METRICS.span("knowledge_context"):
+            knowledge_context = get_knowledge_context(text)
+
+        # wait for room in the OpenAI rate limits instead of starting a run that fails (refused over the daily budget)
+        prompt_tokens = estimate_prompt_tokens(MODEL, message_log, text, len(image_content), knowledge_context)
+        reservation = await OPENAI_SCHEDULER.admit(
+            MODEL,
+            prompt_tokens + MAX_COMPLETION_TOKENS,
+            estimate_cost(MODEL, prompt_tokens, MAX_COMPLETION_TOKENS, len(image_content)),
+            on_queued=lambda position, wait: send_queue_position(discord_thread, text_language, position, wait),
+        )
+        try:
+            run, message_content, response_stream = await stream_assistant_response(
+                openai_client, openai_thread, discord_thread, knowledge_context
             )
+        except BaseException:
+            OPENAI_SCHEDULER.settle(reservation)
+            raise
+
+        # log the cost of getting the last response
+        input_cost, output_cost, image_cost = get_openai_run_cost(run, len(image_content))
+        OPENAI_SCHEDULER.settle(reservation, run.usage.total_tokens, input_cost + output_cost + image_cost)
+        conversation_store.add_cost(discord_thread.id, input_cost, output_cost, image_cost)
+        METRICS.increment("openai_tokens_total", run.usage.prompt_tokens, kind="prompt")
+        METRICS.increment("openai_tokens_total", run.usage.completion_tokens, kind="completion")
+        METRICS.increment("openai_cost_dollars_total", input_cost, kind="input")
+        METRICS.increment("openai_cost_dollars_total", output_cost, kind="output")
+        METRICS.increment("openai_cost_dollars_total", image_cost, kind="image")
+
+        # handle citations (replaces the citation markers with footnotes)
+        _, citations = await extract_citations(openai_client, message_content)
+
+        # log conversation with knowledge files cited (in a thread that already exists)
+        log_conversation(conversation_store, discord_message, discord_thread, text_language, "assistant", message_content.value + '\n' + '\n'.join(citations), True)
+
+        thread_title = discord_thread.name
+        if title_task is not None:
+            try:
+                thread_title = await title_task
+            except Exception:
+                # the placeholder title is good enough
+                logging.exception("ERROR OCCURRED")
 
-            # extract assistant response if run successfully completed
-            openai_message = await get_assistant_response(openai_client, openai_thread, run, discord_thread)
+        # replace the streamed text with the final response and its citations and rename the thread
+        response = message_content.value + ('\n\n' + '\n'.join(citations) if citations else '')
+        if cache_key is not None:
+            answer_cache.store(cache_key, thread_title, message_content.value, citations, discord_thread.id)
+        with METRICS.span("discord_finish"):
+            await asyncio.gather(
+                response_stream.finish(response),
+                *([discord_thread.edit(name=thread_title)] if thread_title != discord_thread.name else []),
+            )
 
-            # log the cost of getting the last response
-            input_cost, output_cost, image_cost = get_openai_run_cost(run, len(image_content))
-            conversations_logs[discord_thread.id]["cost_in_dollars"]["input_cost"] += input_cost
-            conversations_logs[discord_thread.id]["cost_in_dollars"]["output_cost"] += output_cost
-            conversations_logs[discord_thread.id]["cost_in_dollars"]["image_cost"] += image_cost
-            conversations_logs[discord_thread.id]["cost_in_dollars"]["total_cost"] += (input_cost + output_cost + image_cost)
+    except DailyBudgetExceeded:
 
-            # extract the message content
-            # the list is populated from the front so the first message is the most recent assistant response
-            message_content = openai_message.data[0].content[0].text
-            # handle citations
-            annotations, citations = extract_citations(openai_client, message_content)
+        budget_message = await translate_message(OPENAI_BUDGET_EXCEEDED_MESSAGE, text_language)
+        log_conversation(conversation_store, discord_message, discord_thread, text_language, "assistant", budget_message, True)
+        await discord_thread.send(budget_message)
 
-            # log conversation with knowledge files cited (in a thread that already exists)
-            conversations_logs = log_conversation(conversations_logs, discord_message, discord_thread, text_language, "assistant", message_content.value + '\n' + '\n'.join(citations), True)
+    except Exception:
 
-            for index, _ in enumerate(annotations):
-                # remove source citation text
-                message_content.value = message_content.value.replace(f' [{index}]', '')
+        if header_task is not None:
+            # the header may still be on its way, so wait for it instead of sending a second one next to it
+            await asyncio.gather(header_task, return_exceptions=True)
+        discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, THREAD_TITLE_ERROR_MESSAGE)
+        if header_task is None or header_task.exception() is not None:
+            await send_initial_discord_response(discord_thread, existing_thread, discord_message, text_language)
+        translated_error_message = await translate_error_message(text_language)
+        log_conversation(conversation_store, discord_message, discord_thread, text_language, "assistant", translated_error_message, existing_thread)
+        await discord_thread.send(translated_error_message)
+        logging.exception("ERROR OCCURRED")
+
+    finally:
+        if cache_key is not None:
+            # let identical inquiries waiting on this one answer themselves if no answer was stored
+            answer_cache.end(cache_key)
+        # the header and the title are no longer needed once the inquiry failed or stopped early
+        side_tasks = [task for task in (header_task, title_task) if task is not None]
+        for task in side_tasks:
+            if not task.done():
+                task.cancel()
+        # retrieve their results so failures are not reported as never retrieved
+        await asyncio.gather(*side_tasks, return_exceptions=True)
+        if created_thread_id is not None and title_task is not None and not title_task.cancelled() and title_task.exception() is None:
+            conversation_store.set_summary(created_thread_id, title_task.result().removeprefix(f"{THREAD_CATEGORY}: "))
+        if storage_task is not None:
+            try:
+                await storage_task
+            except Exception:
+                logging.exception("ERROR OCCURRED")
 
-            # send response to discord using several messages if need be
-            await send_response_to_discord(discord_thread, message_content.value)  
+async def handle_review_command(discord_message):
+    """
+        Stores a rating for the thread the review command was sent in.
 
-        except Exception:
+        Args:
+            discord_message (discord.Message): The discord message containing the rating.
+    """
+    discord_thread, _ = await get_discord_thread(openai_client, discord_message, discord_thread_name=THREAD_TITLE_ERROR_MESSAGE)
+    # store the review or send an error message that review can't be done
+    try:
+        await submit_review(discord_thread, discord_message, conversation_store)
 
-            discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, THREAD_TITLE_ERROR_MESSAGE)
-            await send_initial_discord_response(discord_thread, existing_thread, discord_message, text_language)
-            translated_error_message = translate_error_message(text_language)
-            conversations_logs = log_conversation(conversations_logs, discord_message, discord_thread, text_language, "assistant", translated_error_message, existing_thread)
-            await discord_thread.send(translated_error_message)
-            logging.exception("ERROR OCCURRED")
+    except Exception:
+        # communicate to user that there is a fatal error
+        await discord_thread.send(BOT_ERROR_MESSAGE)
+        logging.exception("ERROR OCCURRED")
 
+async def handle_correction_command(discord_message):
+    """
+        Stores correction instructions for the thread the correction command was sent in.
 
-    elif discord_message.content.startswith(REVIEW_COMMAND):
+        Args:
+            discord_message (discord.Message): The discord message containing the correction.
+    """
+    discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, discord_thread_name=THREAD_TITLE_ERROR_MESSAGE)
 
-        openai_client = OpenAI()
-        discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, discord_thread_name=THREAD_TITLE_ERROR_MESSAGE)
+    if existing_thread and conversation_store.has_thread(discord_thread.id) and (
+        discord_message.author.name == conversation_store.get_thread(discord_thread.id)["message_author"] or
+        any(role.name in CORRECTION_PERMITTED_ROLES for role in discord_message.author.roles)
+    ):
         # store the review or send an error message that review can't be done
         try:
-            conversations_logs = await submit_review(discord_thread, discord_message, conversations_logs)
+            await submit_correction(discord_thread, discord_message, conversation_store)
 
         except Exception:
             # communicate to user that there is a fatal error
             await discord_thread.send(BOT_ERROR_MESSAGE)
             logging.exception("ERROR OCCURRED")
 
-    
-    elif discord_message.content.startswith(CORRECTION_COMMAND):
-
-        openai_client = OpenAI()
-        discord_thread, existing_thread = await get_discord_thread(openai_client, discord_message, discord_thread_name=THREAD_TITLE_ERROR_MESSAGE)
-        
-        if existing_thread and (
-            discord_message.author.name == conversations_logs[discord_thread.id]["message_author"] or
-            any(role.name in CORRECTION_PERMITTED_ROLES for role in discord_message.author.roles)
-        ):
-            # store the review or send an error message that review can't be done
-            try:
-                conversations_logs = await submit_correction(discord_thread, discord_message, conversations_logs)
+    else:
+        await discord_thread.send(PERMISSION_DENIED_MESSAGE)
 
-            except Exception:
-                # communicate to user that there is a fatal error
-                await discord_thread.send(BOT_ERROR_MESSAGE)
-                logging.exception("ERROR OCCURRED")
+async def handle_trigger_update_command(discord_message):
+    """
+        Refreshes the knowledge files on request of a permitted role.
 
-        else:
-            await discord_thread.send(PERMISSION_DENIED_MESSAGE)
+        Args:
+            discord_message (discord.Message): The discord message containing the update request.
+    """
+    if any(role.name in CORRECTION_PERMITTED_ROLES for role in discord_message.author.roles):
+
+        await refresh_knowledge(discord_message)
+
+async def refresh_knowledge(discord_message):
+    """
+        Refreshes the knowledge files and drops the answers given from the old ones.
+
+        Args:
+            discord_message (discord.Message): The discord message that caused the refresh.
+    """
+    await update_knowledge_files(discord_message)
+    answer_cache.clear()
 
-    
-    elif discord_message.content.startswith(TRIGGER_UPDATE_COMMAND):
+async def handle_knowledge_refresh_command(discord_message):
+    """
+        Refreshes the knowledge files for an inquiry that found them outdated, nobody awaits it so errors are logged here.
 
-        if any(role.name in CORRECTION_PERMITTED_ROLES for role in discord_message.author.roles):
+        Args:
+            discord_message (discord.Message): The discord message containing the inquiry.
+    """
+    try:
+        await refresh_knowledge(discord_message)
+    except Exception:
+        logging.exception("ERROR OCCURRED")
 
-            await update_knowledge_files(discord_message)
+async def handle_last_update_command(discord_message):
+    """
+        Reports when the knowledge files were last refreshed.
 
-    elif discord_message.content.startswith(LAST_UPDATE_COMMAND):
+        Args:
+            discord_message (discord.Message): The discord message containing the command.
+    """
+    load_dotenv(override=True)
+    last_update_message = f"The last time the knowledge files were updated was: {os.environ["LAST_KNOWLEDGE_FILE_UPDATE"]}"
 
-        load_dotenv(override=True)
-        LAST_UPDATE_MESSAGE = f"The last time the knowledge files were updated was: {os.environ["LAST_KNOWLEDGE_FILE_UPDATE"]}"
+    await discord_message.channel.send(last_update_message)
 
-        await discord_message.channel.send(LAST_UPDATE_MESSAGE)
+COMMAND_HANDLERS = {
+    HELP_COMMAND: handle_help_command,
+    REVIEW_COMMAND: handle_review_command,
+    CORRECTION_COMMAND: handle_correction_command,
+    TRIGGER_UPDATE_COMMAND: handle_trigger_update_command,
+    LAST_UPDATE_COMMAND: handle_last_update_command,
+}
+# commands that never call the model, so they never wait behind an inquiry
+FAST_LANE_COMMANDS = {REVIEW_COMMAND, CORRECTION_COMMAND, LAST_UPDATE_COMMAND}
 
-    # save the conversation logs
-    with open(CONVERSATION_FILE, 'w', encoding='utf-8') as logs:
-        json.dump(conversations_logs, logs, indent=4)
+async def run_command(command_handler, discord_message):
+    """
+        Handles a command once a worker of its queue is free.
 
-discord_client.run(os.getenv("DISCORD_TOKEN"))
+        Args:
+            command_handler (coroutine function): The handler of the command.
+            discord_message (discord.Message): The discord message containing the command.
+    """
+    command_name = command_handler.__name__.removeprefix("handle_").removesuffix("_command")
+    METRICS.increment("commands_total", command=command_name)
+    with METRICS.span(f"command_{command_name}"):
+        await command_handler(discord_message)
+
+@discord_client.event
+async def on_ready():
+    """
+        Tasks to perform upon bot server startup.
+    """
+    print(f'Logged in as {discord_client.user}')
+    IMAGE_UPLOAD_CACHE.start_expiry(openai_client)
+    await METRICS.start_export()
+    await prewarm_translations(conversation_store)
+
+
+@discord_client.event
+async def on_message(discord_message):
+    """
+        Tasks to perform when the discord server receives a message.
+    """
+    # cheap in-memory checks first so ordinary chatter never touches disk or network
+    if discord_message.author.bot or not discord_message.content.startswith(COMMAND_PREFIX):
+        return
+
+    command = get_message_command(discord_message)
+    command_handler = COMMAND_HANDLERS.get(command)
+    if command_handler is None or not is_command_channel(discord_message):
+        return
+
+    # the commands of a thread run in order, a new inquiry is keyed by the thread it creates (it has the message id)
+    key = discord_message.channel.id if isinstance(discord_message.channel, discord.Thread) else discord_message.id
+    if command == TRIGGER_UPDATE_COMMAND:
+        # every refresh rewrites the same files, so they all share one key
+        queue, key = update_lane, KNOWLEDGE_UPDATE_KEY
+    else:
+        queue = fast_lane if command in FAST_LANE_COMMANDS else command_queue
+    job = queue.submit(key, lambda: run_command(command_handler, discord_message))
+    if job is None:
+        METRICS.increment("commands_rejected_total", command=command)
+        await discord_message.reply(COMMAND_QUEUE_FULL_MESSAGE)
+        return
+
+    # discord.py runs every event in its own task, so waiting here holds up nothing but this message
+    await job
+
+# importing the bot (e.g. from load_test.py) sets up the handlers without connecting to discord
+if __name__ == "__main__":
+    discord_client.run(os.getenv("DISCORD_TOKEN"))
+    conversation_store.close()
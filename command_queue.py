@@ -0,0 +1,79 @@
+"""Bounded queue of bot commands, processed by a fixed number of workers in order within each thread."""
+
+import asyncio
+import time
+from collections import deque
+
+from config import COMMAND_QUEUE_SIZE
+from metrics import METRICS
+
+
+class CommandQueue:
+    """
+        Jobs grouped by key (the discord thread a command belongs to) and run by a fixed number of workers.
+
+        The jobs of one key run one at a time in the order they were submitted while the jobs of different keys run
+        in parallel, so two messages of the same thread never race on its log. At most *size* jobs wait at a time,
+        further jobs are rejected. The workers start with the first job, so the queue needs a running event loop.
+    """
+
+    def __init__(self, name, workers, size=COMMAND_QUEUE_SIZE):
+        self.name = name
+        self.workers = workers
+        self.size = size
+        self.jobs = {}
+        self.ready_keys = asyncio.Queue()
+        self.pending = 0
+        self.worker_tasks = []
+
+    async def _work(self):
+        while True:
+            key = await self.ready_keys.get()
+            future, job, submitted_at = self.jobs[key].popleft()
+            self.pending -= 1
+            METRICS.observe("stage_seconds", time.perf_counter() - submitted_at, stage=f"queue_{self.name}")
+            try:
+                # a submitter that stopped waiting (e.g. the bot is shutting down) no longer needs its job
+                if not future.done():
+                    future.set_result(await job())
+            except BaseException as exception:
+                if not future.done():
+                    if isinstance(exception, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(exception)
+                # a job that was cancelled on its own must not end the worker, unless the worker itself is cancelled
+                if not isinstance(exception, (Exception, asyncio.CancelledError)) or asyncio.current_task().cancelling():
+                    raise
+            finally:
+                # the later jobs of the key must never be left without a worker
+                if self.jobs[key]:
+                    self.ready_keys.put_nowait(key)
+                else:
+                    del self.jobs[key]
+
+    def submit(self, key, job):
+        """
+            Queues a job behind the earlier jobs of its key.
+
+            Args:
+                key (int): The key that orders the job (e.g. the discord thread id).
+                job (coroutine function): The job, called without arguments.
+
+            Returns:
+                future (asyncio.Future | None): Resolves to the result of the job once it ran, None if the queue is full.
+        """
+        if self.pending >= self.size:
+            return None
+        # start the workers with the first job and replace the workers that ended since
+        self.worker_tasks = [task for task in self.worker_tasks if not task.done()]
+        self.worker_tasks += [asyncio.create_task(self._work()) for _ in range(self.workers - len(self.worker_tasks))]
+        future = asyncio.get_running_loop().create_future()
+        self.pending += 1
+        if key in self.jobs:
+            # the key is waiting for or held by a worker, which runs this job after the earlier ones
+            self.jobs[key].append((future, job, time.perf_counter()))
+        else:
+            self.jobs[key] = deque([(future, job, time.perf_counter())])
+            self.ready_keys.put_nowait(key)
+        return future
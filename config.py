@@ -1,14 +1,28 @@
 """Configuration variables for bot."""
 import json
 
+ANSWER_CACHE_MIN_RATING = 5 # answers whose threads average a lower rating are never served again
+ANSWER_CACHE_PREFERRED_RATING = 8 # answers rated at least this never expire and are evicted last
+ANSWER_CACHE_SIZE = 512
+ANSWER_CACHE_TTL = 24 * 60 * 60 # in seconds
 ATTACHMENT_EXTENSIONS = ['.jpg','.png','.jpeg']
 CHANNEL_NAME = "ailios"
-CONVERSATION_FILE = "conversation_logging.json"
+CHARS_PER_TOKEN = 4 # rough average of english text, to estimate tokens without a tokenizer
+COMMAND_FAST_LANE_WORKERS = 2 # run the light commands (ratings, corrections, ...) that never wait behind inquiries
+COMMAND_PREFIX = "/"
+COMMAND_QUEUE_SIZE = 100 # commands waiting per lane before new commands are rejected
+COMMAND_WORKERS = 4 # commands (mostly inquiries) processed at the same time
+CONVERSATION_DATABASE = "conversation_logging.db"
+CONVERSATION_FILE = "conversation_logging.json" # only read once to migrate into CONVERSATION_DATABASE
+CONVERSATION_FLUSH_BATCH_SIZE = 256
+CONVERSATION_FLUSH_INTERVAL = 0.5 # in seconds
+CONVERSATION_WRITE_ATTEMPTS = 3 # tries of a batch while the database is busy before its writes are committed one by one
 CORRECTION_COMMAND = "/correct"
 CORRECTION_PERMITTED_ROLES = ["3rd Party Developer", "Core-Dev"]
 CORRECTION_PERMITTED_ROLES = ["Ro Ro Ro Your Boat"]
 DATE_FORMAT = "%Y-%m-%d"
 DEFAULT_LANGUAGE = "en"
+DISCORD_EXPORT_MAX_CONCURRENCY = 8
 DYNAMIC_CHANNEL_IDS = {
     "announcements": {"id": 712837747685195902, "batch_by_date": False},
     "help": {"id": 721205500556869642, "batch_by_date": True},
@@ -22,23 +36,52 @@ DYNAMIC_CHANNEL_IDS = {
 }
 HELP_COMMAND = "/randohelp"
 IMAGE_COST_IN_DOLLARS = 0.001275
+IMAGE_UPLOAD_CACHE_FILE = "image_upload_cache.json"
+IMAGE_UPLOAD_CACHE_TTL = 24 * 60 * 60 # in seconds since the image was last used
+IMAGE_UPLOAD_EXPIRY_INTERVAL = 60 * 60 # in seconds
 KH2RANDO_WEBSITE_URL = "https://tommadness.github.io/KH2Randomizer/"
 KH2RANDO_WEBSITE_KNOWLEDGE_FILENAME = "kh2fmrando-website.json"
+KNOWLEDGE_FILE_MANIFEST = "knowledge_file_manifest.json"
+KNOWLEDGE_INDEX_FILE = "knowledge_index.bin"
+KNOWLEDGE_INDEX_PASSAGE_CHARS = 1000
+KNOWLEDGE_INDEX_SEGMENTS_FILE = "knowledge_index_segments.json"
+KNOWLEDGE_INDEX_TOP_K = 4
+KNOWLEDGE_UPLOAD_BATCH_SIZE = 20
 LOGGING_FILE = "app.log"
+LANG_DETECT_CACHE_SIZE = 4096
 LANG_DETECT_MIN_PROB = 0.6
+LANG_DETECT_SEED = 0
 LAST_UPDATE_COMMAND = "/lastupdate"
+MAX_ATTACHMENT_CONNECTIONS = 10
+MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024 # in bytes, the largest image OpenAI accepts
 MAX_ATTACHMENTS_ALLOWED = 2
 MAX_CHARS_DISCORD = 2000
 MAX_CHARS_OPENAI_RESPONSE = 2000
+MAX_CHARS_THREAD_TITLE = 100
 MAX_COMPLETION_TOKENS = 2000
 MAX_MESSAGES_ALLOWED_IN_THREAD = 3
 MAX_PIXEL_DIM = 512
+MAX_TOKENS_THREAD_TITLE = 30
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # in seconds
+METRICS_FILE = "metrics.prom"
+METRICS_PORT = 9464 # only served on 127.0.0.1, None to not serve the metrics
+METRICS_SNAPSHOT_INTERVAL = 60 # in seconds
 MIN_WORDS_IN_MESSAGE_FOR_TRANSLATION = 5
 MODEL = "gpt-4o-mini"
+OPENAI_DAILY_BUDGET_IN_DOLLARS = 5.0
+OPENAI_MAX_CONNECTIONS = 50
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 20
 with open("openai_pricing.json", "r", encoding="utf-8") as f:
     OPENAI_PRICING = json.load(f)
+OPENAI_RATE_LIMITS = { # per minute, from the limits page of the OpenAI organization
+    "gpt-4o-mini": {"requests_per_minute": 500, "tokens_per_minute": 200000},
+}
+OPENAI_RUN_OVERHEAD_TOKENS = 4000 # assistant instructions and file search results added to every run
+OPENAI_SPEND_FILE = "openai_spend.json"
 REVIEW_COMMAND = "/rate"
 STORAGE_SPACE = 10.0 # in GiB
+STREAM_EDIT_INTERVAL = 1.0 # in seconds, between edits of a streamed response
+TRANSLATION_CACHE_FILE = "translation_cache.json"
 TRIGGER_UPDATE_COMMAND = "/update"
 TRIGGER_UPDATE_PERMITTED_ROLES = ["3rd Party Developer", "Core-Dev", "Chat Mod"]
 TRIGGER_UPDATE_PERMITTED_ROLES = ["Ro Ro Ro Your Boat"]
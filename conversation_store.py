@@ -0,0 +1,448 @@
+"""SQLite backed store for the conversation logs of each discord thread."""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from config import (
+    CONVERSATION_DATABASE, CONVERSATION_FILE, CONVERSATION_FLUSH_BATCH_SIZE, CONVERSATION_FLUSH_INTERVAL,
+    CONVERSATION_WRITE_ATTEMPTS
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id INTEGER PRIMARY KEY,
+    message_author TEXT,
+    message_content_summary TEXT,
+    message_language TEXT,
+    rating REAL,
+    correction_information TEXT,
+    input_cost REAL NOT NULL DEFAULT 0,
+    output_cost REAL NOT NULL DEFAULT 0,
+    image_cost REAL NOT NULL DEFAULT 0,
+    total_cost REAL NOT NULL DEFAULT 0,
+    user_message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    thread_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (thread_id, position)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+INSERT_THREAD = (
+    "INSERT OR REPLACE INTO threads (thread_id, message_author, message_content_summary, message_language, rating, "
+    "correction_information, input_cost, output_cost, image_cost, total_cost, user_message_count) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+INSERT_MESSAGE = "INSERT OR REPLACE INTO messages (thread_id, position, role, content) VALUES (?, ?, ?, ?)"
+# in seconds, doubled after every busy attempt
+WRITE_RETRY_DELAY = 0.1
+
+
+def message_text(content):
+    """
+        Turns the content of a logged message into text.
+
+        Args:
+            content (str | list): The content, older logs can hold the multimodal content list sent to OpenAI.
+
+        Returns:
+            text (str): The text of the message, without its images.
+
+        Raises:
+            TypeError if the content is neither text nor a content list.
+    """
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text")
+    if not isinstance(content, str):
+        raise TypeError(f"Unsupported message content {content!r}")
+    return content
+
+
+class ConversationStore:
+    """
+        Conversation logs indexed by discord thread id.
+
+        Threads are read from the database the first time they are needed and kept in memory afterwards, so reads
+        always see the latest writes. Every change is turned into a small SQL statement that a single writer thread
+        commits in batches, which keeps the event loop free of disk I/O and means a message never rewrites the
+        whole history.
+    """
+
+    def __init__(self, database=CONVERSATION_DATABASE):
+        self.database = database
+        self.threads = {}
+        self.pending_writes = queue.Queue()
+        self.connection = self._connect()
+        self.connection.executescript(SCHEMA)
+        self.migrate_json_logs()
+        self.writer = threading.Thread(target=self._write_batches, name="conversation-store-writer", daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _commit(self, connection, writes):
+        """
+            Commits writes in one transaction, retrying it while the database is busy. If the transaction still fails,
+            every write is committed on its own so a single bad statement does not take the others down with it.
+
+            Args:
+                connection (sqlite3.Connection): The connection of the writer thread.
+                writes (list): The SQL statements with their parameters.
+
+            Returns:
+                failed_positions (list): The positions in writes of the statements that could not be committed.
+        """
+        for attempt in range(CONVERSATION_WRITE_ATTEMPTS):
+            try:
+                with connection:
+                    for write in writes:
+                        connection.execute(*write)
+                return []
+            except sqlite3.OperationalError:
+                # e.g. the database is locked by another connection
+                logging.exception("ERROR OCCURRED")
+                if attempt + 1 < CONVERSATION_WRITE_ATTEMPTS:
+                    time.sleep(WRITE_RETRY_DELAY * 2 ** attempt)
+            except sqlite3.Error:
+                logging.exception("ERROR OCCURRED")
+                break
+        failed_positions = []
+        for position, write in enumerate(writes):
+            try:
+                with connection:
+                    connection.execute(*write)
+            except sqlite3.Error:
+                logging.exception("ERROR OCCURRED")
+                failed_positions.append(position)
+        return failed_positions
+
+    def _write_batches(self):
+        """
+            Commits queued writes in batches until the store is closed.
+        """
+        connection = self._connect()
+        closing = False
+        while not closing:
+            batch = [self.pending_writes.get()]
+            deadline = time.monotonic() + CONVERSATION_FLUSH_INTERVAL
+            while len(batch) < CONVERSATION_FLUSH_BATCH_SIZE:
+                try:
+                    batch.append(self.pending_writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            writes = []
+            # each flush with the number of writes queued before it
+            flushes = []
+            for write in batch:
+                if write is None:
+                    closing = True
+                elif isinstance(write, Future):
+                    flushes.append((write, len(writes)))
+                else:
+                    writes.append(write)
+            failed_positions = self._commit(connection, writes) if writes else []
+            for flushed, write_count in flushes:
+                failed_count = sum(position < write_count for position in failed_positions)
+                if failed_count:
+                    flushed.set_exception(sqlite3.Error(f"{failed_count} conversation log writes were not committed"))
+                else:
+                    flushed.set_result(None)
+        connection.close()
+
+    def _load(self, thread_id):
+        """
+            Loads a thread from the database into memory.
+
+            Args:
+                thread_id (int): The discord thread id.
+
+            Returns:
+                thread_log (dict | None): The thread log or None if the thread was never logged.
+        """
+        if thread_id in self.threads:
+            return self.threads[thread_id]
+        row = self.connection.execute(
+            "SELECT message_author, message_content_summary, message_language, rating, correction_information, "
+            "input_cost, output_cost, image_cost, total_cost, user_message_count FROM threads WHERE thread_id = ?",
+            (thread_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        messages = self.connection.execute(
+            "SELECT role, content FROM messages WHERE thread_id = ? ORDER BY position", (thread_id,)
+        ).fetchall()
+        thread_log = {
+            "cost_in_dollars": {
+                "input_cost": row[5],
+                "output_cost": row[6],
+                "image_cost": row[7],
+                "total_cost": row[8]
+            },
+            "message_author": row[0],
+            "message_content_summary": row[1],
+            "message_language": row[2],
+            "message_log": [{"role": role, "content": content} for role, content in messages],
+            "rating": row[3],
+            "user_message_count": row[9],
+        }
+        if row[4] is not None:
+            thread_log["correction information"] = row[4]
+        self.threads[thread_id] = thread_log
+        return thread_log
+
+    def _queue_thread(self, thread_id, thread_log):
+        cost = thread_log["cost_in_dollars"]
+        self.pending_writes.put((INSERT_THREAD, (
+            thread_id, thread_log["message_author"], thread_log["message_content_summary"],
+            thread_log["message_language"], thread_log["rating"], thread_log.get("correction information"),
+            cost["input_cost"], cost["output_cost"], cost["image_cost"], cost["total_cost"],
+            thread_log["user_message_count"]
+        )))
+
+    def add_cost(self, thread_id, input_cost, output_cost, image_cost):
+        """
+            Adds the cost of an assistant response to a thread.
+
+            Args:
+                thread_id (int): The discord thread id.
+                input_cost (float): The cost in USD for the input tokens.
+                output_cost (float): The cost in USD for the completion.
+                image_cost (float): The cost in USD for image input.
+        """
+        cost = self.get_thread(thread_id)["cost_in_dollars"]
+        cost["input_cost"] += input_cost
+        cost["output_cost"] += output_cost
+        cost["image_cost"] += image_cost
+        cost["total_cost"] += (input_cost + output_cost + image_cost)
+        self.pending_writes.put((
+            "UPDATE threads SET input_cost = ?, output_cost = ?, image_cost = ?, total_cost = ? WHERE thread_id = ?",
+            (cost["input_cost"], cost["output_cost"], cost["image_cost"], cost["total_cost"], thread_id)
+        ))
+
+    def append_message(self, thread_id, role, content):
+        """
+            Appends a message to the log of an existing thread.
+
+            Args:
+                thread_id (int): The discord thread id.
+                role (str): The role of the message sender.
+                content (str): The content of the message.
+        """
+        thread_log = self.get_thread(thread_id)
+        position = len(thread_log["message_log"])
+        thread_log["message_log"].append({"role": role, "content": content})
+        self.pending_writes.put((INSERT_MESSAGE, (thread_id, position, role, content)))
+        if role == "user":
+            thread_log["user_message_count"] += 1
+            self.pending_writes.put((
+                "UPDATE threads SET user_message_count = ? WHERE thread_id = ?",
+                (thread_log["user_message_count"], thread_id)
+            ))
+
+    def close(self):
+        """
+            Flushes all pending writes and stops the writer thread.
+
+            Raises:
+                sqlite3.Error if some of the pending writes could not be committed.
+        """
+        try:
+            self.flush()
+        finally:
+            self.pending_writes.put(None)
+            self.writer.join()
+            self.connection.close()
+
+    def create_thread(self, thread_id, message_author, message_content_summary, message_language, role, content):
+        """
+            Starts (or restarts) the log of a thread with its first message.
+
+            Args:
+                thread_id (int): The discord thread id.
+                message_author (str): The name of the author of the inquiry.
+                message_content_summary (str): The summary of the inquiry used as thread title.
+                message_language (str): The language code of the inquiry.
+                role (str): The role of the first message sender.
+                content (str): The content of the first message.
+        """
+        thread_log = {
+            "cost_in_dollars": {
+                "input_cost": 0,
+                "output_cost": 0,
+                "image_cost": 0,
+                "total_cost": 0
+            },
+            "message_author": message_author,
+            "message_content_summary": message_content_summary,
+            "message_language": message_language,
+            "message_log": [{"role": role, "content": content}],
+            "rating": None,
+            "user_message_count": int(role == "user"),
+        }
+        self.threads[thread_id] = thread_log
+        self.pending_writes.put(("DELETE FROM messages WHERE thread_id = ?", (thread_id,)))
+        self._queue_thread(thread_id, thread_log)
+        self.pending_writes.put((INSERT_MESSAGE, (thread_id, 0, role, content)))
+
+    def flush(self):
+        """
+            Blocks until every write queued so far has been committed.
+
+            Raises:
+                sqlite3.Error if some of the writes queued so far could not be committed.
+        """
+        flushed = Future()
+        self.pending_writes.put(flushed)
+        flushed.result()
+
+    def get_thread(self, thread_id):
+        """
+            Retrieves the log of a thread.
+
+            Args:
+                thread_id (int): The discord thread id.
+
+            Returns:
+                thread_log (dict): The thread log in the format of the original conversation log file.
+
+            Raises:
+                KeyError if the thread has not been logged.
+        """
+        thread_log = self._load(thread_id)
+        if thread_log is None:
+            raise KeyError(thread_id)
+        return thread_log
+
+    def has_thread(self, thread_id):
+        """
+            Checks if a thread has been logged.
+
+            Args:
+                thread_id (int): The discord thread id.
+        """
+        return self._load(thread_id) is not None
+
+    def languages(self):
+        """
+            Lists the languages of the logged inquiries.
+
+            Returns:
+                languages (list): The distinct language codes in the store.
+        """
+        rows = self.connection.execute("SELECT DISTINCT message_language FROM threads WHERE message_language IS NOT NULL")
+        return [language for (language,) in rows]
+
+    def migrate_json_logs(self, json_file=CONVERSATION_FILE):
+        """
+            One time import of the conversation log file used before the database existed.
+
+            Args:
+                json_file (str): The path to the JSON conversation log file.
+        """
+        already_migrated = self.connection.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone()
+        if already_migrated or not os.path.exists(json_file):
+            return
+        with open(json_file, "r", encoding="utf-8") as logs:
+            try:
+                conversations_logs = json.load(logs)
+            except json.decoder.JSONDecodeError:
+                conversations_logs = {}
+        with self.connection:
+            # one transaction for the whole migration, with a savepoint per thread
+            self.connection.execute("BEGIN")
+            for thread_id, thread_log in conversations_logs.items():
+                # a malformed thread is skipped instead of keeping the bot from starting on every restart
+                try:
+                    message_log = [
+                        {"role": message["role"], "content": message_text(message["content"])}
+                        for message in thread_log.get("message_log", [])
+                    ]
+                    cost = thread_log.get("cost_in_dollars", {})
+                except (AttributeError, KeyError, TypeError):
+                    logging.exception("ERROR OCCURRED")
+                    continue
+                self.connection.execute("SAVEPOINT migrate_thread")
+                try:
+                    self.connection.execute(INSERT_THREAD, (
+                        int(thread_id), thread_log.get("message_author"), thread_log.get("message_content_summary"),
+                        thread_log.get("message_language"), thread_log.get("rating"),
+                        thread_log.get("correction information"), cost.get("input_cost", 0), cost.get("output_cost", 0),
+                        cost.get("image_cost", 0), cost.get("total_cost", 0),
+                        sum(message["role"] == "user" for message in message_log)
+                    ))
+                    self.connection.executemany(INSERT_MESSAGE, [
+                        (int(thread_id), position, message["role"], message["content"])
+                        for position, message in enumerate(message_log)
+                    ])
+                    self.connection.execute("RELEASE migrate_thread")
+                except (AttributeError, TypeError, ValueError, sqlite3.Error):
+                    logging.exception("ERROR OCCURRED")
+                    self.connection.execute("ROLLBACK TO migrate_thread")
+                    self.connection.execute("RELEASE migrate_thread")
+            self.connection.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (json_file,))
+        os.replace(json_file, json_file + ".migrated")
+
+    def set_correction(self, thread_id, correction_instruction):
+        """
+            Stores correction instructions for a thread.
+
+            Args:
+                thread_id (int): The discord thread id.
+                correction_instruction (str): The instructions on how to correct the response.
+        """
+        self.get_thread(thread_id)["correction information"] = correction_instruction
+        self.pending_writes.put((
+            "UPDATE threads SET correction_information = ? WHERE thread_id = ?", (correction_instruction, thread_id)
+        ))
+
+    def set_language(self, thread_id, language):
+        """
+            Stores the detected language of a thread.
+
+            Args:
+                thread_id (int): The discord thread id.
+                language (str): The language code of the inquiry.
+        """
+        self.get_thread(thread_id)["message_language"] = language
+        self.pending_writes.put(("UPDATE threads SET message_language = ? WHERE thread_id = ?", (language, thread_id)))
+
+    def set_rating(self, thread_id, rating):
+        """
+            Stores the user rating of a thread.
+
+            Args:
+                thread_id (int): The discord thread id.
+                rating (float): The rating between 1 and 10.
+        """
+        self.get_thread(thread_id)["rating"] = rating
+        self.pending_writes.put(("UPDATE threads SET rating = ? WHERE thread_id = ?", (rating, thread_id)))
+
+    def set_summary(self, thread_id, message_content_summary):
+        """
+            Stores the summary of the inquiry of a thread once its title is generated.
+
+            Args:
+                thread_id (int): The discord thread id.
+                message_content_summary (str): The summary of the inquiry used as thread title.
+        """
+        self.get_thread(thread_id)["message_content_summary"] = message_content_summary
+        self.pending_writes.put((
+            "UPDATE threads SET message_content_summary = ? WHERE thread_id = ?", (message_content_summary, thread_id)
+        ))
@@ -1,78 +1,576 @@
 """
-You will need to download the DiscordChatExporter.Cli in order to extract the messages from the Discord server.
-You can download it from https://github.com/Tyrrrz/DiscordChatExporter/releases
+Exports the messages of the channels in DYNAMIC_CHANNEL_IDS into the dynamic knowledge files.
+
+Messages are fetched straight from the Discord API. The id of the last exported message of every channel is kept in
+export_cursors.json so each run only fetches the messages posted since the previous run. DISCORD_SCRAPER_TOKEN is
+sent as is, so prefix it with "Bot " when using a bot token.
+
+Once exported, near identical messages (repeated questions, pasted logs, bot spam) across every channel and month are
+collapsed into their first occurrence, which records the size of its cluster in duplicateCount.
 """
 
+import asyncio
+import glob
+import hashlib
 import json
 import os
+import random
 import re
-import subprocess
+import aiohttp
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta
-from datetime import datetime
+from datetime import datetime, timezone
 
-from config import DATE_FORMAT, DYNAMIC_CHANNEL_IDS
+from config import DISCORD_EXPORT_MAX_CONCURRENCY, DYNAMIC_CHANNEL_IDS
 
 load_dotenv(override=True)
 
 BASE_DIR = os.path.join(os.path.dirname(__file__), "knowledge-files")  # Get the directory of the current Python file
 DYNAMIC_FILES_DIR = os.path.join(BASE_DIR, "dynamic-files")
+CURSOR_FILE = os.path.join(BASE_DIR, "export_cursors.json")  # kept out of dynamic-files so it is never uploaded
+DISCORD_API_URL = "https://discord.com/api/v10"
+DISCORD_EPOCH_MS = 1420070400000
+MESSAGES_PER_PAGE = 100
+STRIP_READ_CHUNK_SIZE = 1024 * 1024
+# new messages of a channel handed to a strip worker at a time, every hand off rewrites the knowledge files it touches
+STRIP_CHUNK_MESSAGES = 5000
+# near duplicate detection: messages are sets of word 3-grams compared with 32 MinHashes split into 8 bands of 4,
+# so messages that are 80% similar share a band with probability 1 - (1 - 0.8^4)^8 ≈ 0.985 (0.52 with 4 bands of 8)
+SHINGLE_SIZE = 3
+DUPLICATE_MIN_WORDS = 5  # shorter messages are too short to compare reliably and are always kept
+DUPLICATE_SIMILARITY = 0.8
+MINHASH_BANDS = 8
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(0)
+MINHASH_COEFFICIENTS = [(_minhash_random.randrange(1, MINHASH_PRIME), _minhash_random.randrange(MINHASH_PRIME)) for _ in range(32)]
 
 # Get the current date
 current_date = datetime.now()
 
 # Generate the last day of the previous 13 months in chronological order
 dates = [(current_date - relativedelta(months=i)).replace(day=1) - relativedelta(days=1) for i in range(12, -1, -1)]
-dates = [date.strftime(DATE_FORMAT) for date in dates]
+# date batched channels keep the 12 full months that end with the previous month
+window_start = dates[1].replace(day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+window_end = window_start + relativedelta(months=12)
+
+
+class AdaptiveConcurrency:
+    """
+        Limits the number of requests in flight, growing the limit while requests succeed and halving it (and pausing
+        every request) whenever Discord answers with a 429.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.active = 0
+        self.paused_until = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        delay = self.paused_until - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self, retry_after=None):
+        async with self.condition:
+            self.active -= 1
+            if retry_after is not None:
+                self.limit = max(1, self.limit // 2)
+                self.paused_until = max(self.paused_until, asyncio.get_running_loop().time() + retry_after)
+            elif self.limit < self.maximum:
+                self.limit += 1
+            self.condition.notify_all()
+
+
+def date_to_snowflake(date):
+    """
+        Converts a date to the smallest Discord message id that could have been posted at that date.
+    """
+    return (int(date.timestamp() * 1000) - DISCORD_EPOCH_MS) << 22
+
+def to_export_message(message):
+    """
+        Converts a message from the Discord API into the stripped export format of the knowledge files.
+
+        Args:
+            message: A message object returned by the Discord API.
+
+        Returns:
+            The message with only the fields the knowledge files keep.
+    """
+    reference = message.get("message_reference")
+    return {
+        "id": message["id"],
+        "timestamp": message["timestamp"],
+        "content": message["content"],
+        "author": {
+            "name": message["author"]["username"],
+            "isBot": message["author"].get("bot", False),
+        },
+        "attachments": [
+            {"id": attachment["id"], "url": attachment["url"], "fileName": attachment["filename"]}
+            for attachment in message.get("attachments", [])
+        ],
+        "embeds": message.get("embeds", []),
+        "mentions": [{"name": user["username"]} for user in message.get("mentions", [])],
+        **({"reference": {
+            "messageId": reference.get("message_id"),
+            "channelId": reference.get("channel_id"),
+            "guildId": reference.get("guild_id"),
+        }} if reference else {}),
+    }
+
+async def fetch_messages_after(session, limiter, channel_id, after):
+    """
+        Fetches one page of the messages posted in a channel after a message id, retrying when rate limited.
+
+        Args:
+            session: The aiohttp session authorized for the Discord API.
+            limiter: The AdaptiveConcurrency shared by every export.
+            channel_id: The id of the channel.
+            after: The message id to fetch after.
+
+        Returns:
+            The page of messages sorted from oldest to newest.
+    """
+    url = f"{DISCORD_API_URL}/channels/{channel_id}/messages"
+    while True:
+        await limiter.acquire()
+        retry_after = None
+        try:
+            async with session.get(url, params={"after": str(after), "limit": str(MESSAGES_PER_PAGE)}) as response:
+                if response.status == 429:
+                    retry_after = float(response.headers.get("Retry-After", 1))
+                    continue
+                response.raise_for_status()
+                messages = await response.json()
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    # wait out the bucket before the next request instead of running into a 429
+                    await asyncio.sleep(float(response.headers.get("X-RateLimit-Reset-After", 0)))
+        finally:
+            await limiter.release(retry_after)
+        return sorted(messages, key=lambda message: int(message["id"]))
+
+async def export_channel(session, limiter, strip_pool, channel_name, channel_info, cursors):
+    """
+        Exports the messages posted in a channel since its last export.
+
+        Args:
+            session: The aiohttp session authorized for the Discord API.
+            limiter: The AdaptiveConcurrency shared by every export.
+            strip_pool: The process pool that strips and appends the messages of each knowledge file.
+            channel_name: The name of the channel in DYNAMIC_CHANNEL_IDS.
+            channel_info: The id and batching information of the channel.
+            cursors: The id of the last exported message of every channel, updated in place.
+
+        Returns:
+            The filenames of the knowledge files that received new messages.
+    """
+    channel_id, batch_channel_by_date = channel_info["id"], channel_info["batch_by_date"]
+    current_knowledge_filepath = os.path.join(DYNAMIC_FILES_DIR, channel_name)
+    after = cursors.get(channel_name) or (date_to_snowflake(window_start) if batch_channel_by_date else 0)
+    loop = asyncio.get_running_loop()
+    channel = {"id": str(channel_id), "name": channel_name}
+    exported_filenames = []
+    exported_count = 0
+
+    async def strip_chunk(messages_by_filename):
+        # strip and append in other processes so fetching (and the remaining channels) keep going meanwhile
+        strip_results = await asyncio.gather(*[
+            loop.run_in_executor(strip_pool, strip_discord_messages, current_knowledge_filepath, filename, messages, channel)
+            for filename, messages in messages_by_filename.items()
+        ], return_exceptions=True)
+        for result in strip_results:
+            if isinstance(result, BaseException):
+                # keep the cursor of the last stripped chunk, the next export appends the rest again and skips the
+                # ids already written
+                raise result
+        cursors[channel_name] = list(messages_by_filename.values())[-1][-1]["id"]
+        with open(CURSOR_FILE, "w", encoding="utf-8") as file:
+            json.dump(cursors, file, indent=4)
+
+    # pages are stripped in chunks of STRIP_CHUNK_MESSAGES while the next pages are fetched, so only the chunk being
+    # filled and the chunk being stripped are in memory however long the history of the channel is
+    messages_by_filename = {}
+    chunk_size = 0
+    strip_task = None
+    finished = False
+    try:
+        while not finished:
+            page = await fetch_messages_after(session, limiter, channel_id, after)
+            finished = len(page) < MESSAGES_PER_PAGE
+            for message in page:
+                if batch_channel_by_date:
+                    timestamp = datetime.fromisoformat(message["timestamp"])
+                    if timestamp >= window_end:
+                        # the current month is exported once it is over
+                        finished = True
+                        break
+                    filename = f"{channel_name}-{timestamp.strftime('%B_%Y')}.json"
+                else:
+                    filename = f"{channel_name}.json"
+                messages_by_filename.setdefault(filename, []).append(to_export_message(message))
+                chunk_size += 1
+            if page:
+                after = page[-1]["id"]
+            if messages_by_filename and (finished or chunk_size >= STRIP_CHUNK_MESSAGES):
+                if strip_task is not None:
+                    # the chunks of a channel are appended in order
+                    await strip_task
+                strip_task = asyncio.ensure_future(strip_chunk(messages_by_filename))
+                exported_filenames += [filename for filename in messages_by_filename if filename not in exported_filenames]
+                exported_count += chunk_size
+                messages_by_filename = {}
+                chunk_size = 0
+    except BaseException:
+        if strip_task is not None:
+            # a failed page still lets the chunk before it finish and move the cursor
+            await asyncio.gather(strip_task, return_exceptions=True)
+        raise
+    if strip_task is not None:
+        await strip_task
+
+    print(f"Exported {exported_count} messages from {channel_name}")
+    return [(current_knowledge_filepath, filename) for filename in exported_filenames]
+
+async def export_channels(strip_pool):
+    """
+        Exports every channel in DYNAMIC_CHANNEL_IDS concurrently.
+
+        Args:
+            strip_pool: The process pool that strips and appends the messages of each knowledge file.
+
+        Returns:
+            The (directory, filename) of every knowledge file that received new messages.
+    """
+    cursors = {}
+    if os.path.exists(CURSOR_FILE):
+        with open(CURSOR_FILE, "r", encoding="utf-8") as file:
+            cursors = json.load(file)
+    os.makedirs(DYNAMIC_FILES_DIR, exist_ok=True)
+
+    limiter = AdaptiveConcurrency(DISCORD_EXPORT_MAX_CONCURRENCY)
+    headers = {"Authorization": os.getenv("DISCORD_SCRAPER_TOKEN")}
+    async with aiohttp.ClientSession(headers=headers, raise_for_status=False) as session:
+        exported_files = await asyncio.gather(*[
+            export_channel(session, limiter, strip_pool, channel_name, channel_info, cursors)
+            for channel_name, channel_info in DYNAMIC_CHANNEL_IDS.items()
+        ], return_exceptions=True)
+    # a channel that failed (e.g. 403 or 5xx) keeps its old cursor and is exported again by the next run
+    for channel_name, channel_files in zip(DYNAMIC_CHANNEL_IDS, exported_files):
+        if isinstance(channel_files, BaseException):
+            print(f"Failed to export {channel_name}: {channel_files!r}")
+    return [
+        exported_file for channel_files in exported_files if not isinstance(channel_files, BaseException)
+        for exported_file in channel_files
+    ]
+
+class JsonStreamReader:
+    """
+        Reads the values of a JSON document one at a time so only the value being read is held in memory.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.file.read(STRIP_READ_CHUNK_SIZE)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        self.eof = not chunk
+
+    def peek_char(self):
+        """
+            Returns the next non whitespace character without consuming it.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position] if self.position < len(self.buffer) else ""
+            self._fill()
+
+    def read_char(self):
+        """
+            Consumes the next non whitespace character.
+        """
+        char = self.peek_char()
+        if not char:
+            raise ValueError("Unexpected end of JSON document")
+        self.position += 1
+        return char
+
+    def read_value(self):
+        """
+            Consumes the next JSON value.
+        """
+        self.peek_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a value that ends with the buffer might continue in the next chunk (e.g. a number)
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
 
-def run_command(command):
+def strip_message(message):
     """
-        Runs a terminal command to start Discord Chat Exporting.
+        Removes the fields the knowledge files do not need from an exported message.
 
         Args:
-            command: The terminal command to be run.
+            message: A message in the DiscordChatExporter JSON format.
+
+        Returns:
+            The stripped message.
     """
-    subprocess.run(command, cwd=os.path.join(BASE_DIR, "DiscordChatExporter.Cli"), check=True)
+    message.pop("type", None)
+    message.pop("timestampEdited", None)
+    message.pop("callEndedTimestamp", None)
+    message.pop("isPinned", None)
+    message.pop("reactions", None)
+    message.pop("stickers", None)
+    message["author"].pop("id", None)
+    message["author"].pop("discriminator", None)
+    message["author"].pop("nickname", None)
+    message["author"].pop("color", None)
+    message["author"].pop("avatarUrl", None)
+    # ensure that the roles are in dictionary form before scarping the relevant role titles
+    if "roles" in message["author"]:
+        if isinstance(message["author"]["roles"], list):
+            if len(message["author"]["roles"]) > 0 and isinstance(message["author"]["roles"][0], dict):
+                message["author"]["roles"] = [role["name"] for role in message["author"]["roles"]]
+    return message
 
-def strip_discord_messages(knowledge_filepath, dated_filename):
+def strip_discord_messages(knowledge_filepath, dated_filename, new_messages=None, channel=None, message_filter=None):
     """
         Strips the relevant content from the messages within a discord channel. 
 
+        The file is streamed message by message into a temporary file that replaces it, so memory stays bounded
+        regardless of the size of the export.
+
         Args:
             knowledge_filepath: The filepath of where the relevant knowledge files are located (usually dynamic files).
             dated_filename: The filename for the information in question. May be dated.
+            new_messages: Messages to append after the existing ones, skipping ids the file already contains.
+            channel: The channel information written when the file does not exist yet.
+            message_filter: Called with every stripped message, returns the message to write or None to drop it.
 
         Outputs:
             Stripped discord messages pertaining to the relevant files in question.
     """
     current_filepath = os.path.join(knowledge_filepath, dated_filename)
-    if os.path.exists(current_filepath):
-        with open(current_filepath, "r", encoding="utf-8") as file:
-            if os.path.getsize(current_filepath) > 0:  # Check if the file has non-null content
-                data = json.load(file)
+    has_content = os.path.exists(current_filepath) and os.path.getsize(current_filepath) > 0
+    if os.path.exists(current_filepath) and not has_content:
+        os.remove(current_filepath)  # Delete the file if it is empty
+    if not has_content and not new_messages:
+        return  # Exit the function as there's no need to process further
+
+    os.makedirs(knowledge_filepath, exist_ok=True)
+    exported_ids = set()
+    message_count = 0
+
+    def write_messages(output, messages):
+        nonlocal message_count
+        for message in messages:
+            if message.get("id") in exported_ids:
+                continue
+            exported_ids.add(message.get("id"))
+            message = strip_message(message)
+            if message_filter is not None and (message := message_filter(message)) is None:
+                continue
+            output.write((", " if message_count else "") + json.dumps(message))
+            message_count += 1
+
+    temporary_filepath = current_filepath + ".tmp"
+    with open(temporary_filepath, "w", encoding="utf-8") as output:
+        output.write("{")
+        separator = ""
+        wrote_messages = False
+        if has_content:
+            with open(current_filepath, "r", encoding="utf-8") as file:
+                reader = JsonStreamReader(file)
+                reader.read_char()  # {
+                while reader.peek_char() != "}":
+                    key = reader.read_value()
+                    reader.read_char()  # :
+                    output.write(f"{separator}{json.dumps(key)}: ")
+                    separator = ", "
+                    if key == "messages":
+                        output.write("[")
+                        reader.read_char()  # [
+                        while reader.peek_char() != "]":
+                            write_messages(output, [reader.read_value()])
+                            if reader.peek_char() == ",":
+                                reader.read_char()
+                        reader.read_char()  # ]
+                        write_messages(output, new_messages or [])
+                        output.write("]")
+                        wrote_messages = True
+                    elif key == "messageCount" and wrote_messages:
+                        reader.read_value()
+                        output.write(str(message_count))
+                    else:
+                        output.write(json.dumps(reader.read_value()))
+                    if reader.peek_char() == ",":
+                        reader.read_char()
+        if not wrote_messages:
+            if not has_content:
+                output.write(f'"channel": {json.dumps(channel)}')
+                separator = ", "
+            output.write(f'{separator}"messages": [')
+            write_messages(output, new_messages or [])
+            output.write("]")
+        output.write("}")
+    os.replace(temporary_filepath, current_filepath)
+
+def iter_exported_messages(filepath):
+    """
+        Reads the messages of a knowledge file one at a time.
+
+        Args:
+            filepath: The path of the exported channel file.
+
+        Yields:
+            The messages of the file in order.
+    """
+    with open(filepath, "r", encoding="utf-8") as file:
+        reader = JsonStreamReader(file)
+        reader.read_char()  # {
+        while reader.peek_char() != "}":
+            key = reader.read_value()
+            reader.read_char()  # :
+            if key == "messages":
+                reader.read_char()  # [
+                while reader.peek_char() != "]":
+                    yield reader.read_value()
+                    if reader.peek_char() == ",":
+                        reader.read_char()
+                reader.read_char()  # ]
             else:
-                os.remove(current_filepath)  # Delete the file if it is empty
-                return  # Exit the function as there's no need to process further
-        for message in data["messages"]:
-            message.pop("type", None)
-            message.pop("timestampEdited", None)
-            message.pop("callEndedTimestamp", None)
-            message.pop("isPinned", None)
-            message.pop("reactions", None)
-            message.pop("stickers", None)
-            message["author"].pop("id", None)
-            message["author"].pop("discriminator", None)
-            message["author"].pop("nickname", None)
-            message["author"].pop("color", None)
-            message["author"].pop("avatarUrl", None)
-            # ensure that the roles are in dictionary form before scarping the relevant role titles
-            if "roles" in message["author"]:
-                if isinstance(message["author"]["roles"], list):
-                    if len(message["author"]["roles"]) > 0 and isinstance(message["author"]["roles"][0], dict):
-                        message["author"]["roles"] = [role["name"] for role in message["author"]["roles"]]
-        with open(os.path.join(knowledge_filepath, dated_filename), "w", encoding="utf-8") as file:
-            json.dump(data, file)
+                reader.read_value()
+            if reader.peek_char() == ",":
+                reader.read_char()
+
+def minhash_signature(content):
+    """
+        Computes the MinHash signature of the word 3-grams of a message.
+
+        Args:
+            content: The content of the message.
+
+        Returns:
+            The signature, or None if the message is too short to be compared.
+    """
+    words = re.findall(r"\w+", content.lower())
+    if len(words) < DUPLICATE_MIN_WORDS:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in shingles]
+    return array("Q", (min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_COEFFICIENTS))
+
+def find_duplicate_messages(filepaths):
+    """
+        Clusters near identical messages across knowledge files.
+
+        Every message is only compared with the cluster representatives it shares a band of its MinHash signature
+        with, so the files are read once and the run time grows linearly with the number of messages.
+
+        Args:
+            filepaths: The exported channel files, in the order their messages should be considered.
+
+        Returns:
+            The ids of the duplicate messages to drop and the updated duplicateCount of the representatives, both
+            indexed by file.
+    """
+    rows = len(MINHASH_COEFFICIENTS) // MINHASH_BANDS
+    buckets = {}
+    # file, message id, signature, cluster size and the cluster size recorded in the file
+    representatives = []
+    duplicate_ids = defaultdict(set)
+    for filepath in filepaths:
+        for message in iter_exported_messages(filepath):
+            signature = minhash_signature(message.get("content") or "")
+            if signature is None:
+                continue
+            bands = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(MINHASH_BANDS)]
+            match = None
+            for band in bands:
+                candidate = buckets.get(band)
+                if candidate is not None:
+                    candidate_signature = representatives[candidate][2]
+                    agreement = sum(x == y for x, y in zip(signature, candidate_signature)) / len(signature)
+                    if agreement >= DUPLICATE_SIMILARITY:
+                        match = candidate
+                        break
+            # a representative collapsed by an earlier run brings its whole cluster along
+            count = message.get("duplicateCount", 1)
+            if match is None:
+                for band in bands:
+                    buckets.setdefault(band, len(representatives))
+                representatives.append([filepath, message["id"], signature, count, count])
+            else:
+                representatives[match][3] += count
+                duplicate_ids[filepath].add(message["id"])
+
+    duplicate_counts = defaultdict(dict)
+    for filepath, message_id, _, count, recorded_count in representatives:
+        if count != recorded_count:
+            duplicate_counts[filepath][message_id] = count
+    return duplicate_ids, duplicate_counts
+
+def collapse_duplicate(duplicate_ids, duplicate_counts, message):
+    """
+        Drops a duplicate message or records the cluster size of a representative.
+    """
+    if message.get("id") in duplicate_ids:
+        return None
+    if message.get("id") in duplicate_counts:
+        message["duplicateCount"] = duplicate_counts[message["id"]]
+    return message
+
+def deduplicate_messages(strip_pool):
+    """
+        Collapses the near identical messages of every exported channel and month into one representative each.
+
+        Args:
+            strip_pool: The process pool that rewrites the knowledge files that changed.
+    """
+    filepaths = [
+        filepath for channel_name in DYNAMIC_CHANNEL_IDS
+        for filepath in glob.glob(os.path.join(DYNAMIC_FILES_DIR, channel_name, "*.json"))
+    ]
+    # oldest file first (by its first message id) so the first occurrence of a message represents its cluster
+    filepaths.sort(key=lambda filepath: int(next(iter_exported_messages(filepath), {}).get("id", 0)))
+    duplicate_ids, duplicate_counts = find_duplicate_messages(filepaths)
+    # only rewrite the files that changed so the others keep their content hash and are not uploaded again
+    changed_filepaths = sorted(set(duplicate_ids) | set(duplicate_counts))
+    rewrites = [
+        strip_pool.submit(
+            strip_discord_messages, os.path.dirname(filepath), os.path.basename(filepath),
+            message_filter=partial(collapse_duplicate, duplicate_ids.get(filepath, set()), duplicate_counts.get(filepath, {}))
+        )
+        for filepath in changed_filepaths
+    ]
+    for rewrite in rewrites:
+        rewrite.result()
+    print(f"Removed {sum(len(ids) for ids in duplicate_ids.values())} near duplicate messages from "
+          f"{len(changed_filepaths)} knowledge files")
 
 def delete_excess_media(media_dir):
     media_files = os.listdir(media_dir)
@@ -81,47 +579,8 @@ def delete_excess_media(media_dir):
         os.remove(os.path.join(media_dir, file))
 
 
-command_list = []
-COMMAND_NAME = "DiscordChatExporter.Cli.exe" if os.name == 'nt' else "./DiscordChatExporter.Cli"
-for channel_name, channel_info in DYNAMIC_CHANNEL_IDS.items():
-    channel_id, batch_channel_by_date = channel_info["id"], channel_info["batch_by_date"]
-    current_knowledge_filepath = os.path.join(DYNAMIC_FILES_DIR, channel_name)
-    if batch_channel_by_date:
-        for after_date, before_date in zip(dates, dates[1:]):
-            date_filename = f"{channel_name}-{datetime.strptime(before_date, DATE_FORMAT).strftime('%B_%Y')}.json"
-            output_file = os.path.join(current_knowledge_filepath, date_filename)
-            # media_dir = os.path.join(current_knowledge_filepath, f"{date_filename.replace(".json", "")} MEDIA")
-            command_list.append([
-                COMMAND_NAME, "export", "-t", os.getenv("DISCORD_SCRAPER_TOKEN"),
-                "-c", f"{channel_id}", "-f", "Json", "-o", output_file, 
-                # "--media", "--reuse-media", "--media-dir", media_dir,
-                "--after", after_date, "--before", before_date
-            ])
-    else:
-        output_file = os.path.join(current_knowledge_filepath, f"{channel_name}.json")
-        media_dir = os.path.join(current_knowledge_filepath, f"{channel_name} MEDIA")
-        command_list.append([
-            COMMAND_NAME, "export", "-t", os.getenv("DISCORD_SCRAPER_TOKEN"), 
-            "-c", f"{channel_id}", "-f", "Json", "-o", output_file, 
-            # "--media", "--reuse-media", "--media-dir", media_dir
-        ])
-
-with ThreadPoolExecutor(max_workers=12) as executor:
-    executor.map(run_command, command_list)
-
-
-for channel_name, channel_info in DYNAMIC_CHANNEL_IDS.items():
-    channel_id, batch_channel_by_date = channel_info["id"], channel_info["batch_by_date"]
-    current_knowledge_filepath = os.path.join(DYNAMIC_FILES_DIR, channel_name)
-    if batch_channel_by_date:
-        for after_date, before_date in zip(dates, dates[1:]):
-            date_filename = f"{channel_name}-{datetime.strptime(before_date, DATE_FORMAT).strftime('%B_%Y')}.json"
-            strip_discord_messages(current_knowledge_filepath, date_filename)
-            # media_dir = os.path.join(current_knowledge_filepath, f"{date_filename.replace(".json", "")} MEDIA")
-            # delete_excess_media(media_dir)
-    else:
-        date_filename = f"{channel_name}.json"
-        strip_discord_messages(current_knowledge_filepath, date_filename)
-        # media_dir = os.path.join(current_knowledge_filepath, f"{channel_name} MEDIA")
-        # delete_excess_media(media_dir)
-
+if __name__ == "__main__":
+    # the guard keeps the strip worker processes from exporting again when they import this script
+    with ProcessPoolExecutor() as pool:
+        asyncio.run(export_channels(pool))
+        deduplicate_messages(pool)
@@ -0,0 +1,124 @@
+"""Cache of the images uploaded to OpenAI, indexed by content hash."""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+
+import openai
+
+from config import IMAGE_UPLOAD_CACHE_FILE, IMAGE_UPLOAD_CACHE_TTL, IMAGE_UPLOAD_EXPIRY_INTERVAL
+from metrics import METRICS
+
+
+class ImageUploadCache:
+    """
+        OpenAI file ids of uploaded images indexed by the sha256 digest of the image.
+
+        An image that is posted again (or posted while its first upload is still running) reuses the same file. Files
+        that were not used for IMAGE_UPLOAD_CACHE_TTL seconds are forgotten and deleted from OpenAI by expire, which
+        runs when start_expiry is called and every IMAGE_UPLOAD_EXPIRY_INTERVAL seconds after. The file ids are saved
+        to IMAGE_UPLOAD_CACHE_FILE, so a restart neither uploads the images again nor leaks the files uploaded before it.
+    """
+
+    def __init__(self, ttl=IMAGE_UPLOAD_CACHE_TTL, cache_file=IMAGE_UPLOAD_CACHE_FILE):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        # content hash -> [file id, unix time of last use]
+        self.file_ids = {}
+        self.uploads = {}
+        self.expiry_task = None
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as cache:
+                try:
+                    self.file_ids = json.load(cache)
+                except json.decoder.JSONDecodeError:
+                    self.file_ids = {}
+
+    async def _upload(self, openai_client, content_hash, image_data, filename):
+        try:
+            # the bytes are sent as they are, without a copy through a temporary file
+            file_response = await openai_client.files.create(file=(filename, image_data), purpose="vision")
+            self.file_ids[content_hash] = [file_response.id, time.time()]
+            self.save()
+            return file_response.id
+        finally:
+            del self.uploads[content_hash]
+
+    async def expire(self, openai_client):
+        """
+            Forgets the images that were not used for the time to live and deletes their files from OpenAI.
+
+            Args:
+                openai_client (openai.AsyncOpenAI): The OpenAI client the images were uploaded with.
+        """
+        now = time.time()
+        expired_hashes = [
+            content_hash for content_hash, (_, last_used) in self.file_ids.items() if now - last_used > self.ttl
+        ]
+        for content_hash in expired_hashes:
+            file_id, _ = self.file_ids.pop(content_hash)
+            try:
+                await openai_client.files.delete(file_id)
+            except openai.NotFoundError:
+                pass
+            except openai.OpenAIError:
+                # keep the file to delete it with the next expiry
+                self.file_ids[content_hash] = [file_id, 0]
+                logging.exception("ERROR OCCURRED")
+        if expired_hashes:
+            self.save()
+
+    async def _expire_periodically(self, openai_client, interval):
+        while True:
+            # the files uploaded before a restart may have expired already
+            await self.expire(openai_client)
+            await asyncio.sleep(interval)
+
+    def save(self):
+        """
+            Writes the file ids to disk.
+        """
+        temporary_file = self.cache_file + ".tmp"
+        with open(temporary_file, "w", encoding="utf-8") as cache:
+            json.dump(self.file_ids, cache)
+        os.replace(temporary_file, self.cache_file)
+
+    def start_expiry(self, openai_client, interval=IMAGE_UPLOAD_EXPIRY_INTERVAL):
+        """
+            Schedules expire every *interval* seconds, unless it is scheduled already.
+
+            Args:
+                openai_client (openai.AsyncOpenAI): The OpenAI client the images were uploaded with.
+                interval (float): The seconds between two expiries.
+        """
+        if self.expiry_task is None or self.expiry_task.done():
+            self.expiry_task = asyncio.create_task(self._expire_periodically(openai_client, interval))
+
+    async def upload(self, openai_client, image_data, filename):
+        """
+            Uploads an image unless an identical image was uploaded already.
+
+            Args:
+                openai_client (openai.AsyncOpenAI): The OpenAI client to upload images to.
+                image_data (bytes): The bytes of the image.
+                filename (str): The filename of the image.
+
+            Returns:
+                file_id (str): The OpenAI file id of the image.
+        """
+        content_hash = hashlib.sha256(image_data).hexdigest()
+        cached_file = self.file_ids.get(content_hash)
+        METRICS.increment("cache_requests_total", cache="image_upload", result="miss" if cached_file is None else "hit")
+        if cached_file is not None:
+            cached_file[1] = time.time()
+            self.save()
+            return cached_file[0]
+        if content_hash not in self.uploads:
+            self.uploads[content_hash] = asyncio.ensure_future(self._upload(openai_client, content_hash, image_data, filename))
+        return await asyncio.shield(self.uploads[content_hash])
+
+
+IMAGE_UPLOAD_CACHE = ImageUploadCache()
@@ -1,6 +1,8 @@
 # Configuration equivalent to config.ts
 class Config:
-    def __init__(self, url, match, selector, max_pages_to_crawl, output_file_name, cookie=None, on_visit_page=None):
+    def __init__(self, url, match, selector, max_pages_to_crawl, output_file_name, cookie=None, on_visit_page=None,
+                 max_concurrency_per_host=4, cache_file=None, checkpoint_file=None):
+        # url and match may also be lists to crawl several sites at once
         self.url = url
         self.match = match
         self.selector = selector
@@ -8,5 +10,7 @@ class Config:
         self.output_file_name = output_file_name
         self.cookie = cookie
         self.on_visit_page = on_visit_page
-
-
+        self.max_concurrency_per_host = max_concurrency_per_host
+        # conditional request cache and resumable frontier, both optional
+        self.cache_file = cache_file
+        self.checkpoint_file = checkpoint_file
@@ -1,82 +1,409 @@
+import argparse
 import asyncio
 import json
 import fnmatch
+import hashlib
+import html
+import logging
+import re
+from collections import Counter, defaultdict
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
 from crawler_config import Config
-import sys
 import os
-import requests
+import aiohttp
 
 from bs4 import BeautifulSoup
 
 KH2RANDO_WEBSITE_URL_START = "https://tommadness.github.io"
 KH2RANDO_WEBSITE_KNOWLEDGE_FILENAME = "kh2fmrando-website.json"
+CRAWL_WORKERS = 16
+REQUEST_TIMEOUT = 30  # in seconds
+CHECKPOINT_INTERVAL = 25  # in pages
+# a text block on at least this many pages and this share of its site's pages is navigation/footer boilerplate
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_PAGE_FRACTION = 0.5
+# elements whose text is rendered as a block of its own, the text of inline elements (links, code, ...) stays
+# in the block around it
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "body", "caption", "dd", "details", "div", "dl", "dt", "fieldset",
+    "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "li", "main", "nav", "ol",
+    "p", "pre", "section", "summary", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "ul",
+}
+# bump when the text extraction changes so cached pages are downloaded and extracted again
+EXTRACTION_VERSION = 3
+CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "cache"))
 
-async def get_page_html(page, selector):
-    await page.wait_for_selector(selector)
-    element = await page.query_selector(selector)
-    return await element.inner_text() if element else ""
 
+def canonicalize_url(url):
+    """
+        Normalizes an absolute URL so each page has a single URL.
 
-async def crawl(config):
-    visited_pages = []
-    results = []
-    queue = [config.url]
+        Args:
+            url: The absolute URL.
 
-    session = requests.Session()
+        Returns:
+            The URL without fragment, default port or trailing slash, or None if it is not a valid http(s) URL.
+    """
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        # malformed links such as https://x.com:abc/ are skipped
+        return None
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https"):
+        return None
+    netloc = parts.netloc.lower()
+    if (scheme, port) in (("http", 80), ("https", 443)):
+        netloc = netloc.rsplit(":", 1)[0]
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
 
-    if config.cookie:
-        session.cookies.set(config.cookie['name'], config.cookie['value'], domain=config.url)
 
-    try:
-        while queue and len(results) < config.max_pages_to_crawl:
+def matches(url, patterns):
+    """
+        Checks a canonical URL against the crawl patterns, which may be full URLs or paths.
+    """
+    path = urlsplit(url).path
+    return any(fnmatch.fnmatch(url, pattern) or fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+
+def load_json(path, default):
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
             try:
-                url = queue.pop(0)
-                if not url.startswith("http"):
-                    url = KH2RANDO_WEBSITE_URL_START + url
-                if url in visited_pages:
+                return json.load(f)
+            except json.decoder.JSONDecodeError:
+                pass
+    return default
+
+
+def save_json(path, data):
+    # write to a temporary file first so an interrupted crawl never leaves a truncated cache or checkpoint
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+
+async def fetch_sitemap_urls(session, start_url):
+    """
+        Collects the page URLs listed in the sitemap of the site (or project site) of a start URL, if there is one.
+    """
+    sitemap_urls = {urljoin(start_url.rstrip("/") + "/", "sitemap.xml"), urljoin(start_url, "/sitemap.xml")}
+    page_urls = []
+    for sitemap_url in sitemap_urls:
+        try:
+            async with session.get(sitemap_url) as response:
+                if response.status != 200:
                     continue
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError):
+            continue
+        page_urls += [html.unescape(loc) for loc in re.findall(r"<loc>\s*(.*?)\s*</loc>", text)]
+    return page_urls
+
+
+def extract_text_blocks(content):
+    """
+        Splits the text of a page into the blocks it is rendered as.
+
+        A block is the text of a block level element (see BLOCK_TAGS) outside the blocks nested in it, with its
+        inline elements joined by spaces, so a link in the middle of a sentence never becomes a block of its own.
+
+        Args:
+            content: The BeautifulSoup element with the content of the page.
+
+        Returns:
+            The non empty blocks of the page in order, with collapsed whitespace.
+    """
+    blocks = []
+    pieces = []
+    current_block = None
+    for string in content.strings:
+        block = next(parent for parent in string.parents if parent is content or parent.name in BLOCK_TAGS)
+        if block is not current_block:
+            blocks.append(" ".join(" ".join(pieces).split()))
+            pieces = []
+            current_block = block
+        pieces.append(string)
+    blocks.append(" ".join(" ".join(pieces).split()))
+    return [block for block in blocks if block]
+
+
+def extract_blocks(content):
+    """
+        Splits the text of a page into blocks (one per line of rendered text) with collapsed whitespace.
+
+        Args:
+            content: The text of the page, one block per line.
+
+        Returns:
+            The non empty blocks of the page in order.
+    """
+    blocks = (" ".join(line.split()) for line in content.splitlines())
+    return [block for block in blocks if block]
+
+
+def clean_results(results):
+    """
+        Removes the blocks repeated across the pages of a site and drops pages whose remaining text was already seen.
+
+        Args:
+            results: The crawled pages as dicts with url and html (the extracted text).
+
+        Returns:
+            The cleaned pages, the number of pages dropped as duplicates and the number of boilerplate blocks removed.
+    """
+    page_counts = Counter()
+    block_counts = defaultdict(Counter)
+    pages = []
+    for result in results:
+        host = urlsplit(result["url"]).netloc
+        blocks = extract_blocks(result["html"])
+        pages.append((result["url"], host, blocks))
+        page_counts[host] += 1
+        block_counts[host].update(set(blocks))
+
+    cleaned_results = []
+    seen_hashes = set()
+    duplicate_count = 0
+    boilerplate_blocks = set()
+    for url, host, blocks in pages:
+        threshold = max(BOILERPLATE_MIN_PAGES, BOILERPLATE_PAGE_FRACTION * page_counts[host])
+        kept_blocks = []
+        for block in blocks:
+            if block_counts[host][block] >= threshold:
+                boilerplate_blocks.add((host, block))
+            else:
+                kept_blocks.append(block)
+        text = "\n".join(kept_blocks)
+        # the same page reached through several URLs (or an empty page) only needs to be uploaded once
+        content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if not text or content_hash in seen_hashes:
+            duplicate_count += 1
+            continue
+        seen_hashes.add(content_hash)
+        cleaned_results.append({'url': url, 'html': text})
+    return cleaned_results, duplicate_count, len(boilerplate_blocks)
+
+
+class ResultStream:
+    """
+        Writes crawl results as a JSON array one page at a time so earlier pages are never rewritten.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+        self.file.write("[")
+
+    def write(self, result):
+        self.file.write(("," if self.count else "") + "\n  " + json.dumps(result))
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]\n")
+
+
+async def crawl(config, results):
+    start_urls = [config.url] if isinstance(config.url, str) else list(config.url)
+    patterns = [config.match] if isinstance(config.match, str) else list(config.match)
+
+    queue = asyncio.Queue()
+    seen_urls = set()
+    pending_urls = set()
+    visited_urls = []
+    host_limits = defaultdict(lambda: asyncio.Semaphore(config.max_concurrency_per_host))
+    # page validators (ETag / Last-Modified), extracted text and links indexed by canonical URL
+    cache = load_json(config.cache_file, {})
+
+    def enqueue(url):
+        # every page is queued at most once (by canonical URL) and never beyond the page budget
+        canonical_url = canonicalize_url(url)
+        if canonical_url and canonical_url not in seen_urls and len(seen_urls) < config.max_pages_to_crawl:
+            seen_urls.add(canonical_url)
+            pending_urls.add(urldefrag(url).url)
+            queue.put_nowait(urldefrag(url).url)
+
+    def save_checkpoint():
+        if config.cache_file:
+            save_json(config.cache_file, cache)
+        if config.checkpoint_file:
+            save_json(config.checkpoint_file, {
+                "seen": sorted(seen_urls), "pending": sorted(pending_urls), "visited": visited_urls
+            })
+
+    def record(canonical_url):
+        entry = cache[canonical_url]
+        results.write({'url': canonical_url, 'html': entry["html"]})
+        visited_urls.append(canonical_url)
+        for linked_url in entry["links"]:
+            enqueue(linked_url)
+        if len(visited_urls) % CHECKPOINT_INTERVAL == 0:
+            save_checkpoint()
+
+    checkpoint = load_json(config.checkpoint_file, None)
+
+    cookies = {config.cookie['name']: config.cookie['value']} if config.cookie else None
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(cookies=cookies, timeout=timeout) as session:
+
+        if checkpoint:
+            # resume the interrupted crawl: replay finished pages from the cache, then continue with the rest
+            print(f"Crawler: Resuming with {len(checkpoint['pending'])} pending pages")
+            seen_urls.update(checkpoint["seen"])
+            for canonical_url in checkpoint["visited"]:
+                if canonical_url in cache:
+                    results.write({'url': canonical_url, 'html': cache[canonical_url]["html"]})
+                    visited_urls.append(canonical_url)
+            for url in checkpoint["pending"]:
+                pending_urls.add(url)
+                queue.put_nowait(url)
+        else:
+            for start_url in start_urls:
+                enqueue(start_url)
+            for start_url in start_urls:
+                for sitemap_url in await fetch_sitemap_urls(session, start_url):
+                    canonical_url = canonicalize_url(sitemap_url)
+                    if canonical_url and matches(canonical_url, patterns):
+                        enqueue(sitemap_url)
+
+        async def visit(url):
+            canonical_url = canonicalize_url(url)
+            cached_page = cache.get(canonical_url)
+            headers = {}
+            if cached_page and cached_page.get("version") != EXTRACTION_VERSION:
+                # extracted by an older version of the crawler so fetch the page in full
+                cached_page = None
+            if cached_page and cached_page.get("etag"):
+                headers["If-None-Match"] = cached_page["etag"]
+            if cached_page and cached_page.get("last_modified"):
+                headers["If-Modified-Since"] = cached_page["last_modified"]
+
+            async with host_limits[urlsplit(url).netloc]:
                 print(f"Crawler: Crawling {url}")
-                response = session.get(url)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                html = soup.select_one(config.selector).get_text() if soup.select_one(config.selector) else ""
-                results.append({'url': url, 'html': html})
-                with open(config.output_file_name, 'w') as f:
-                    json.dump(results, f, indent=2)
-
-                # Extract and enqueue links
-                links = soup.find_all("a")
-                for link in links:
-                    href = link.get("href")
-                    if href and fnmatch.fnmatch(href, config.match):
-                        queue.append(href)
-
-            except:
-                pass
-            visited_pages.append(url)
-    finally:
-        session.close()
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 304:
+                        # unchanged since the last crawl so reuse the extracted text and links
+                        record(canonical_url)
+                        return
+                    response.raise_for_status()
+                    if "html" not in response.headers.get("Content-Type", "html"):
+                        return
+                    page_url = str(response.url)
+                    validators = {
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                    }
+                    text = await response.text()
+            soup = await asyncio.to_thread(BeautifulSoup, text, 'html.parser')
+            content = soup.select_one(config.selector)
+
+            # Extract links, resolving relative links against the URL the page was served from
+            links = []
+            for link in soup.find_all("a", href=True):
+                linked_url = urljoin(page_url, link["href"])
+                linked_canonical_url = canonicalize_url(linked_url)
+                if linked_canonical_url and matches(linked_canonical_url, patterns):
+                    links.append(linked_url)
+
+            # one line per block so repeated navigation and footer blocks can be recognized across pages
+            text = "\n".join(extract_text_blocks(content)) if content else ""
+            cache[canonical_url] = {**validators, "version": EXTRACTION_VERSION, "html": text, "links": links}
+            record(canonical_url)
+
+        async def worker():
+            while True:
+                url = await queue.get()
+                try:
+                    await visit(url)
+                except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeDecodeError) as e:
+                    logging.warning("Crawler: Failed to crawl %s: %s", url, e)
+                except Exception:
+                    # a page that breaks the crawler must not take its worker down, or queue.join() never returns
+                    logging.exception("Crawler: Failed to crawl %s", url)
+                finally:
+                    pending_urls.discard(url)
+                    queue.task_done()
 
-    return results
+        workers = [asyncio.create_task(worker()) for _ in range(CRAWL_WORKERS)]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            save_checkpoint()
+
+    # the crawl finished so the next one starts from scratch (using the cache for conditional requests)
+    if config.checkpoint_file and os.path.exists(config.checkpoint_file):
+        os.remove(config.checkpoint_file)
+    return results.count
 
 
 async def main(config):
 
     output_dir = os.path.dirname(config.output_file_name)
-    os.makedirs(output_dir, exist_ok=True)
-    
-    results = await crawl(config)
-    with open(config.output_file_name, 'w') as f:
-        json.dump(results, f, indent=2)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
 
+    # boilerplate can only be recognized once every page is known, so the raw pages are streamed to a side file
+    # (which the knowledge file sync ignores) and cleaned into the output file at the end
+    raw_file_name = config.output_file_name + ".raw"
+    with open(raw_file_name, 'w', encoding="utf-8") as f:
+        results = ResultStream(f)
+        try:
+            page_count = await crawl(config, results)
+        finally:
+            results.close()
 
-if __name__ == "__main__":
-    config = Config(
-        url=KH2RANDO_WEBSITE_URL_START + "/KH2Randomizer",
-        match=f"/KH2Randomizer/**",
-        selector="#content",
-        max_pages_to_crawl=1000,
-        output_file_name=os.path.abspath(os.path.join(__file__, "..", "..", "..", "dynamic-files", "kh2rando-website", KH2RANDO_WEBSITE_KNOWLEDGE_FILENAME))
+    with open(raw_file_name, 'r', encoding="utf-8") as f:
+        cleaned_results, duplicate_count, boilerplate_count = clean_results(json.load(f))
+    with open(config.output_file_name + ".tmp", 'w', encoding="utf-8") as f:
+        json.dump(cleaned_results, f, indent=2)
+    os.replace(config.output_file_name + ".tmp", config.output_file_name)
+    os.remove(raw_file_name)
+    print(f"Crawler: Crawled {page_count} pages, removed {boilerplate_count} boilerplate blocks and "
+          f"{duplicate_count} duplicate pages, wrote {len(cleaned_results)} pages into {config.output_file_name}")
+
+
+def sites_config(urls_file, output_file_name, max_pages_to_crawl):
+    """
+        Builds a config that crawls every site listed (one URL per line) in a urls file.
+    """
+    with open(urls_file, "r", encoding="utf-8") as f:
+        urls = [line.strip() for line in f if line.strip()]
+    sites = {urlsplit(url).scheme + "://" + urlsplit(url).netloc for url in urls}
+    return Config(
+        url=urls,
+        match=[f"{site}/**" for site in sites] + list(sites),
+        selector="body",
+        max_pages_to_crawl=max_pages_to_crawl,
+        output_file_name=os.path.abspath(output_file_name),
+        cache_file=os.path.join(CACHE_DIR, "sites-cache.json"),
+        checkpoint_file=os.path.join(CACHE_DIR, "sites-checkpoint.json")
     )
-    asyncio.run(main(config))
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawls the KH2 Randomizer website (or the sites in a urls file).")
+    parser.add_argument("--urls-file", help="crawl the sites listed in this file instead of the KH2 Randomizer website")
+    parser.add_argument("--output", default="crawl-output.json", help="output file when crawling a urls file")
+    parser.add_argument("--max-pages", type=int, default=1000, help="maximum number of pages to crawl")
+    args = parser.parse_args()
+
+    if args.urls_file:
+        config = sites_config(args.urls_file, args.output, args.max_pages)
+    else:
+        config = Config(
+            url=KH2RANDO_WEBSITE_URL_START + "/KH2Randomizer",
+            match=f"/KH2Randomizer/**",
+            selector="#content",
+            max_pages_to_crawl=args.max_pages,
+            output_file_name=os.path.abspath(os.path.join(__file__, "..", "..", "..", "dynamic-files", "kh2rando-website", KH2RANDO_WEBSITE_KNOWLEDGE_FILENAME)),
+            cache_file=os.path.join(CACHE_DIR, "kh2rando-website-cache.json"),
+            checkpoint_file=os.path.join(CACHE_DIR, "kh2rando-website-checkpoint.json")
+        )
+    asyncio.run(main(config))
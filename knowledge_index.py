@@ -0,0 +1,314 @@
+"""Local BM25 index over the knowledge files, used to attach the most relevant passages to an inquiry."""
+
+import array
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+from collections import Counter
+
+from config import (
+    KNOWLEDGE_INDEX_FILE, KNOWLEDGE_INDEX_PASSAGE_CHARS, KNOWLEDGE_INDEX_SEGMENTS_FILE, KNOWLEDGE_INDEX_TOP_K
+)
+
+INDEX_MAGIC = b"KIDX"
+INDEX_VERSION = 1
+# magic, version and length of the JSON header that follows
+INDEX_PREAMBLE = struct.Struct("<4sIQ")
+TOKEN_PATTERN = re.compile(r"\w\w+")
+# standard BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    """
+        Splits text into the lowercase terms that are indexed.
+
+        Args:
+            text (str): The text to tokenize.
+
+        Returns:
+            terms (list): The terms of the text in order.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def chunk_blocks(blocks, prefix=""):
+    """
+        Groups consecutive blocks of text into passages of about KNOWLEDGE_INDEX_PASSAGE_CHARS characters.
+
+        Args:
+            blocks (iterable): The blocks (paragraphs, messages, ...) in document order.
+            prefix (str): Context prepended to every passage (e.g. the URL of a page).
+
+        Returns:
+            passages (list): The passage texts.
+    """
+    passages = []
+    current = []
+    current_length = 0
+    for block in blocks:
+        block = block.strip()
+        if not block:
+            continue
+        if current and current_length + len(block) > KNOWLEDGE_INDEX_PASSAGE_CHARS:
+            passages.append(prefix + "\n".join(current))
+            current, current_length = [], 0
+        # a single oversized block is split on its own so no passage grows without bound
+        while len(block) > KNOWLEDGE_INDEX_PASSAGE_CHARS:
+            passages.append(prefix + block[:KNOWLEDGE_INDEX_PASSAGE_CHARS])
+            block = block[KNOWLEDGE_INDEX_PASSAGE_CHARS:]
+        current.append(block)
+        current_length += len(block)
+    if current:
+        passages.append(prefix + "\n".join(current))
+    return passages
+
+
+def extract_passages(path):
+    """
+        Splits a knowledge file into passages.
+
+        Text files are split on blank lines, exported discord channels into runs of messages and crawled websites
+        into runs of lines of each page.
+
+        Args:
+            path (str): The path of the knowledge file.
+
+        Returns:
+            passages (list): The passage texts of the file.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        if not path.endswith(".json"):
+            return chunk_blocks(re.split(r"\n\s*\n", file.read()))
+        try:
+            data = json.load(file)
+        except json.decoder.JSONDecodeError:
+            logging.error("Could not index invalid knowledge file %s", path)
+            return []
+    if isinstance(data, dict) and "messages" in data:
+        return chunk_blocks(
+            f"{message.get('author', {}).get('name', '')}: {message.get('content', '')}"
+            for message in data["messages"] if message.get("content")
+        )
+    if isinstance(data, list):
+        passages = []
+        for page in data:
+            if isinstance(page, dict) and page.get("html"):
+                passages += chunk_blocks(page["html"].splitlines(), prefix=f"{page.get('url', '')}\n")
+        return passages
+    return chunk_blocks([json.dumps(data)])
+
+
+def build_knowledge_index(file_hashes, full=False, index_file=KNOWLEDGE_INDEX_FILE,
+                          segments_file=KNOWLEDGE_INDEX_SEGMENTS_FILE):
+    """
+        Builds the on disk index over the knowledge files.
+
+        The passages and term counts of every file are kept in a segments file keyed by content hash, so only new
+        and changed files are read and tokenized again. The segments are then merged into a single compact file that
+        the bot memory maps.
+
+        Args:
+            file_hashes (dict): The sha256 digest of every knowledge file indexed by path.
+            full (bool): Ignore the segments of the previous build and index every file again.
+            index_file (str): The path of the index the bot loads.
+            segments_file (str): The path of the per file segments.
+
+        Returns:
+            reindexed (int): The number of files that were read and tokenized again.
+    """
+    segments = {}
+    if not full and os.path.exists(segments_file):
+        with open(segments_file, "r", encoding="utf-8") as file:
+            try:
+                segments = json.load(file)
+            except json.decoder.JSONDecodeError:
+                segments = {}
+
+    reindexed = 0
+    updated_segments = {}
+    for path, content_hash in sorted(file_hashes.items()):
+        segment = segments.get(path)
+        if segment is None or segment["sha256"] != content_hash:
+            passages = extract_passages(path)
+            segment = {
+                "sha256": content_hash,
+                "passages": [[text, Counter(tokenize(text))] for text in passages],
+            }
+            reindexed += 1
+        updated_segments[path] = segment
+
+    # merge the segments: passage metadata, postings per term and the passage texts
+    sources = sorted(updated_segments)
+    passage_sources = []
+    passage_lengths = []
+    text_offsets = [0]
+    texts = []
+    postings = {}
+    for source_index, path in enumerate(sources):
+        for text, term_counts in updated_segments[path]["passages"]:
+            passage_id = len(passage_lengths)
+            passage_sources.append(source_index)
+            passage_lengths.append(sum(term_counts.values()))
+            encoded_text = text.encode("utf-8")
+            texts.append(encoded_text)
+            text_offsets.append(text_offsets[-1] + len(encoded_text))
+            for term, count in term_counts.items():
+                postings.setdefault(term, []).extend((passage_id, count))
+
+    terms = {}
+    posting_values = []
+    for term in sorted(postings):
+        terms[term] = [len(posting_values) // 2, len(postings[term]) // 2]
+        posting_values += postings[term]
+
+    sections = [
+        ("lengths", "I", passage_lengths),
+        ("sources", "I", passage_sources),
+        ("text_offsets", "Q", text_offsets),
+        ("postings", "I", posting_values),
+    ]
+    header = {
+        "passage_count": len(passage_lengths),
+        "average_length": sum(passage_lengths) / max(1, len(passage_lengths)),
+        "source_files": sources,
+        "terms": terms,
+        "sections": {},
+    }
+    # sections are laid out after the header at offsets relative to the end of the header
+    offset = 0
+    for name, type_code, values in sections:
+        header["sections"][name] = [offset, type_code, len(values)]
+        offset += struct.calcsize(type_code) * len(values)
+    header["sections"]["text"] = [offset, "B", text_offsets[-1]]
+    encoded_header = json.dumps(header).encode("utf-8")
+    # pad the header so every section stays 8 byte aligned
+    encoded_header += b" " * (-(INDEX_PREAMBLE.size + len(encoded_header)) % 8)
+
+    with open(index_file + ".tmp", "wb") as file:
+        file.write(INDEX_PREAMBLE.pack(INDEX_MAGIC, INDEX_VERSION, len(encoded_header)))
+        file.write(encoded_header)
+        for _, type_code, values in sections:
+            file.write(array.array(type_code, values).tobytes())
+        for encoded_text in texts:
+            file.write(encoded_text)
+    os.replace(index_file + ".tmp", index_file)
+
+    with open(segments_file + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(updated_segments, file)
+    os.replace(segments_file + ".tmp", segments_file)
+    return reindexed
+
+
+class KnowledgeIndex:
+    """
+        Read only view of the index written by build_knowledge_index.
+
+        The postings, passage lengths and passage texts stay in the memory mapped file and only the term dictionary
+        is loaded into memory, so loading is fast and the pages of rarely searched terms are never read.
+    """
+
+    def __init__(self, index_file=KNOWLEDGE_INDEX_FILE):
+        self.index_file = index_file
+        self.mapped_file = None
+        self.view = None
+        self.passage_count = 0
+        self.average_length = 0.0
+        self.source_files = []
+        self.terms = {}
+        self.sections = {}
+
+    def close(self):
+        """
+            Releases the memory mapped index.
+        """
+        # every view into the mapped file has to be released before it can be closed
+        for section in self.sections.values():
+            section.release()
+        self.sections = {}
+        self.terms = {}
+        self.passage_count = 0
+        if self.mapped_file is not None:
+            self.view.release()
+            self.mapped_file.close()
+            self.mapped_file = None
+            self.view = None
+
+    def load(self):
+        """
+            Memory maps the index file, replacing the index loaded before. A missing or invalid index leaves the
+            index empty so searches return nothing.
+        """
+        self.close()
+        if not os.path.exists(self.index_file) or os.path.getsize(self.index_file) == 0:
+            return
+        with open(self.index_file, "rb") as file:
+            mapped_file = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_length = INDEX_PREAMBLE.unpack_from(mapped_file)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            logging.error("Invalid knowledge index %s", self.index_file)
+            mapped_file.close()
+            return
+        header_end = INDEX_PREAMBLE.size + header_length
+        header = json.loads(mapped_file[INDEX_PREAMBLE.size:header_end])
+        self.view = memoryview(mapped_file)
+        for name, (offset, type_code, count) in header["sections"].items():
+            start = header_end + offset
+            self.sections[name] = self.view[start:start + struct.calcsize(type_code) * count].cast(type_code)
+        self.mapped_file = mapped_file
+        self.passage_count = header["passage_count"]
+        self.average_length = header["average_length"]
+        self.source_files = header["source_files"]
+        self.terms = header["terms"]
+
+    def passage(self, passage_id):
+        """
+            Reads a passage out of the index.
+
+            Args:
+                passage_id (int): The position of the passage in the index.
+
+            Returns:
+                source_file (str): The knowledge file the passage belongs to.
+                text (str): The text of the passage.
+        """
+        text_offsets = self.sections["text_offsets"]
+        text = self.sections["text"][text_offsets[passage_id]:text_offsets[passage_id + 1]].tobytes().decode("utf-8")
+        return self.source_files[self.sections["sources"][passage_id]], text
+
+    def search(self, query, top_k=KNOWLEDGE_INDEX_TOP_K):
+        """
+            Ranks the passages against a query with BM25.
+
+            Args:
+                query (str): The inquiry.
+                top_k (int): The maximum number of passages to return.
+
+            Returns:
+                passages (list): Tuples of the source file, text and score of the best passages, best first.
+        """
+        if not self.passage_count:
+            return []
+        lengths = self.sections["lengths"]
+        postings = self.sections["postings"]
+        scores = Counter()
+        for term in set(tokenize(query)):
+            if term not in self.terms:
+                continue
+            start, document_frequency = self.terms[term]
+            idf = math.log(1 + (self.passage_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            term_postings = postings[2 * start:2 * (start + document_frequency)]
+            for passage_id, count in zip(term_postings[::2], term_postings[1::2]):
+                length_norm = 1 - BM25_B + BM25_B * lengths[passage_id] / self.average_length
+                scores[passage_id] += idf * count * (BM25_K1 + 1) / (count + BM25_K1 * length_norm)
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(*self.passage(passage_id), score) for passage_id, score in best]
+
+
+KNOWLEDGE_INDEX = KnowledgeIndex()
@@ -0,0 +1,507 @@
+"""
+Replays logged inquiries through bot.on_message to find how much load one bot process can handle.
+
+Every logged thread becomes a session: its first question arrives as a new /randohelp inquiry in the bot channel
+and its follow-up questions are asked in the created thread, each after the previous answer and a short pause.
+Sessions arrive at random (Poisson) times at the given rate. Discord, OpenAI (threads, runs, chat completions and
+files) and the translator are replaced by local stand-ins whose calls take an exponentially distributed time with
+the given mean and fail with the given probability, so no network access or token is needed. The knowledge update
+(crawlers and vector stores) is never triggered.
+
+The report contains the throughput, the p50/p95/p99 latency of on_message and the event loop lag. Discord drops the
+gateway connection when heartbeats are blocked for too long, so the lag is what limits the number of users.
+
+    python load_test.py --rate 2 --sessions 200 --openai-latency 0.8 --openai-error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import datetime as dt
+import importlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import discord
+
+# messages.py reads the date of the last knowledge file update when it is imported. a knowledge update would run
+# the crawlers, so the knowledge files are always up to date during a replay
+os.environ["LAST_KNOWLEDGE_FILE_UPDATE"] = dt.datetime.today().strftime("%m-%d-%Y")
+
+from config import (
+    CHANNEL_NAME, CHARS_PER_TOKEN, CONVERSATION_DATABASE, CONVERSATION_FILE, HELP_COMMAND, KNOWLEDGE_INDEX_FILE, MODEL
+)
+from conversation_store import message_text
+from messages import BOT_ERROR_MESSAGE, COMMAND_QUEUE_FULL_MESSAGE
+from metrics import METRICS
+
+# a streamed text delta is about this many characters
+STREAM_CHUNK_CHARS = 20
+CITED_FILE_COUNT = 20
+
+
+class InjectedError(Exception):
+    """
+        A failure injected into a stand-in service.
+    """
+
+
+class Service:
+    """
+        Stand-in for a remote service: every call takes an exponentially distributed time and may fail.
+    """
+
+    def __init__(self, name, latency, error_rate):
+        self.name = name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self.error_replies = 0
+        self.rejections = 0
+
+    def _outcome(self):
+        self.calls += 1
+        delay = random.expovariate(1 / self.latency) if self.latency > 0 else 0
+        failed = random.random() < self.error_rate
+        self.errors += failed
+        return delay, failed
+
+    async def call(self):
+        """
+            Waits like a request to the service would, raising InjectedError if the request fails.
+        """
+        delay, failed = self._outcome()
+        await asyncio.sleep(delay)
+        if failed:
+            raise InjectedError(f"{self.name} request failed")
+
+    def blocking_call(self):
+        """
+            Blocks like a synchronous request to the service would, raising InjectedError if the request fails.
+        """
+        delay, failed = self._outcome()
+        time.sleep(delay)
+        if failed:
+            raise InjectedError(f"{self.name} request failed")
+
+
+class FakeSentMessage:
+    def __init__(self, discord_service, content):
+        self.discord = discord_service
+        self.content = content
+
+    async def edit(self, content):
+        await self.discord.call()
+        self.content = content
+
+    async def delete(self):
+        await self.discord.call()
+
+
+class FakeMessageable:
+    async def send(self, content):
+        await self.discord.call()
+        if content == BOT_ERROR_MESSAGE:
+            self.discord.error_replies += 1
+        return FakeSentMessage(self.discord, content)
+
+
+class FakeChannel(FakeMessageable):
+    def __init__(self, discord_service):
+        self.discord = discord_service
+        self.id = 0
+        self.name = CHANNEL_NAME
+        self.threads = []
+
+
+class FakeThread(FakeMessageable, discord.Thread):
+    # discord.Thread looks its parent up in the guild, which the stand-in does not have
+    parent = None
+
+    def __init__(self, discord_service, thread_id, name, parent):
+        self.discord = discord_service
+        self.id = thread_id
+        self.name = name
+        self.parent = parent
+
+    async def edit(self, name):
+        await self.discord.call()
+        self.name = name
+
+
+class FakeMessage:
+    def __init__(self, discord_service, message_id, content, channel, author):
+        self.discord = discord_service
+        self.id = message_id
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.attachments = []
+        self.thread = None
+
+    async def create_thread(self, name):
+        await self.discord.call()
+        # like in discord, the thread of a message has the id of the message
+        self.thread = FakeThread(self.discord, self.id, name, self.channel)
+        self.channel.threads.append(self.thread)
+        return self.thread
+
+    async def reply(self, content):
+        if content == COMMAND_QUEUE_FULL_MESSAGE:
+            self.discord.rejections += 1
+        return await self.channel.send(content)
+
+
+class FakeRunStream:
+    """
+        Streams a logged answer at a fixed number of tokens per second after the time to the first token.
+    """
+
+    def __init__(self, openai_service, answer, prompt_tokens, tokens_per_second):
+        self.openai = openai_service
+        file_id = f"file-{random.randrange(CITED_FILE_COUNT)}"
+        citation = SimpleNamespace(text="【4:0†source】", file_citation=SimpleNamespace(file_id=file_id))
+        self.answer = f"{answer}{citation.text}"
+        self.annotations = [citation]
+        self.prompt_tokens = prompt_tokens
+        self.tokens_per_second = tokens_per_second
+
+    async def __aenter__(self):
+        await self.openai.call()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    def text_deltas(self):
+        return self._text_deltas()
+
+    async def _text_deltas(self):
+        for start in range(0, len(self.answer), STREAM_CHUNK_CHARS):
+            await asyncio.sleep(STREAM_CHUNK_CHARS / CHARS_PER_TOKEN / self.tokens_per_second)
+            yield self.answer[start:start + STREAM_CHUNK_CHARS]
+
+    async def get_final_run(self):
+        completion_tokens = len(self.answer) // CHARS_PER_TOKEN
+        return SimpleNamespace(
+            status="completed",
+            model=MODEL,
+            usage=SimpleNamespace(
+                prompt_tokens=self.prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=self.prompt_tokens + completion_tokens,
+            ),
+            incomplete_details=None,
+            last_error=None,
+        )
+
+    async def get_final_messages(self):
+        text = SimpleNamespace(value=self.answer, annotations=self.annotations)
+        return [SimpleNamespace(content=[SimpleNamespace(text=text)])]
+
+
+class FakeOpenAI:
+    """
+        Stand-in for the parts of openai.AsyncOpenAI the help command uses. Runs answer with the logged answer to
+        the question, or with a random logged answer for a question that was never answered.
+    """
+
+    def __init__(self, openai_service, answers, tokens_per_second):
+        self.openai = openai_service
+        self.answers = answers
+        self.fallback_answers = list(answers.values()) or ["An answer."]
+        self.tokens_per_second = tokens_per_second
+        self.thread_ids = itertools.count(1)
+        self.threads = {}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_completion))
+        self.beta = SimpleNamespace(threads=SimpleNamespace(
+            create=self.create_thread,
+            messages=SimpleNamespace(create=self.create_message),
+            runs=SimpleNamespace(stream=self.stream_run),
+        ))
+        self.files = SimpleNamespace(retrieve=self.retrieve_file)
+
+    async def create_completion(self, **_):
+        await self.openai.call()
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Replayed inquiry"))],
+            usage=SimpleNamespace(prompt_tokens=60, completion_tokens=5, total_tokens=65),
+        )
+
+    async def create_thread(self, messages):
+        await self.openai.call()
+        thread_id = f"thread-{next(self.thread_ids)}"
+        self.threads[thread_id] = {"prompt_chars": sum(len(str(message["content"])) for message in messages), "question": ""}
+        return SimpleNamespace(id=thread_id)
+
+    async def create_message(self, thread_id, role, content):
+        await self.openai.call()
+        question = " ".join(part["text"] for part in content if part.get("type") == "text")
+        self.threads[thread_id]["prompt_chars"] += len(question)
+        self.threads[thread_id]["question"] = question
+        return SimpleNamespace(thread_id=thread_id, role=role)
+
+    def stream_run(self, thread_id, **_):
+        thread = self.threads[thread_id]
+        answer = self.answers.get(thread["question"]) or random.choice(self.fallback_answers)
+        return FakeRunStream(self.openai, answer, thread["prompt_chars"] // CHARS_PER_TOKEN, self.tokens_per_second)
+
+    async def retrieve_file(self, file_id):
+        await self.openai.call()
+        return SimpleNamespace(id=file_id, filename=f"{file_id}.json")
+
+
+def fake_translator(translator_service):
+    """
+        Builds a stand-in for deep_translator.GoogleTranslator that returns the text it is given.
+    """
+    class FakeTranslator:
+        def __init__(self, source, target):
+            self.source = source
+            self.target = target
+
+        def translate(self, text):
+            translator_service.blocking_call()
+            return text
+
+        def translate_batch(self, batch):
+            translator_service.blocking_call()
+            return list(batch)
+
+    return FakeTranslator
+
+
+def load_sessions(log_file):
+    """
+        Reads the logged threads as lists of questions and the answers they got.
+
+        Args:
+            log_file (str): The conversation database, or a conversation log file from before the database.
+
+        Returns:
+            sessions (list): The (question, answer) pairs of every thread, in order.
+    """
+    message_logs = {}
+    if log_file.endswith(".db"):
+        connection = sqlite3.connect(f"file:{log_file}?mode=ro", uri=True)
+        for thread_id, role, content in connection.execute(
+            "SELECT thread_id, role, content FROM messages ORDER BY thread_id, position"
+        ):
+            message_logs.setdefault(thread_id, []).append({"role": role, "content": content})
+        connection.close()
+    else:
+        with open(log_file, "r", encoding="utf-8") as file:
+            message_logs = {thread_id: thread_log["message_log"] for thread_id, thread_log in json.load(file).items()}
+
+    sessions = []
+    for message_log in message_logs.values():
+        session = []
+        for message in message_log:
+            content = message_text(message["content"])
+            if message["role"] == "user" and content.strip():
+                session.append([content, None])
+            elif message["role"] == "assistant" and session and session[-1][1] is None:
+                session[-1][1] = content
+        if session:
+            sessions.append(session)
+    return sessions
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values, default=None),
+    }
+
+
+async def monitor_event_loop(lag_samples, interval, stop):
+    """
+        Measures how late the event loop wakes up a task that sleeps for *interval* seconds.
+    """
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag_samples.append(time.perf_counter() - start - interval)
+
+
+async def replay_session(bot, discord_service, channel, session, session_number, message_ids, think_time, results):
+    author = SimpleNamespace(bot=False, name=f"replay-user-{session_number}", display_name=f"Replay User {session_number}", roles=[])
+    thread = None
+    for index, (question, _) in enumerate(session):
+        if index:
+            await asyncio.sleep(random.expovariate(1 / think_time) if think_time > 0 else 0)
+        message = FakeMessage(discord_service, next(message_ids), f"{HELP_COMMAND} {question}", thread or channel, author)
+        kind = "follow_up" if thread else "inquiry"
+        start = time.perf_counter()
+        try:
+            await bot.on_message(message)
+        except Exception:
+            # discord.py would only log an exception escaping on_message
+            results["failed"] += 1
+        results[kind].append(time.perf_counter() - start)
+        if thread is None:
+            thread = message.thread
+            # without a thread (e.g. rate limited) there is nowhere to ask the follow-up questions
+            if thread is None:
+                return
+
+
+async def run_replay(bot, sessions, args, discord_service):
+    results = {"inquiry": [], "follow_up": [], "failed": 0}
+    lag_samples = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_event_loop(lag_samples, args.lag_interval, stop))
+    channel = FakeChannel(discord_service)
+    message_ids = itertools.count(1)
+
+    tasks = []
+    start = time.perf_counter()
+    arrival = 0.0
+    for session_number, session in enumerate(sessions):
+        # sleep until the planned arrival time so a lagging loop does not lower the offered load
+        await asyncio.sleep(max(0.0, arrival - (time.perf_counter() - start)))
+        tasks.append(asyncio.create_task(replay_session(
+            bot, discord_service, channel, session, session_number, message_ids, args.think_time, results
+        )))
+        arrival += random.expovariate(args.rate)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+    return results, lag_samples, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logs", help="conversation database or log file to replay (default: the bot's own logs)")
+    parser.add_argument("--sessions", type=int, default=100, help="number of logged threads to replay")
+    parser.add_argument("--rate", type=float, default=1.0, help="new inquiries per second")
+    parser.add_argument("--think-time", type=float, default=5.0, help="mean seconds between an answer and the next follow-up")
+    parser.add_argument("--no-follow-ups", action="store_true", help="only replay the first question of every thread")
+    parser.add_argument("--discord-latency", type=float, default=0.1, help="mean seconds of a discord request")
+    parser.add_argument("--discord-error-rate", type=float, default=0.0, help="fraction of failing discord requests")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="mean seconds of an OpenAI request")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="fraction of failing OpenAI requests")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="speed of the streamed answers")
+    parser.add_argument("--translator-latency", type=float, default=0.3, help="mean seconds of a translation")
+    parser.add_argument("--translator-error-rate", type=float, default=0.0, help="fraction of failing translations")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="seconds between event loop lag samples")
+    parser.add_argument("--lag-threshold", type=float, default=1.0, help="event loop lag reported as a stall")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to write the report to")
+    parser.add_argument("--metrics-file", help="file to write the per stage metrics of the bot to")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    log_file = args.logs or next(
+        (path for path in (CONVERSATION_DATABASE, CONVERSATION_FILE, CONVERSATION_FILE + ".migrated") if os.path.exists(path)),
+        None
+    )
+    if log_file is None:
+        sys.exit("No conversation logs found, pass one with --logs.")
+    all_sessions = load_sessions(os.path.abspath(log_file))
+    if not all_sessions:
+        sys.exit(f"No questions found in {log_file}.")
+    sessions = [random.choice(all_sessions) for _ in range(args.sessions)]
+    if args.no_follow_ups:
+        sessions = [session[:1] for session in sessions]
+    answers = {question: answer for session in all_sessions for question, answer in session if answer}
+
+    discord_service = Service("discord", args.discord_latency, args.discord_error_rate)
+    openai_service = Service("openai", args.openai_latency, args.openai_error_rate)
+    translator_service = Service("translator", args.translator_latency, args.translator_error_rate)
+    knowledge_index_file = os.path.abspath(KNOWLEDGE_INDEX_FILE)
+    output_file = os.path.abspath(args.output) if args.output else None
+    metrics_file = os.path.abspath(args.metrics_file) if args.metrics_file else None
+    if metrics_file:
+        METRICS.enable()
+    working_dir = os.getcwd()
+
+    # the bot keeps its logs, translations and conversation database in the working directory
+    with tempfile.TemporaryDirectory() as replay_dir:
+        os.chdir(replay_dir)
+        try:
+            os.environ.setdefault("OPENAI_API_KEY", "load-test")
+            bot = importlib.import_module("bot")
+            # the bot reloads the .env file when it is imported
+            os.environ["LAST_KNOWLEDGE_FILE_UPDATE"] = dt.datetime.today().strftime("%m-%d-%Y")
+            bot.openai_client = FakeOpenAI(openai_service, answers, args.tokens_per_second)
+            importlib.import_module("translation_cache").GoogleTranslator = fake_translator(translator_service)
+            if os.path.exists(knowledge_index_file):
+                bot.KNOWLEDGE_INDEX.index_file = knowledge_index_file
+                bot.KNOWLEDGE_INDEX.load()
+
+            results, lag_samples, elapsed = asyncio.run(run_replay(bot, sessions, args, discord_service))
+            bot.conversation_store.close()
+            bot.KNOWLEDGE_INDEX.close()
+        finally:
+            os.chdir(working_dir)
+
+    message_count = len(results["inquiry"]) + len(results["follow_up"])
+    report = {
+        "log_file": log_file,
+        "arguments": vars(args),
+        "messages": message_count,
+        "failed": results["failed"],
+        "error_replies": discord_service.error_replies,
+        "rejected": discord_service.rejections,
+        "elapsed_seconds": elapsed,
+        "throughput_per_second": message_count / elapsed,
+        "latency_seconds": {
+            "all": latency_summary(results["inquiry"] + results["follow_up"]),
+            "inquiry": latency_summary(results["inquiry"]),
+            "follow_up": latency_summary(results["follow_up"]),
+        },
+        "event_loop_lag_seconds": {
+            **latency_summary(lag_samples),
+            "stalls": sum(lag > args.lag_threshold for lag in lag_samples),
+        },
+        "services": {
+            service.name: {"calls": service.calls, "errors": service.errors}
+            for service in (discord_service, openai_service, translator_service)
+        },
+    }
+
+    print(f"Replayed {message_count} messages of {len(sessions)} threads from {log_file} in {elapsed:.1f}s "
+          f"({report['throughput_per_second']:.2f} messages/s)")
+    print(f"Failed: {report['failed']}, error replies: {report['error_replies']}, rejected: {report['rejected']}")
+    for kind, summary in report["latency_seconds"].items():
+        if summary["count"]:
+            print(f"Latency {kind:<10} p50 {summary['p50']:.3f}s  p95 {summary['p95']:.3f}s  "
+                  f"p99 {summary['p99']:.3f}s  max {summary['max']:.3f}s")
+    lag = report["event_loop_lag_seconds"]
+    if lag["count"]:
+        print(f"Event loop lag     p50 {lag['p50'] * 1000:.1f}ms  p99 {lag['p99'] * 1000:.1f}ms  "
+              f"max {lag['max'] * 1000:.1f}ms  stalls over {args.lag_threshold}s: {lag['stalls']}")
+    for name, service in report["services"].items():
+        print(f"{name}: {service['calls']} calls, {service['errors']} injected errors")
+
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+        print(f"Report written to {output_file}")
+    if metrics_file:
+        METRICS.write_snapshot(metrics_file)
+        print(f"Metrics written to {metrics_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Timing spans and counters of the bot, exported in the Prometheus text format."""
+
+# pylint: disable=broad-exception-caught
+
+import asyncio
+import contextlib
+import functools
+import inspect
+import logging
+import os
+import time
+
+from aiohttp import web
+
+from config import METRICS_BUCKETS, METRICS_FILE, METRICS_PORT, METRICS_SNAPSHOT_INTERVAL
+
+METRIC_PREFIX = "ailios_"
+METRIC_DESCRIPTIONS = {
+    "cache_requests_total": ("counter", "Cache lookups by cache and result."),
+    "commands_rejected_total": ("counter", "Commands rejected because their queue was full by command."),
+    "commands_total": ("counter", "Commands handled by command."),
+    "openai_cost_dollars_total": ("counter", "Dollars spent on OpenAI runs by kind (see get_openai_run_cost)."),
+    "openai_tokens_total": ("counter", "Tokens used by OpenAI runs by kind."),
+    "retries_total": ("counter", "Requests retried after a rate limit or server error by service."),
+    "stage_errors_total": ("counter", "Stages that ended with an exception by stage."),
+    "stage_seconds": ("histogram", "Duration of the stages of a command by stage."),
+}
+# returned by span while the metrics are disabled so timing costs nothing
+NULL_SPAN = contextlib.nullcontext()
+
+
+def format_labels(labels, **extra_labels):
+    labels = labels + tuple(extra_labels.items())
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Span:
+    """
+        Times a stage from entering to leaving the with block, counting the stage as failed if it raises.
+    """
+
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe("stage_seconds", time.perf_counter() - self.start, stage=self.stage)
+        if exc_type is not None:
+            self.metrics.increment("stage_errors_total", stage=self.stage)
+        return False
+
+
+class Metrics:
+    """
+        Latency histograms and counters kept in memory.
+
+        Nothing is recorded until enable is called, and until then span returns a shared no-op context manager and
+        increment and observe return immediately, so the instrumentation can stay in place when metrics are off.
+        Once enabled, start_export serves the metrics at http://127.0.0.1:METRICS_PORT/metrics and writes them to
+        METRICS_FILE every METRICS_SNAPSHOT_INTERVAL seconds.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.enabled = False
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.runner = None
+        self.snapshot_task = None
+
+    async def _handle_metrics(self, _request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def _write_snapshots(self, snapshot_file, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.write_snapshot(snapshot_file)
+            except Exception:
+                logging.exception("ERROR OCCURRED")
+
+    def enable(self):
+        """
+            Starts recording spans and counters.
+        """
+        self.enabled = True
+
+    def increment(self, name, value=1, **labels):
+        """
+            Adds to a counter.
+
+            Args:
+                name (str): The name of the counter (see METRIC_DESCRIPTIONS).
+                value (float): The amount to add.
+                labels: The labels of the counter (e.g. result="hit").
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+            Records a value in a histogram.
+
+            Args:
+                name (str): The name of the histogram (see METRIC_DESCRIPTIONS).
+                value (float): The value to record (e.g. a duration in seconds).
+                labels: The labels of the histogram (e.g. stage="translate").
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # the count of each bucket followed by the sum and the count of every value
+            histogram = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[index] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def render(self):
+        """
+            Formats every metric in the Prometheus text exposition format.
+
+            Returns:
+                text (str): The metrics, one sample per line.
+        """
+        lines = []
+        for name, (metric_type, description) in METRIC_DESCRIPTIONS.items():
+            metric_name = METRIC_PREFIX + name
+            samples = []
+            if metric_type == "counter":
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        samples.append(f"{metric_name}{format_labels(labels)} {value}")
+            else:
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    # prometheus buckets are cumulative
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, histogram):
+                        cumulative += count
+                        samples.append(f"{metric_name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+                    samples.append(f"{metric_name}_bucket{format_labels(labels, le='+Inf')} {histogram[-1]}")
+                    samples.append(f"{metric_name}_sum{format_labels(labels)} {histogram[-2]}")
+                    samples.append(f"{metric_name}_count{format_labels(labels)} {histogram[-1]}")
+            if samples:
+                lines += [f"# HELP {metric_name} {description}", f"# TYPE {metric_name} {metric_type}"] + samples
+        return "\n".join(lines) + "\n"
+
+    def span(self, stage):
+        """
+            Times a stage of a command.
+
+            Args:
+                stage (str): The name of the stage.
+
+            Returns:
+                span (Span): A context manager timing its with block.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, stage)
+
+    async def start_export(self, port=METRICS_PORT, snapshot_file=METRICS_FILE, interval=METRICS_SNAPSHOT_INTERVAL):
+        """
+            Serves the metrics over HTTP and schedules the snapshots, unless metrics are disabled or exported already.
+
+            Args:
+                port (int | None): The local port to serve the metrics on, None to not serve them.
+                snapshot_file (str | None): The file to write the metrics to, None to not write them.
+                interval (float): The seconds between two snapshots.
+        """
+        if not self.enabled:
+            return
+        if port is not None and self.runner is None:
+            self.runner = web.AppRunner(web.Application())
+            self.runner.app.router.add_get("/metrics", self._handle_metrics)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, "127.0.0.1", port).start()
+        if snapshot_file is not None and (self.snapshot_task is None or self.snapshot_task.done()):
+            self.snapshot_task = asyncio.create_task(self._write_snapshots(snapshot_file, interval))
+
+    def timed(self, stage):
+        """
+            Decorates a function or coroutine function so every call is timed as a stage.
+
+            Args:
+                stage (str): The name of the stage.
+
+            Returns:
+                decorator (function): The decorator.
+        """
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def timed_coroutine(*args, **kwargs):
+                    if not self.enabled:
+                        return await function(*args, **kwargs)
+                    with Span(self, stage):
+                        return await function(*args, **kwargs)
+                return timed_coroutine
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Span(self, stage):
+                    return function(*args, **kwargs)
+            return timed_function
+        return decorator
+
+    def write_snapshot(self, snapshot_file=METRICS_FILE):
+        """
+            Writes the metrics to a file.
+
+            Args:
+                snapshot_file (str): The file to write the metrics to.
+        """
+        with open(snapshot_file + ".tmp", "w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(snapshot_file + ".tmp", snapshot_file)
+
+
+METRICS = Metrics()
@@ -0,0 +1,307 @@
+"""Admits OpenAI requests only when the rate limits and the daily budget leave room for them."""
+
+import asyncio
+import datetime as dt
+import json
+import math
+import os
+import time
+from collections import deque
+
+from config import (
+    CHARS_PER_TOKEN, IMAGE_COST_IN_DOLLARS, OPENAI_DAILY_BUDGET_IN_DOLLARS, OPENAI_PRICING, OPENAI_RATE_LIMITS,
+    OPENAI_RUN_OVERHEAD_TOKENS, OPENAI_SPEND_FILE
+)
+
+# the OpenAI rate limits are per minute
+RATE_LIMIT_WINDOW = 60.0
+# tokens added for the role and separators of every message
+TOKENS_PER_MESSAGE = 4
+
+
+class DailyBudgetExceeded(Exception):
+    """
+        Raised when a request would take the OpenAI spend of the day over OPENAI_DAILY_BUDGET_IN_DOLLARS.
+    """
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, num_images=0):
+    """
+        Estimates the cost of a request the same way get_openai_run_cost computes the cost of a run.
+
+        Args:
+            model (str): The model of the request.
+            prompt_tokens (int): The estimated prompt tokens.
+            completion_tokens (int): The most tokens the completion may use.
+            num_images (int): The number of images in the request.
+
+        Returns:
+            dollars (float): The estimated cost in USD.
+    """
+    pricing = OPENAI_PRICING[model]
+    return pricing["input"] * prompt_tokens / 1000 + pricing["output"] * completion_tokens / 1000 + IMAGE_COST_IN_DOLLARS * num_images
+
+
+def estimate_message_tokens(messages):
+    """
+        Estimates the prompt tokens of chat messages without a tokenizer, at CHARS_PER_TOKEN characters per token.
+
+        Args:
+            messages (list): The messages with their role and content.
+
+        Returns:
+            prompt_tokens (int): The estimated prompt tokens.
+    """
+    characters = sum(len(str(message["content"])) for message in messages)
+    return math.ceil(characters / CHARS_PER_TOKEN) + TOKENS_PER_MESSAGE * len(messages)
+
+
+def estimate_prompt_tokens(model, message_log, text, num_images=0, additional_instructions=None):
+    """
+        Estimates the prompt tokens of an assistant run without a tokenizer.
+
+        Every image counts as the tokens that cost as much as IMAGE_COST_IN_DOLLARS. The assistant instructions and
+        file search results are covered by OPENAI_RUN_OVERHEAD_TOKENS.
+
+        Args:
+            model (str): The model of the run.
+            message_log (list): The earlier messages of the thread.
+            text (str): The inquiry.
+            num_images (int): The number of images attached to the inquiry.
+            additional_instructions (str | None): The additional instructions of the run.
+
+        Returns:
+            prompt_tokens (int): The estimated prompt tokens.
+    """
+    image_tokens = IMAGE_COST_IN_DOLLARS / OPENAI_PRICING[model]["input"] * 1000
+    return (
+        estimate_message_tokens(message_log + [{"role": "user", "content": text}])
+        + math.ceil(len(additional_instructions or "") / CHARS_PER_TOKEN + image_tokens * num_images)
+        + OPENAI_RUN_OVERHEAD_TOKENS
+    )
+
+
+class Reservation:
+    """
+        The tokens, request and dollars an admitted request holds in the budgets until it is settled.
+    """
+
+    def __init__(self, model, tokens, dollars, window_entry):
+        self.model = model
+        self.tokens = tokens
+        self.dollars = dollars
+        self.window_entry = window_entry
+        self.settled = False
+
+
+class OpenAIScheduler:
+    """
+        Rolling per minute token and request budgets of every model in OPENAI_RATE_LIMITS and a daily dollar budget.
+
+        Requests are admitted in arrival order once the tokens and requests of the last minute leave room for them,
+        so a request is never sent just to fail with rate_limit_exceeded. A request waiting in line learns its
+        position and an estimate of its wait. Requests that would exceed the daily budget are refused right away.
+        The spend of the day is saved to OPENAI_SPEND_FILE so a restart does not reset it.
+    """
+
+    def __init__(self, rate_limits=OPENAI_RATE_LIMITS, daily_budget=OPENAI_DAILY_BUDGET_IN_DOLLARS, spend_file=OPENAI_SPEND_FILE):
+        self.rate_limits = rate_limits
+        self.daily_budget = daily_budget
+        self.spend_file = spend_file
+        self.windows = {}
+        self.queues = {}
+        self.paused_until = {}
+        self.wakeups = {}
+        self.spend_date = dt.date.today().isoformat()
+        self.spent = 0.0
+        if os.path.exists(spend_file):
+            with open(spend_file, "r", encoding="utf-8") as file:
+                try:
+                    spend = json.load(file)
+                except json.decoder.JSONDecodeError:
+                    spend = {}
+            if spend.get("date") == self.spend_date:
+                self.spent = spend["dollars"]
+
+    def _dispatch(self, model):
+        """
+            Admits the requests at the front of the line of a model for as long as the budgets leave room.
+        """
+        wakeup = self.wakeups.pop(model, None)
+        if wakeup is not None:
+            wakeup.cancel()
+        queue = self.queues.get(model)
+        while queue:
+            waiter = queue[0]
+            if waiter["future"].done():
+                queue.popleft()
+            elif self._has_room(model, waiter["tokens"]):
+                queue.popleft()
+                waiter["future"].set_result(self._reserve(model, waiter["tokens"], waiter["dollars"]))
+            else:
+                # nothing frees up before the oldest request of the window expires
+                wait = max(self.estimate_wait(model, 0), 0.01)
+                self.wakeups[model] = asyncio.get_running_loop().call_later(wait, self._dispatch, model)
+                return
+
+    def _has_room(self, model, tokens):
+        limits = self.rate_limits.get(model)
+        if limits is None:
+            return True
+        if time.monotonic() < self.paused_until.get(model, 0):
+            return False
+        window = self._window(model)
+        if len(window) + 1 > limits["requests_per_minute"]:
+            return False
+        # a request larger than the whole budget is only sent on its own
+        used_tokens = sum(entry[1] for entry in window)
+        return used_tokens + tokens <= limits["tokens_per_minute"] or not window
+
+    def _reserve(self, model, tokens, dollars):
+        window_entry = [time.monotonic(), tokens]
+        self.windows.setdefault(model, deque()).append(window_entry)
+        return Reservation(model, tokens, dollars, window_entry)
+
+    def _roll_over(self):
+        today = dt.date.today().isoformat()
+        if today != self.spend_date:
+            self.spend_date = today
+            self.spent = 0.0
+
+    def _save(self):
+        with open(self.spend_file + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({"date": self.spend_date, "dollars": self.spent}, file)
+        os.replace(self.spend_file + ".tmp", self.spend_file)
+
+    def _window(self, model):
+        window = self.windows.setdefault(model, deque())
+        expired_before = time.monotonic() - RATE_LIMIT_WINDOW
+        while window and window[0][0] <= expired_before:
+            window.popleft()
+        return window
+
+    async def admit(self, model, tokens, dollars=0.0, on_queued=None):
+        """
+            Waits until a request fits in the budgets of its model and reserves its tokens, request and dollars.
+
+            Args:
+                model (str): The model of the request.
+                tokens (int): The estimated prompt tokens plus the most tokens the completion may use.
+                dollars (float): The estimated cost of the request.
+                on_queued (coroutine function | None): Called with the position in line (starting at 1) and the
+                    estimated wait in seconds if the request has to wait.
+
+            Returns:
+                reservation (Reservation): The reservation to settle once the request is done.
+
+            Raises:
+                DailyBudgetExceeded: If the request would take the spend of the day over the daily budget.
+        """
+        self._roll_over()
+        if self.spent + dollars > self.daily_budget:
+            raise DailyBudgetExceeded(f"${self.spent:.2f} of the ${self.daily_budget:.2f} daily budget is spent.")
+        # the dollars are held from the start so concurrent requests cannot overshoot the budget together
+        self.spent += dollars
+
+        queue = self.queues.setdefault(model, deque())
+        if not queue and self._has_room(model, tokens):
+            return self._reserve(model, tokens, dollars)
+
+        waiter = {"future": asyncio.get_running_loop().create_future(), "tokens": tokens, "dollars": dollars}
+        queue.append(waiter)
+        self._dispatch(model)
+        try:
+            if on_queued is not None and not waiter["future"].done():
+                position = queue.index(waiter)
+                await on_queued(position + 1, math.ceil(self.estimate_wait(model, position)))
+            return await waiter["future"]
+        except BaseException:
+            # a request that gave up (e.g. its inquiry failed) must not keep its place or its reservation
+            if waiter["future"].done() and not waiter["future"].cancelled():
+                self.release(waiter["future"].result())
+            else:
+                waiter["future"].cancel()
+                self.spent -= dollars
+                self._dispatch(model)
+            raise
+
+    def estimate_wait(self, model, position):
+        """
+            Estimates how long the request at a position in line waits, assuming every request ahead of it uses its
+            whole reservation.
+
+            Args:
+                model (str): The model of the requests.
+                position (int): The position in line, starting at 0.
+
+            Returns:
+                wait (float): The estimated wait in seconds.
+        """
+        limits = self.rate_limits.get(model)
+        if limits is None:
+            return 0.0
+        now = time.monotonic()
+        window = self._window(model)
+        waiting = [waiter for waiter in self.queues.get(model, ()) if not waiter["future"].done()][:position + 1]
+        missing_tokens = sum(entry[1] for entry in window) + sum(waiter["tokens"] for waiter in waiting) - limits["tokens_per_minute"]
+        missing_requests = len(window) + len(waiting) - limits["requests_per_minute"]
+        wait = max(0.0, self.paused_until.get(model, 0) - now)
+        # the reservations of the window free up in order as they expire
+        for admitted_at, tokens in window:
+            if missing_tokens <= 0 and missing_requests <= 0:
+                break
+            missing_tokens -= tokens
+            missing_requests -= 1
+            wait = max(wait, admitted_at + RATE_LIMIT_WINDOW - now)
+        # requests ahead that are admitted later fill a later window
+        extra_windows = max(missing_tokens / limits["tokens_per_minute"], missing_requests / limits["requests_per_minute"])
+        return wait + RATE_LIMIT_WINDOW * max(0, math.ceil(extra_windows))
+
+    def pause(self, model, seconds):
+        """
+            Stops admitting requests of a model, e.g. after OpenAI reported the rate limit as met anyway.
+
+            Args:
+                model (str): The model to pause.
+                seconds (float): The seconds until the OpenAI rate limit resets.
+        """
+        self.paused_until[model] = max(self.paused_until.get(model, 0), time.monotonic() + seconds)
+
+    def release(self, reservation):
+        """
+            Returns the reservation of a request that was never sent.
+
+            Args:
+                reservation (Reservation): The reservation of the request.
+        """
+        if reservation.settled:
+            return
+        reservation.settled = True
+        window = self.windows.get(reservation.model, ())
+        if reservation.window_entry in window:
+            window.remove(reservation.window_entry)
+        self.spent -= reservation.dollars
+        self._save()
+        self._dispatch(reservation.model)
+
+    def settle(self, reservation, tokens=None, dollars=None):
+        """
+            Replaces the estimates of a sent request with what it used.
+
+            Args:
+                reservation (Reservation): The reservation of the request.
+                tokens (int | None): The tokens the request used, None to keep the estimate (e.g. the request failed).
+                dollars (float | None): The cost of the request, None to keep the estimate.
+        """
+        if reservation.settled:
+            return
+        reservation.settled = True
+        if tokens is not None:
+            reservation.window_entry[1] = tokens
+        if dollars is not None:
+            self.spent += dollars - reservation.dollars
+        self._save()
+        self._dispatch(reservation.model)
+
+
+OPENAI_SCHEDULER = OpenAIScheduler()
@@ -0,0 +1,113 @@
+"""Tracks Discord rate limits from the headers of the responses the bot already receives."""
+
+import re
+import time
+
+import aiohttp
+
+from metrics import METRICS
+
+API_PATH_PATTERN = re.compile(r"/api/v\d+/")
+# ids that follow these path segments pick the rate limit bucket, every other id shares the bucket
+MAJOR_PARAMETER_PATTERN = re.compile(r"(?<!channels/)(?<!guilds/)(?<!webhooks/)\b\d{15,21}\b")
+ID_PATTERN = re.compile(r"\b\d{15,21}\b")
+
+
+def normalize_route(method, path):
+    """
+        Reduces a request to the route that Discord uses to pick its rate limit bucket.
+
+        Args:
+            method (str): The HTTP method of the request.
+            path (str): The URL path of the request, with or without the API version prefix.
+
+        Returns:
+            route (str): The method and path with every non major id replaced (e.g. "POST channels/123/messages").
+    """
+    path = API_PATH_PATTERN.split(path, maxsplit=1)[-1].strip("/")
+    return f"{method.upper()} {MAJOR_PARAMETER_PATTERN.sub('{id}', path)}"
+
+
+class DiscordRateLimitTracker:
+    """
+        Remaining capacity of each Discord route, predicted from the X-RateLimit headers of past responses.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        # discord names the bucket of every route in X-RateLimit-Bucket, routes in the same bucket with the same
+        # major ids share their limit
+        self.route_buckets = {}
+        self.shared_buckets = {}
+        self.global_reset_at = 0.0
+
+    async def _on_request_end(self, _session, _context, params):
+        self.update(params.method, params.url.path, params.response.status, params.response.headers)
+
+    def check(self, route):
+        """
+            Predicts the remaining capacity of a route without any network access.
+
+            Args:
+                route (str): The normalized route (see normalize_route).
+
+            Returns:
+                remaining (int | None): The requests remaining before the route is rate limited, None if unknown.
+                reset_after (float | None): Seconds until the route resets, None if unknown.
+        """
+        now = time.monotonic()
+        if now < self.global_reset_at:
+            return 0, self.global_reset_at - now
+        bucket = self.buckets.get(route)
+        if bucket is None:
+            # a route that was never requested may share the bucket of a route that was
+            route_template = ID_PATTERN.sub("{id}", route)
+            bucket = self.shared_buckets.get((self.route_buckets.get(route_template), tuple(ID_PATTERN.findall(route))))
+        if bucket is None:
+            return None, None
+        limit, remaining, reset_at = bucket
+        if now >= reset_at:
+            # the window has passed so the bucket is full again
+            return limit, 0.0
+        return remaining, reset_at - now
+
+    def trace_config(self):
+        """
+            Creates the aiohttp hook that feeds every Discord response into the tracker.
+
+            Returns:
+                trace_config (aiohttp.TraceConfig): The trace config to pass to discord.Client as http_trace.
+        """
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(self._on_request_end)
+        return trace_config
+
+    def update(self, method, path, status, headers):
+        """
+            Records the rate limit state reported by a Discord response.
+
+            Args:
+                method (str): The HTTP method of the request.
+                path (str): The URL path of the request.
+                status (int): The status code of the response.
+                headers (Mapping): The headers of the response.
+        """
+        now = time.monotonic()
+        if status == 429:
+            # discord.py waits and retries every rate limited request
+            METRICS.increment("retries_total", service="discord")
+        if status == 429 and headers.get("X-RateLimit-Global", "").lower() == "true":
+            self.global_reset_at = now + float(headers.get("Retry-After", 1))
+            return
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        reset_after = float(headers.get("X-RateLimit-Reset-After", 0))
+        route = normalize_route(method, path)
+        bucket = (int(headers.get("X-RateLimit-Limit", 1)), int(headers["X-RateLimit-Remaining"]), now + reset_after)
+        self.buckets[route] = bucket
+        if "X-RateLimit-Bucket" in headers:
+            self.route_buckets[ID_PATTERN.sub("{id}", route)] = headers["X-RateLimit-Bucket"]
+            self.shared_buckets[(headers["X-RateLimit-Bucket"], tuple(ID_PATTERN.findall(route)))] = bucket
+
+
+RATE_LIMIT_TRACKER = DiscordRateLimitTracker()
@@ -1,14 +1,95 @@
+"""
+Syncs the knowledge files with the OpenAI vector store used by the assistant.
+
+Only files whose content hash changed since the last sync are uploaded and only files that were removed or replaced
+are detached. Progress is written to the knowledge file manifest after every upload and batch so a crashed sync
+resumes where it stopped, deleting the uploads it never attached. Run with --full to delete every uploaded file and
+upload everything again.
+"""
+
+import argparse
 import glob
+import hashlib
+import json
 import os
+import re
 import warnings
-from openai import OpenAI
- 
-client = OpenAI()
+from openai import NotFoundError, OpenAI
+
+from config import KNOWLEDGE_FILE_MANIFEST, KNOWLEDGE_UPLOAD_BATCH_SIZE
+from knowledge_index import build_knowledge_index
+
+
+def hash_file(path):
+    """
+        Computes the content hash of a knowledge file without reading it into memory at once.
+
+        Args:
+            path: The path of the knowledge file.
+
+        Returns:
+            The hex encoded sha256 digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest():
+    """
+        Loads the manifest of uploaded knowledge files indexed by OpenAI file id.
+    """
+    if not os.path.exists(KNOWLEDGE_FILE_MANIFEST):
+        return {}
+    with open(KNOWLEDGE_FILE_MANIFEST, 'r', encoding='utf-8') as file:
+        try:
+            return json.load(file)
+        except json.decoder.JSONDecodeError:
+            return {}
+
+def save_manifest(manifest):
+    """
+        Atomically writes the manifest so an interrupted sync never leaves a truncated file behind.
+    """
+    temporary_file = KNOWLEDGE_FILE_MANIFEST + ".tmp"
+    with open(temporary_file, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=4)
+    os.replace(temporary_file, KNOWLEDGE_FILE_MANIFEST)
+
+def manifest_entry(path, content_hash):
+    """
+        Describes a knowledge file for the manifest.
+    """
+    filename = os.path.basename(path)
+    month = re.search(r"-([A-Za-z]+_\d{4})\.json$", filename)
+    return {
+        "filename": filename,
+        "path": path,
+        "channel": os.path.basename(os.path.dirname(path)),
+        "month": month.group(1) if month else None,
+        "sha256": content_hash,
+        "attached": False,
+    }
 
-# Delete all previous loose files.
-files_list = client.files.list()
-for file in files_list:
-    client.files.delete(file.id)
+def remove_file(file_id):
+    """
+        Detaches a file from the vector store and deletes it, ignoring files that are already gone.
+    """
+    try:
+        client.vector_stores.files.delete(vector_store_id=vector_store_id, file_id=file_id)
+    except NotFoundError:
+        pass
+    try:
+        client.files.delete(file_id)
+    except NotFoundError:
+        pass
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--full", action="store_true", help="delete every uploaded file and upload all knowledge files again")
+args = parser.parse_args()
+
+client = OpenAI()
 
 # Update the vector store ID if a new one is created.
 vector_store_list = client.vector_stores.list().data
@@ -23,30 +104,91 @@ if len(vector_store_list) == 0:
     with open('config.py', 'w', encoding='utf-8') as file:
         file.writelines(config_content)
     warnings.warn(f"The OPENAI_VECTOR_STORE_ID in config.py has been updated to {vector_store.id}")
+vector_store_id = os.getenv("OPENAI_VECTOR_STORE_ID")
 
-# Generate the new knowledge files.
+manifest = load_manifest()
+if args.full:
+    # Delete all previous loose files.
+    for file in client.files.list(purpose="assistants"):
+        remove_file(file.id)
+    manifest = {}
+    save_manifest(manifest)
+
+# Hash the current knowledge files.
 file_paths = glob.glob(os.path.join('knowledge-files', 'dynamic-files', '**', '*.json'), recursive=True)
 file_paths += glob.glob(os.path.join('knowledge-files', 'static-files', '*.*'), recursive=True)
-file_streams = [open(path, "rb") for path in file_paths]
-
-# Remove all old files from the vector store.
-files_list = client.vector_stores.files.list(
-    vector_store_id=os.getenv("OPENAI_VECTOR_STORE_ID")
-).data
-for file in files_list:
-    client.vector_stores.files.delete(
-        vector_store_id=os.getenv("OPENAI_VECTOR_STORE_ID"),
-        file_id=file.id
+local_hashes = {path: hash_file(path) for path in file_paths}
+
+# Update the local search index the bot uses to pick passages for each inquiry.
+reindexed_count = build_knowledge_index(local_hashes, full=args.full)
+print(f"{reindexed_count} knowledge files reindexed")
+
+attached_file_ids = {file.id for file in client.vector_stores.files.list(vector_store_id=vector_store_id)}
+# uploads recorded as pending by a sync that crashed before attaching them are deleted and uploaded again
+for file_id, entry in list(manifest.items()):
+    if entry.get("attached"):
+        continue
+    if file_id in attached_file_ids:
+        entry["attached"] = True
+    else:
+        remove_file(file_id)
+        del manifest[file_id]
+save_manifest(manifest)
+
+uploaded_paths = {
+    entry["path"]: file_id for file_id, entry in manifest.items()
+    if local_hashes.get(entry["path"]) == entry.get("sha256")
+}
+paths_to_upload = [path for path in file_paths if path not in uploaded_paths]
+# files detached since the last sync only need to be attached again
+file_ids_to_attach = [file_id for file_id in uploaded_paths.values() if file_id not in attached_file_ids]
+kept_file_ids = set(uploaded_paths.values())
+file_ids_to_remove = [file_id for file_id in manifest if file_id not in kept_file_ids]
+
+print(f"{len(file_paths) - len(paths_to_upload)} unchanged, {len(paths_to_upload)} to upload, "
+      f"{len(file_ids_to_attach)} to reattach, {len(file_ids_to_remove)} to remove")
+
+# Upload new and changed files, recording every upload as pending (not attached) before anything else happens so
+# a crash never leaves an upload the next sync does not know about.
+for path in paths_to_upload:
+    with open(path, "rb") as file_stream:
+        uploaded_file = client.files.create(file=file_stream, purpose="assistants")
+    manifest[uploaded_file.id] = manifest_entry(path, local_hashes[path])
+    save_manifest(manifest)
+    file_ids_to_attach.append(uploaded_file.id)
+
+for start in range(0, len(file_ids_to_attach), KNOWLEDGE_UPLOAD_BATCH_SIZE):
+    batch_file_ids = file_ids_to_attach[start:start + KNOWLEDGE_UPLOAD_BATCH_SIZE]
+    file_batch = client.vector_stores.file_batches.create_and_poll(
+        vector_store_id=vector_store_id, file_ids=batch_file_ids
     )
- 
-# Use the upload and poll SDK helper to upload the files, add them to the vector store,
-# and poll the status of the file batch for completion.
-file_batch = client.vector_stores.file_batches.upload_and_poll(
-  vector_store_id=os.getenv("OPENAI_VECTOR_STORE_ID"), files=file_streams
-)
+    print(file_batch.status)
+    print(file_batch.file_counts)
+    completed_file_ids = {
+        file.id for file in client.vector_stores.file_batches.list_files(
+            vector_store_id=vector_store_id, batch_id=file_batch.id, filter="completed"
+        )
+    }
+    for file_id in batch_file_ids:
+        if file_id in completed_file_ids:
+            manifest[file_id]["attached"] = True
+        else:
+            # drop the failed upload so the next sync uploads the file again, the old version stays searchable
+            warnings.warn(f"{manifest[file_id]['path']} could not be added to the vector store")
+            remove_file(file_id)
+            del manifest[file_id]
+    save_manifest(manifest)
 
-print(file_batch.status)
-print(file_batch.file_counts)
+# Remove the files that were deleted or replaced only once their replacements are searchable.
+attached_paths = {entry["path"] for entry in manifest.values() if entry.get("attached")}
+for file_id in file_ids_to_remove:
+    path = manifest[file_id]["path"]
+    if path in local_hashes and path not in attached_paths:
+        print(f"Keeping the previous version of {path} until its replacement is attached")
+        continue
+    remove_file(file_id)
+    del manifest[file_id]
+    save_manifest(manifest)
 
 client.beta.assistants.update(
   assistant_id=os.getenv("OPENAI_ASSISTANT_ID"),
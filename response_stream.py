@@ -0,0 +1,97 @@
+"""Shows an assistant response in discord while it is being generated."""
+
+import re
+import time
+
+from config import MAX_CHARS_DISCORD, STREAM_EDIT_INTERVAL
+
+# file search citations (e.g. 【4:0†source】) are replaced by footnotes once the response is complete
+CITATION_MARKER_PATTERN = re.compile(r"【[^】]*】")
+
+
+def split_response(response):
+    """
+        Splits a response into discord messages, preferably at line breaks or spaces.
+
+        The split points only depend on the text before them, so the messages of a growing response never change
+        once the response has moved on to the next message.
+
+        Args:
+            response (str): The response.
+
+        Returns:
+            messages (list): The message contents, none longer than MAX_CHARS_DISCORD.
+    """
+    messages = []
+    while len(response) > MAX_CHARS_DISCORD:
+        split_index = response.rfind("\n", 0, MAX_CHARS_DISCORD)
+        if split_index <= 0:
+            split_index = response.rfind(" ", 0, MAX_CHARS_DISCORD)
+        if split_index <= 0:
+            split_index = MAX_CHARS_DISCORD
+        messages.append(response[:split_index])
+        response = response[split_index:].lstrip()
+    if response.strip():
+        messages.append(response)
+    return messages
+
+
+def visible_text(partial_response):
+    """
+        Removes the citation markers from a partial response, hiding a marker that has not been closed yet.
+    """
+    text = CITATION_MARKER_PATTERN.sub("", partial_response)
+    return text.split("【", 1)[0]
+
+
+class DiscordResponseStream:
+    """
+        Discord messages that show a response as its text arrives.
+
+        The last message is edited at most once every STREAM_EDIT_INTERVAL seconds to stay clear of the discord
+        rate limits, and the response continues in a new message whenever it reaches MAX_CHARS_DISCORD.
+    """
+
+    def __init__(self, discord_thread, edit_interval=STREAM_EDIT_INTERVAL):
+        self.discord_thread = discord_thread
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.messages = []
+        self.shown = []
+        self.last_render = 0.0
+
+    async def _render(self, response):
+        self.last_render = time.monotonic()
+        contents = split_response(response)
+        for index, content in enumerate(contents):
+            if index == len(self.messages):
+                self.messages.append(await self.discord_thread.send(content))
+                self.shown.append(content)
+            elif self.shown[index] != content:
+                await self.messages[index].edit(content=content)
+                self.shown[index] = content
+        # the final response can be shorter than what was streamed (e.g. once markers become footnotes)
+        for message in self.messages[len(contents):]:
+            await message.delete()
+        del self.messages[len(contents):]
+        del self.shown[len(contents):]
+
+    async def append(self, text_delta):
+        """
+            Adds generated text to the response, updating discord if the last update is old enough.
+
+            Args:
+                text_delta (str): The text generated since the last call.
+        """
+        self.text += text_delta
+        if time.monotonic() - self.last_render >= self.edit_interval:
+            await self._render(visible_text(self.text))
+
+    async def finish(self, response):
+        """
+            Replaces the streamed text with the final response.
+
+            Args:
+                response (str): The complete response, including its citations.
+        """
+        await self._render(response)
@@ -0,0 +1,43 @@
+"""Run from the repository root with: python -m unittest discover tests"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from extract_messages import find_duplicate_messages
+
+# 26 words, the second message drops one word from the middle: 21 of the 26 word 3-grams are shared (81%)
+MESSAGE = (
+    "the seed generator keeps crashing on my steam deck every time i click generate after picking the hints and "
+    "the starting items for the randomizer today"
+)
+SIMILAR_MESSAGE = MESSAGE.replace("click generate", "generate")
+UNRELATED_MESSAGE = "which tracker layout shows the proofs and the reports of the current seed in a single window"
+
+
+class FindDuplicateMessagesTest(unittest.TestCase):
+
+    def find_duplicates(self, contents):
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, "help.json")
+            with open(filepath, "w", encoding="utf-8") as file:
+                json.dump({"messages": [
+                    {"id": str(message_id), "content": content} for message_id, content in enumerate(contents, 1)
+                ]}, file)
+            duplicate_ids, duplicate_counts = find_duplicate_messages([filepath])
+        return duplicate_ids[filepath], duplicate_counts[filepath]
+
+    def test_80_percent_similar_messages_are_collapsed(self):
+        duplicate_ids, duplicate_counts = self.find_duplicates([MESSAGE, SIMILAR_MESSAGE])
+        self.assertEqual(duplicate_ids, {"2"})
+        self.assertEqual(duplicate_counts, {"1": 2})
+
+    def test_unrelated_messages_are_kept(self):
+        duplicate_ids, duplicate_counts = self.find_duplicates([MESSAGE, UNRELATED_MESSAGE])
+        self.assertEqual(duplicate_ids, set())
+        self.assertEqual(duplicate_counts, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
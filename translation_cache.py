@@ -0,0 +1,162 @@
+"""Persistent cache of translations of the bot's fixed messages."""
+
+# pylint: disable=broad-exception-caught
+
+import json
+import logging
+import os
+import re
+import threading
+
+from deep_translator import GoogleTranslator
+
+from config import DEFAULT_LANGUAGE, TRANSLATION_CACHE_FILE
+
+PLACEHOLDER_PATTERN = re.compile(r"%\((\w+)\)s")
+
+
+def fill_placeholders(template, placeholders):
+    """
+        Replaces the %(name)s placeholders of a template.
+
+        Args:
+            template (str): The message template.
+            placeholders (dict): The values of the placeholders by name.
+
+        Returns:
+            message (str): The message with every placeholder filled in.
+    """
+    return PLACEHOLDER_PATTERN.sub(lambda match: str(placeholders[match.group(1)]), template)
+
+
+class TranslationCache:
+    """
+        Translations of message templates indexed by language, saved to disk as they are learned.
+
+        Templates are translated with their placeholders (e.g. %(display_name)s) swapped for {0}, {1}, ... which the
+        translator leaves untouched, so one cached translation serves every user.
+    """
+
+    def __init__(self, cache_file=TRANSLATION_CACHE_FILE):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.translations = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as cache:
+                try:
+                    self.translations = json.load(cache)
+                except json.decoder.JSONDecodeError:
+                    self.translations = {}
+
+    def lookup(self, template, language, **placeholders):
+        """
+            Retrieves a translated message without any network access.
+
+            Args:
+                template (str): The message template in the default language.
+                language (str): The language code to translate to.
+                placeholders: Values for the placeholders of the template.
+
+            Returns:
+                message (str | None): The translated message or None if the template has not been translated yet.
+        """
+        if language == DEFAULT_LANGUAGE:
+            return fill_placeholders(template, placeholders)
+        translated_template = self.translations.get(language, {}).get(template)
+        if translated_template is None:
+            return None
+        return fill_placeholders(translated_template, placeholders)
+
+    def prewarm(self, templates, languages):
+        """
+            Translates every template missing from the cache for each language.
+
+            Args:
+                templates (list): The message templates in the default language.
+                languages (iterable): The language codes to translate to.
+        """
+        for language in languages:
+            try:
+                self.translate_templates(templates, language)
+            except Exception:
+                logging.exception("ERROR OCCURRED")
+
+    def save(self):
+        """
+            Writes the cache to disk.
+        """
+        temporary_file = self.cache_file + ".tmp"
+        with self.lock:
+            with open(temporary_file, "w", encoding="utf-8") as cache:
+                json.dump(self.translations, cache, indent=4, ensure_ascii=False)
+            os.replace(temporary_file, self.cache_file)
+
+    def translate(self, template, language, **placeholders):
+        """
+            Translates a message template, going to the translator only on a cache miss.
+
+            Args:
+                template (str): The message template in the default language.
+                language (str): The language code to translate to.
+                placeholders: Values for the placeholders of the template.
+
+            Returns:
+                message (str): The translated message, or the untranslated message if translation fails.
+        """
+        message = self.lookup(template, language, **placeholders)
+        if message is not None:
+            return message
+        try:
+            self.translate_templates([template], language)
+            message = self.lookup(template, language, **placeholders)
+            if message is None:
+                # the translator mangled a placeholder so translate this message on its own
+                message = GoogleTranslator(source='auto', target=language).translate(
+                    fill_placeholders(template, placeholders)
+                )
+        except Exception:
+            message = fill_placeholders(template, placeholders)
+            logging.exception("ERROR OCCURRED")
+        return message
+
+    def translate_templates(self, templates, language):
+        """
+            Translates the templates missing from the cache for a language in a single batch.
+
+            Args:
+                templates (list): The message templates in the default language.
+                language (str): The language code to translate to.
+        """
+        if language == DEFAULT_LANGUAGE:
+            return
+        cached_templates = self.translations.get(language, {})
+        missing_templates = [template for template in templates if template not in cached_templates]
+        if not missing_templates:
+            return
+
+        protected_templates = []
+        for template in missing_templates:
+            names = PLACEHOLDER_PATTERN.findall(template)
+            protected_template = template
+            for index, name in enumerate(names):
+                protected_template = protected_template.replace(f"%({name})s", f"{{{index}}}", 1)
+            protected_templates.append((protected_template, names))
+
+        translator = GoogleTranslator(source='auto', target=language)
+        translations = translator.translate_batch([protected_template for protected_template, _ in protected_templates])
+
+        learned_translations = {}
+        for template, (_, names), translation in zip(missing_templates, protected_templates, translations):
+            if not translation or not all(f"{{{index}}}" in translation for index in range(len(names))):
+                continue
+            for index, name in enumerate(names):
+                translation = translation.replace(f"{{{index}}}", f"%({name})s", 1)
+            learned_translations[template] = translation
+
+        if learned_translations:
+            with self.lock:
+                self.translations.setdefault(language, {}).update(learned_translations)
+            self.save()
+
+
+TRANSLATION_CACHE = TranslationCache()
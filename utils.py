@@ -13,48 +13,88 @@ import re
 import subprocess
 
 import datetime as dt
-import tempfile
-import requests
+import functools
 import aiohttp
+import httpx
 from PIL import Image
-from deep_translator import GoogleTranslator
 from dotenv import load_dotenv, set_key
-from langdetect import detect_langs
+from langdetect import DetectorFactory, LangDetectException, detect_langs
+from langdetect.detector_factory import init_factory
 
 import discord
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
 from config import *
+from conversation_store import ConversationStore
+from image_upload_cache import IMAGE_UPLOAD_CACHE
+from knowledge_index import KNOWLEDGE_INDEX
 from messages import *
+from metrics import METRICS
+from openai_scheduler import OPENAI_SCHEDULER, estimate_cost, estimate_message_tokens
+from rate_limits import RATE_LIMIT_TRACKER, normalize_route
+from response_stream import DiscordResponseStream
+from translation_cache import TRANSLATION_CACHE
 
 load_dotenv(override=True)
 
-def check_rate_limit(endpoint):
+# uploaded knowledge files indexed by OpenAI file id (see load_knowledge_file_manifest)
+KNOWLEDGE_FILES = {}
+# session shared by every attachment download (see get_attachment_session)
+ATTACHMENT_SESSION = None
+
+@METRICS.timed("rate_limit_check")
+def check_rate_limit(endpoint, method="POST"):
     """
-        Rate limit checker.
+        Rate limit checker. Uses the rate limit headers of earlier discord responses so no request is made.
 
         Args:
             endpoint (str): The endpoint to check for discord rate limits.
+            method (str): The HTTP method the bot is about to use on *endpoint*.
 
         Returns:
             rate_limit_remaining (int | None): The number of messages remaining under the rate limit at *endpoint*.
-            rate_limit_reset (int | None): Time in seconds until the rate limit resets at *endpoint*.
+            rate_limit_reset (float | None): Time in seconds until the rate limit resets at *endpoint*.
+    """
+    return RATE_LIMIT_TRACKER.check(normalize_route(method, endpoint))
 
-        Raises:
-            RuntimeError: Raised if the rate limit cannot be checked.
+async def close_attachment_session():
     """
+        Closes the aiohttp session shared by every attachment download, if it was ever created.
+    """
+    global ATTACHMENT_SESSION
+    if ATTACHMENT_SESSION is not None and not ATTACHMENT_SESSION.closed:
+        await ATTACHMENT_SESSION.close()
+    ATTACHMENT_SESSION = None
 
-    url = f"https://discord.com/api/v9/{endpoint}"
-    headers = {
-        "Authorization": f"Bot {os.getenv('DISCORD_TOKEN')}"
-    }
-    response = requests.get(url, headers=headers, timeout=15)
-    if response.status_code == 200:
-        rate_limit_remaining = response.headers.get("X-RateLimit-Remaining")
-        rate_limit_reset = response.headers.get("X-RateLimit-Reset-After")
-        return rate_limit_remaining, rate_limit_reset
-    logging.error("Failed to check rate limit: %s", response.status_code)
-    return None, None
+async def count_openai_retry(response):
+    """
+        Counts the OpenAI responses the OpenAI client retries (rate limits, timeouts and server errors).
+
+        Args:
+            response (httpx.Response): A response from OpenAI.
+    """
+    if response.status_code in (408, 409, 429) or response.status_code >= 500:
+        METRICS.increment("retries_total", service="openai")
 
+def create_openai_client():
+    """
+        Creates the OpenAI client shared by every request the bot makes.
+
+        Returns:
+            openai_client (openai.AsyncOpenAI): An async client that keeps its connections to OpenAI alive between requests.
+    """
+    return AsyncOpenAI(
+        organization=os.getenv("ORG"),
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            event_hooks={"response": [count_openai_retry]},
+        ),
+    )
+
+@functools.lru_cache(maxsize=LANG_DETECT_CACHE_SIZE)
 def detect_message_language(message):
     """
         Detect the language of a message.
@@ -65,9 +105,14 @@ def detect_message_language(message):
         Returns:
             language (str): The code for the language detected.
     """
-    detected_language = detect_langs(message)[0]
-    change_language = detected_language.prob > LANG_DETECT_MIN_PROB and len(message.split(' ')) >= MIN_WORDS_IN_MESSAGE_FOR_TRANSLATION
-    text_language = detected_language.lang if change_language else DEFAULT_LANGUAGE
+    # messages this short are never translated so there is no need to run detection
+    if len(message.split(' ')) < MIN_WORDS_IN_MESSAGE_FOR_TRANSLATION:
+        return DEFAULT_LANGUAGE
+    try:
+        detected_language = detect_langs(message)[0]
+    except LangDetectException:
+        return DEFAULT_LANGUAGE
+    text_language = detected_language.lang if detected_language.prob > LANG_DETECT_MIN_PROB else DEFAULT_LANGUAGE
     return text_language
 
 async def discord_to_openai_image_conversion(discord_message, discord_thread, openai_client):
@@ -77,27 +122,46 @@ async def discord_to_openai_image_conversion(discord_message, discord_thread, op
         Args:
             discord_message (discord.Message): The discord message to check for attached images.
             discord_thread (discord.Thread): The discord thread to send warnings/errors to.
-            openai_client (openai.OpenAI): The OpenAI client to upload images to.
+            openai_client (openai.AsyncOpenAI): The OpenAI client to upload images to.
 
         Returns:
             image_files (list): A list of image content dictionaries to be uploaded to the OpenAI assistant.
     """
     attached_images = await process_discord_message_attachments(discord_message, discord_thread)
-    image_files = []
-    for filename, image_data in attached_images:
-        file_response = await upload_image_to_openai(openai_client, image_data, filename)
-        image_files.append({
-            "type": "image_file",
-            "image_file": {"file_id": file_response.id}
-        })
-    return image_files
+    file_ids = await asyncio.gather(*[
+        upload_image_to_openai(openai_client, image_data, filename) for filename, image_data in attached_images
+    ])
+    return [{"type": "image_file", "image_file": {"file_id": file_id}} for file_id in file_ids]
 
-def extract_citations(openai_client, message):
+async def download_image(session, attachment):
+    """
+        Downloads an image attachment, downscaling it if it is larger than MAX_PIXEL_DIM.
+
+        Args:
+            session (aiohttp.ClientSession): The session to download with.
+            attachment (discord.Attachment): The image attachment.
+
+        Returns:
+            attached_image (tuple | None): The filename and bytes of the image, None if the download failed.
+    """
+    async with session.get(attachment.url) as response:
+        if response.status != 200:
+            logging.error("Could not download attachment %s: %s", attachment.filename, response.status)
+            return None
+        image_data = await response.read()
+    # discord reports the dimensions of images, so only images that are too large (or unknown) are decoded
+    if attachment.width is None or attachment.height is None or max(attachment.width, attachment.height) > MAX_PIXEL_DIM:
+        image_data = await asyncio.to_thread(resize_image, image_data)
+    return attachment.filename, image_data
+
+@METRICS.timed("citations")
+async def extract_citations(openai_client, message):
     """
         Extracts annotations and citations from an OpenAI completion.
 
         Args:
-            openai_client (openai.OpenAI): The discord client used to send DMs about memory warnings.
+            openai_client (openai.AsyncOpenAI): The OpenAI client used to look up cited files.
+            message (openai.types.beta.threads.Text): The assistant message text containing the annotations.
 
         Returns:
             annotations_list, citations_list (list, list): List of annotations and their respective citations.
@@ -110,44 +174,81 @@ def extract_citations(openai_client, message):
         message.value = message.value.replace(annotation.text, f' [{index}]')
         # Gather citations based on annotation attributes
         if (file_citation := getattr(annotation, 'file_citation', None)):
-            cited_file = openai_client.files.retrieve(file_citation.file_id)
-            citations.append(f'[{index}]: {cited_file.filename}')
+            cited_filename = await get_cited_filename(openai_client, file_citation.file_id)
+            citations.append(f'[{index}]: {cited_filename}')
         elif (file_path := getattr(annotation, 'file_path', None)):
-            cited_file = openai_client.files.retrieve(file_path.file_id)
-            citations.append(f'[{index}] Click <here> to download {cited_file.filename}')
+            cited_filename = await get_cited_filename(openai_client, file_path.file_id)
+            citations.append(f'[{index}] Click <here> to download {cited_filename}')
     return annotations, citations
 
-async def get_assistant_response(openai_client, openai_thread, run, discord_thread):
+@METRICS.timed("thread_title")
+async def generate_thread_title(openai_client, message_content):
     """
-        Retrieves the OpenAI assistant response from the appropriate thread.
+        Summarizes an inquiry into a thread title.
 
         Args:
-            openai_client (openai.OpenAI): The OpenAI client to use for response retrieval.
-            openai_thread (openai.Thread): The thread used to facilitate assistant response.
-            run (openai.Run): The run object containing status information about the ping to the assistant.
-            discord_thread (discord.Thread): The discord thread to send messages to if rate limit issues with OpenAI happen.
+            openai_client (openai.AsyncOpenAI): The client to use to create a short summary of the query.
+            message_content (str): The inquiry.
 
         Returns:
-            openai_message (openai.pagination.SyncCursorPage[Message]): The response from the assistant.
+            discord_thread_name (str): The thread title.
+    """
+    messages = [
+        {"role": "system", "content": THREAD_TITLE_SYSTEM_PROMPT},
+        {"role": "user", "content": f"{THREAD_TITLE_USER_PROMPT}: {message_content}"}
+    ]
+    prompt_tokens = estimate_message_tokens(messages)
+    reservation = await OPENAI_SCHEDULER.admit(
+        MODEL, prompt_tokens + MAX_TOKENS_THREAD_TITLE, estimate_cost(MODEL, prompt_tokens, MAX_TOKENS_THREAD_TITLE)
+    )
+    try:
+        response = await openai_client.chat.completions.create(
+                        model=MODEL,
+                        messages=messages,
+                        max_tokens=MAX_TOKENS_THREAD_TITLE,
+                    )
+    except BaseException:
+        # the request may have reached OpenAI, so it keeps its estimated reservation
+        OPENAI_SCHEDULER.settle(reservation)
+        raise
+    OPENAI_SCHEDULER.settle(
+        reservation,
+        response.usage.total_tokens,
+        estimate_cost(MODEL, response.usage.prompt_tokens, response.usage.completion_tokens),
+    )
+    return f"{THREAD_CATEGORY}: {response.choices[0].message.content}"[:MAX_CHARS_THREAD_TITLE]
 
-        Raises:
-            RuntimeError: If the OpenAI assistant ping fails for any reason, a RuntimeError is raised.
+def get_attachment_session():
     """
-    if run.status == 'completed':
-        openai_message = openai_client.beta.threads.messages.list(
-            thread_id=openai_thread.id
-        )
-    else:
-        logging.error("Incomplete Details: %s", run.incomplete_details)
-        logging.error("Failure Details: %s", run.last_error)
-        if run.last_error.code == 'rate_limit_exceeded':
-            limit, used, requested, seconds_to_reset = [x.strip() for x in re.findall(r' \d+\.\d+| \d+', run.last_error.message)]
-            limit, used, requested, seconds_to_reset = int(limit), int(used), int(requested), float(seconds_to_reset)
-            await discord_thread.send(OPENAI_RATE_LIMIT_MESSAGE % {"limit": limit, "used": used, "requested": requested, "seconds_to_reset": seconds_to_reset})
-        raise RuntimeError("The OpenAI message failed to generate.")
+        Retrieves the aiohttp session shared by every attachment download, creating it on first use (it has to be
+        created inside the event loop).
+
+        Returns:
+            session (aiohttp.ClientSession): The shared session.
+    """
+    global ATTACHMENT_SESSION
+    if ATTACHMENT_SESSION is None or ATTACHMENT_SESSION.closed:
+        ATTACHMENT_SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_ATTACHMENT_CONNECTIONS))
+    return ATTACHMENT_SESSION
 
-    return openai_message
+async def get_cited_filename(openai_client, file_id):
+    """
+        Resolves the filename of a cited file, only asking OpenAI if the file is missing from the knowledge file manifest.
 
+        Args:
+            openai_client (openai.AsyncOpenAI): The OpenAI client used to look up files missing from the manifest.
+            file_id (str): The OpenAI id of the cited file.
+
+        Returns:
+            filename (str): The filename of the cited file.
+    """
+    METRICS.increment("cache_requests_total", cache="cited_file", result="hit" if file_id in KNOWLEDGE_FILES else "miss")
+    if file_id not in KNOWLEDGE_FILES:
+        cited_file = await openai_client.files.retrieve(file_id)
+        KNOWLEDGE_FILES[file_id] = {"filename": cited_file.filename}
+    return KNOWLEDGE_FILES[file_id]["filename"]
+
+@METRICS.timed("discord_thread")
 async def get_discord_thread(openai_client, discord_message, discord_thread_name=None, message_content=None):
     """
         Retrieve the discord thread of a discord message or create a new thread for a new inquiry.
@@ -170,18 +271,40 @@ async def get_discord_thread(openai_client, discord_message, discord_thread_name
         discord_thread = discord_message.channel
     else:
         if discord_thread_name is None:
-            response = openai_client.chat.completions.create(
-                            model=MODEL,
-                            messages=[
-                                {"role": "system", "content": THREAD_TITLE_SYSTEM_PROMPT},
-                                {"role": "user", "content": f"{THREAD_TITLE_USER_PROMPT}: {message_content}"}
-                            ]
-                        )
-            discord_thread_name = f"{THREAD_CATEGORY}: {response.choices[0].message.content}"
+            discord_thread_name = await generate_thread_title(openai_client, message_content)
         discord_thread = await discord_message.create_thread(name=discord_thread_name)
 
     return discord_thread, existing_thread
 
+def get_knowledge_context(message):
+    """
+        Finds the knowledge file passages most relevant to an inquiry in the local index.
+
+        Args:
+            message (str): The inquiry.
+
+        Returns:
+            additional_instructions (str | None): The passages formatted as instructions for the assistant run, None if no passage matched.
+    """
+    passages = KNOWLEDGE_INDEX.search(message)
+    if not passages:
+        return None
+    return KNOWLEDGE_CONTEXT_INSTRUCTIONS % {
+        "passages": "\n\n".join(f"[{os.path.basename(source_file)}]\n{text}" for source_file, text, _ in passages)
+    }
+
+def get_message_command(discord_message):
+    """
+        Extracts the command a discord message starts with.
+
+        Args:
+            discord_message (discord.Message): The discord message to extract the command from.
+
+        Returns:
+            command (str): The first word of the message (e.g. "/randohelp").
+    """
+    return discord_message.content.split(maxsplit=1)[0]
+
 def get_openai_run_cost(run, num_images):
     """
         Gets the cost of generating the assistant response.
@@ -199,12 +322,31 @@ def get_openai_run_cost(run, num_images):
     output_1k_token_cost_in_dollars = OPENAI_PRICING[run.model]["output"]
     return input_1k_token_cost_in_dollars * (run.usage.prompt_tokens / 1000), output_1k_token_cost_in_dollars * (run.usage.completion_tokens / 1000), IMAGE_COST_IN_DOLLARS * num_images
 
+def get_thread_language(conversation_store, discord_thread):
+    """
+        Retrieves the language a thread was logged with, detecting and storing it only if it was never logged.
+
+        Args:
+            conversation_store (ConversationStore): The conversation store.
+            discord_thread (discord.Thread): The discord thread to get the language of.
+
+        Returns:
+            language (str): The language code of the thread.
+    """
+    thread_log = conversation_store.get_thread(discord_thread.id)
+    if thread_log["message_language"] is None:
+        conversation_store.set_language(discord_thread.id, detect_message_language(thread_log["message_log"][0]["content"]))
+    return thread_log["message_language"]
+
 async def handle_rate_limit(discord_message, remaining, reset, is_thread):
     """
         Deals with rate limits.
 
         Args:
-            discord_client (discord.Client): The discord client used to send DMs about memory warnings.
+            discord_message (discord.Message): The discord message that triggered the command.
+            remaining (int | None): The number of messages remaining under the rate limit, None if unknown.
+            reset (float | None): Time in seconds until the rate limit resets, None if unknown.
+            is_thread (bool): Status of the message being in an existing discord thread.
 
         Outputs:
             A message in the thread indicating the user has been rate limited.
@@ -212,7 +354,7 @@ async def handle_rate_limit(discord_message, remaining, reset, is_thread):
         Returns:
             (bool) Status if user has been rate limited.
     """
-    if remaining <= 1:
+    if remaining is not None and remaining <= 1:
         if not is_thread:
             discord_thread_name = "Rate Limit Warning"
             discord_thread = await discord_message.create_thread(name=discord_thread_name)
@@ -222,6 +364,21 @@ async def handle_rate_limit(discord_message, remaining, reset, is_thread):
         return True
     return False
 
+def is_command_channel(discord_message):
+    """
+        Checks if a message was sent in the bot channel or in one of its threads.
+
+        Args:
+            discord_message (discord.Message): The discord message to check the channel of.
+
+        Returns:
+            (bool) Status of the message being sent where the bot accepts commands.
+    """
+    channel = discord_message.channel
+    if isinstance(channel, discord.Thread):
+        channel = channel.parent
+    return getattr(channel, "name", None) == CHANNEL_NAME
+
 def is_discord_thread(discord_message, discord_thread=None):
     """
         Checks the status of the message of being in an existing discord thread.
@@ -252,12 +409,24 @@ def knowledge_file_needs_update():
         logging.error("Invalid date format in LAST_KNOWLEDGE_FILE_UPDATE")
         return True  # If there's an error parsing the date, assume update is needed
 
-def log_conversation(conversations_logs, discord_message, discord_thread, text_language, role, current_message, existing_thread):
+def load_knowledge_file_manifest():
+    """
+        Loads the manifest of uploaded knowledge files written by refresh_knowledge_files.py into memory.
+    """
+    KNOWLEDGE_FILES.clear()
+    if os.path.exists(KNOWLEDGE_FILE_MANIFEST):
+        with open(KNOWLEDGE_FILE_MANIFEST, "r", encoding='utf-8') as manifest:
+            try:
+                KNOWLEDGE_FILES.update(json.load(manifest))
+            except json.decoder.JSONDecodeError:
+                logging.error("Invalid knowledge file manifest %s", KNOWLEDGE_FILE_MANIFEST)
+
+def log_conversation(conversation_store, discord_message, discord_thread, text_language, role, current_message, existing_thread):
     """
         Logs a conversation.
 
         Args:
-            conversations_logs (dict): The log of conversations indexed by discord thread id.
+            conversation_store (ConversationStore): The store of conversations indexed by discord thread id.
             discord_message (discord.Message): The current discord message object.
             discord_thread (discord.Thread): The discord thread of the current message.
             text_language (str): The language code of the message.
@@ -265,34 +434,24 @@ def log_conversation(conversations_logs, discord_message, discord_thread, text_l
             current_message (dict): The content of the message to be logged.
             existing_thread (bool): Status of whether the thread already exists or not.
 
-        Returns:
-            conversations_logs (dict): A conversation log updated with the new user + assistant message.
-
         Raises:
             ValueError if role is not in ["user", "assistant"]. 
     """
     if role not in ["user", "assistant"]:
         raise ValueError("OpenAI must receive messages from either the role of user or assistant.")
-    if existing_thread and discord_thread.id in conversations_logs:
+    if existing_thread and conversation_store.has_thread(discord_thread.id):
         # add the last message to the existing log for this thread
-        conversations_logs[discord_thread.id]["message_log"] += [{"role": role, "content": current_message}]
+        conversation_store.append_message(discord_thread.id, role, current_message)
     else:
         # initialize conversation log with original help message and original response
-        conversations_logs[discord_thread.id] = {
-            "cost_in_dollars": {
-                "input_cost": 0,
-                "output_cost": 0,
-                "image_cost": 0,
-                "total_cost": 0
-            },
-            "message_author": discord_message.author.name, 
-            "message_content_summary": discord_thread.name.removeprefix(f"{THREAD_CATEGORY}: "),
-            "message_language": text_language,
-            "message_log": [{"role": role, "content": current_message}],
-            "rating": None,
-        }
-
-    return conversations_logs
+        conversation_store.create_thread(
+            discord_thread.id,
+            discord_message.author.name,
+            discord_thread.name.removeprefix(f"{THREAD_CATEGORY}: "),
+            text_language,
+            role,
+            current_message
+        )
 
 def message_has_thread(discord_message):
     """
@@ -306,12 +465,24 @@ def message_has_thread(discord_message):
             return True
     return False
 
+def placeholder_thread_title(message_content):
+    """
+        Titles a new thread with the start of its inquiry until the summarized title is generated.
+
+        Args:
+            message_content (str): The inquiry.
+
+        Returns:
+            discord_thread_name (str): The thread title.
+    """
+    return f"{THREAD_CATEGORY}: {' '.join(message_content.split())}"[:MAX_CHARS_THREAD_TITLE]
+
 async def populate_multimodal_data_for_openai(openai_client, discord_message, discord_thread, discord_message_contents):
     """
         Creates jsons of text and image data to send to OpenAI assistant.
 
         Args:
-            openai_client (openai.OpenAI): The OpenAI client to send messages to. 
+            openai_client (openai.AsyncOpenAI): The OpenAI client to send messages to. 
             discord_message (discord.Message) The discord message to extract potential attachments from.
             discord_thread (discord.Thread): The thread to send warning/error messages to.
             discord_message_contents (str): The contents of the message to pass to text data.
@@ -331,9 +502,23 @@ async def populate_multimodal_data_for_openai(openai_client, discord_message, di
 
     return text_content, image_content
 
+async def prewarm_translations(conversation_store):
+    """
+        Fills the translation cache with the bot's fixed messages in every language seen in the conversation logs.
+
+        Args:
+            conversation_store (ConversationStore): The store to read the logged languages from.
+    """
+    await asyncio.to_thread(TRANSLATION_CACHE.prewarm, TRANSLATED_MESSAGES, conversation_store.languages())
+
+@METRICS.timed("attachments")
 async def process_discord_message_attachments(discord_message, discord_thread):
     """
-        Rate limit checker.
+        Downloads the images attached to a discord message.
+
+        The size and type of every attachment are checked from the discord metadata before anything is downloaded,
+        the allowed images are downloaded concurrently over the shared attachment session and images larger than
+        MAX_PIXEL_DIM are downscaled off the event loop.
 
         Args:
             discord_message (discord.Message): A discord message to check for attachements (images).
@@ -345,24 +530,47 @@ async def process_discord_message_attachments(discord_message, discord_thread):
         Returns:
             attached_images (list): A list of processed images in the discord message.
     """
-    if len(discord_message.attachments) > 0:  # Checks if there are attachments
-        attached_images = []
-        for file in discord_message.attachments:
-            for ext in ATTACHMENT_EXTENSIONS:
-                if file.filename.endswith(ext):
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(file.url) as response:
-                            if response.status == 200:
-                                image_data = await response.read()
-                                image = Image.open(io.BytesIO(image_data))
-                                if len(attached_images) >= MAX_ATTACHMENTS_ALLOWED:
-                                    await send_response_to_discord(discord_thread, MAX_ATTACHMENTS_MESSAGE)
-                                    return attached_images
-                                if image.width <= 512 and image.height <= 512:
-                                    attached_images.append((file.filename, image_data))
-                                else:
-                                    await send_response_to_discord(discord_thread, IMAGE_TOO_LARGE_MESSAGE % file.filename)
-        return attached_images
+    images = [
+        attachment for attachment in discord_message.attachments
+        if attachment.filename.lower().endswith(tuple(ATTACHMENT_EXTENSIONS))
+        and (attachment.content_type is None or attachment.content_type.startswith("image/"))
+    ]
+    if len(images) > MAX_ATTACHMENTS_ALLOWED:
+        await send_response_to_discord(discord_thread, MAX_ATTACHMENTS_MESSAGE)
+        images = images[:MAX_ATTACHMENTS_ALLOWED]
+
+    allowed_images = []
+    for attachment in images:
+        if attachment.size > MAX_ATTACHMENT_SIZE:
+            await send_response_to_discord(discord_thread, IMAGE_TOO_LARGE_MESSAGE % attachment.filename)
+        else:
+            allowed_images.append(attachment)
+
+    session = get_attachment_session()
+    attached_images = await asyncio.gather(*[download_image(session, attachment) for attachment in allowed_images])
+    return [attached_image for attached_image in attached_images if attached_image is not None]
+
+def resize_image(image_data):
+    """
+        Downscales an image so that neither side is larger than MAX_PIXEL_DIM. Decodes the image, so call it off
+        the event loop.
+
+        Args:
+            image_data (bytes): The encoded image.
+
+        Returns:
+            image_data (bytes): The encoded image, unchanged if it is small enough already.
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        if image.width <= MAX_PIXEL_DIM and image.height <= MAX_PIXEL_DIM:
+            return image_data
+        image_format = image.format or "PNG"
+        image.thumbnail((MAX_PIXEL_DIM, MAX_PIXEL_DIM))
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        resized_image = io.BytesIO()
+        image.save(resized_image, format=image_format)
+    return resized_image.getvalue()
 
 async def run_asyncio_task(script_path: str):
     process = await asyncio.create_subprocess_exec(
@@ -383,6 +591,7 @@ async def run_asyncio_task(script_path: str):
     return stdout.decode(), stderr.decode()
 
 
+@METRICS.timed("discord_header")
 async def send_initial_discord_response(discord_thread, existing_thread, discord_message, text_language='en'):
     """
         Sends initial discord message upon new inquiry from user. 
@@ -401,18 +610,29 @@ async def send_initial_discord_response(discord_thread, existing_thread, discord
     """
 
     if existing_thread:
-        header = EXISTING_THREAD_HEADER
-        header = GoogleTranslator(source='auto', target=text_language).translate(header)
+        header = await translate_message(EXISTING_THREAD_HEADER, text_language)
         await discord_thread.send(header)
         await discord_thread.send(SEPARATOR)
     else:
-        header = f'Hey, {discord_message.author.display_name}! {NEW_THREAD_HEADER}'
-        header = GoogleTranslator(source='auto', target=text_language).translate(header)
+        header = await translate_message(NEW_THREAD_HEADER_TEMPLATE, text_language, display_name=discord_message.author.display_name)
         await discord_thread.send(header)
         await discord_thread.send(SEPARATOR)
 
     return header
 
+async def send_queue_position(discord_thread, text_language, position, wait):
+    """
+        Tells the user where their inquiry is in line for the OpenAI rate limits.
+
+        Args:
+            discord_thread (discord.Thread): The discord thread of the inquiry.
+            text_language (str): The language code to translate the message to.
+            position (int): The position of the inquiry in line, starting at 1.
+            wait (int): The estimated wait in seconds.
+    """
+    await discord_thread.send(await translate_message(OPENAI_QUEUE_MESSAGE, text_language, position=position, wait=wait))
+
+@METRICS.timed("discord_send")
 async def send_response_to_discord(discord_thread, response):
     """
         Sends an AI generated response to discord utilizing multiple messages if need be.
@@ -437,24 +657,21 @@ async def send_response_to_discord(discord_thread, response):
 
 def setup_conversation_logs():
     """
-        Instantiates conversation log file.
+        Opens the conversation store, migrating the old conversation log file on first use.
 
         Returns:
-            conversations_logs (dict): A dictionary of thread ids and their contents
+            conversation_store (ConversationStore): The store of thread ids and their contents.
     """
-    if os.path.exists(CONVERSATION_FILE):
-        with open(CONVERSATION_FILE, "r", encoding='utf-8') as logs:
-            try:
-                conversations_logs = json.load(logs)
-                conversations_logs = {int(k): v for k, v in conversations_logs.items()}
-            except json.decoder.JSONDecodeError:
-                conversations_logs = {}
-    else:
-        conversations_logs = {}
-        with open(CONVERSATION_FILE, "w", encoding='utf-8') as logs:
-            json.dump(conversations_logs, logs)
-    return conversations_logs
+    return ConversationStore()
 
+def setup_language_detection():
+    """
+        Loads the language detection profiles once and seeds detection so results are reproducible.
+    """
+    DetectorFactory.seed = LANG_DETECT_SEED
+    init_factory()
+
+@METRICS.timed("storage_check")
 async def storage_check(discord_client):
     """
         Storage check on converation logs.
@@ -465,7 +682,7 @@ async def storage_check(discord_client):
         Outputs:
             DM to roro if the conversation files are too large.
     """
-    if ((os.path.getsize(LOGGING_FILE) + os.path.getsize(LOGGING_FILE)) / (1024 * 1024 * 1024)) > (0.8 * STORAGE_SPACE):
+    if ((os.path.getsize(LOGGING_FILE) + os.path.getsize(CONVERSATION_DATABASE)) / (1024 * 1024 * 1024)) > (0.8 * STORAGE_SPACE):
         # DM Roro that we are low on storage.
         user_id = 611722032198975511
         user = await discord_client.fetch_user(user_id)
@@ -473,93 +690,125 @@ async def storage_check(discord_client):
         if user:
             await user.send("Less than 20% of storage space remains!!!!! Back up logs and conversations.")
 
-async def submit_correction(discord_thread, discord_message, conversations_logs):
+@METRICS.timed("assistant_run")
+async def stream_assistant_response(openai_client, openai_thread, discord_thread, additional_instructions=None):
+    """
+        Runs the OpenAI assistant on a thread, showing the response in discord while it is generated.
+
+        Args:
+            openai_client (openai.AsyncOpenAI): The OpenAI client to run the assistant with.
+            openai_thread (openai.Thread): The thread used to facilitate assistant response.
+            discord_thread (discord.Thread): The discord thread to stream the response to.
+            additional_instructions (str | None): Instructions appended to the assistant instructions for this run.
+
+        Returns:
+            run (openai.Run): The completed run, for its token usage.
+            message_content (openai.types.beta.threads.Text): The complete response with its annotations.
+            response_stream (DiscordResponseStream): The discord messages showing the response, to finish with the final response.
+
+        Raises:
+            RuntimeError: If the OpenAI assistant ping fails for any reason, a RuntimeError is raised.
+    """
+    response_stream = DiscordResponseStream(discord_thread)
+    async with openai_client.beta.threads.runs.stream(
+        thread_id=openai_thread.id,
+        assistant_id=os.getenv("OPENAI_ASSISTANT_ID"),
+        max_completion_tokens=MAX_COMPLETION_TOKENS,
+        additional_instructions=additional_instructions,
+    ) as stream:
+        async for text_delta in stream.text_deltas:
+            await response_stream.append(text_delta)
+        run = await stream.get_final_run()
+        if run.status != 'completed':
+            logging.error("Incomplete Details: %s", run.incomplete_details)
+            logging.error("Failure Details: %s", run.last_error)
+            if run.last_error and run.last_error.code == 'rate_limit_exceeded':
+                limit, used, requested, seconds_to_reset = [x.strip() for x in re.findall(r' \d+\.\d+| \d+', run.last_error.message)]
+                limit, used, requested, seconds_to_reset = int(limit), int(used), int(requested), float(seconds_to_reset)
+                # the estimates were too low, so hold every request of the model until the limit resets
+                OPENAI_SCHEDULER.pause(run.model, seconds_to_reset)
+                await discord_thread.send(OPENAI_RATE_LIMIT_MESSAGE % {"limit": limit, "used": used, "requested": requested, "seconds_to_reset": seconds_to_reset})
+            raise RuntimeError("The OpenAI message failed to generate.")
+        # the last message of the run is the response
+        openai_messages = await stream.get_final_messages()
+
+    return run, openai_messages[-1].content[0].text, response_stream
+
+async def submit_correction(discord_thread, discord_message, conversation_store):
     """
         Submits the potential instructions to fix the error in the outputted response.
 
         Args:
             discord_thread (discord.Thread): The discord thread for discord to send message to.
             discord_message (discord.Message): The current message object. Used to see if the reviewer is the original author.
-            conversations_logs (dict): The conversation logging dictionary used to update the rating of this thread.
+            conversation_store (ConversationStore): The conversation store used to update the correction of this thread.
 
         Outputs:
             A message indicating whether the review was successfully submitted or not.
-
-        Returns:
-            conversations_logs (dict): The updated conversation logs.
     """
 
     text = discord_message.content.removeprefix(CORRECTION_COMMAND + " ")
 
     if is_discord_thread(discord_message, discord_thread):
         discord_thread = discord_message.channel
-        first_thread_message = conversations_logs[discord_thread.id]["message_log"][0]["content"]
-        text_language = detect_message_language(first_thread_message)
+        text_language = get_thread_language(conversation_store, discord_thread)
         try:
             correction_instruction = str(text)
-            conversations_logs[discord_thread.id]["correction information"] = correction_instruction
-            await discord_thread.send(GoogleTranslator(source='auto', target=text_language).translate(CORRECTION_SUCCESS_MESSAGE))
+            conversation_store.set_correction(discord_thread.id, correction_instruction)
+            await discord_thread.send(await translate_message(CORRECTION_SUCCESS_MESSAGE, text_language))
         except ValueError:
-            await discord_thread.send(GoogleTranslator(source='auto', target=text_language).translate(CORRECTION_FAILURE_MESSAGE))
-
-    return conversations_logs
+            await discord_thread.send(await translate_message(CORRECTION_FAILURE_MESSAGE, text_language))
 
-async def submit_review(discord_thread, discord_message, conversations_logs):
+async def submit_review(discord_thread, discord_message, conversation_store):
     """
         Submits the review to logs and responds with the appropriate discord messages.
 
         Args:
             discord_thread (discord.Thread): The discord thread for discord to send message to.
             discord_message (discord.Message): The current message object. Used to see if the reviewer is the original author.
-            conversations_logs (dict): The conversation logging dictionary used to update the rating of this thread.
+            conversation_store (ConversationStore): The conversation store used to update the rating of this thread.
 
         Outputs:
             A message indicating whether the review was successfully submitted or not.
-
-        Returns:
-            conversations_logs (dict): The updated conversation logs.
     """
     text = discord_message.content.removeprefix(REVIEW_COMMAND + " ")
 
     if is_discord_thread(discord_message, discord_thread):
         discord_thread = discord_message.channel
-        first_thread_message = conversations_logs[discord_thread.id]["message_log"][0]["content"]
-        text_language = detect_message_language(first_thread_message)
+        thread_log = conversation_store.get_thread(discord_thread.id)
+        text_language = get_thread_language(conversation_store, discord_thread)
         try:
             user_rating = float(text)
-            if (1 <= user_rating <= 10) and (discord_message.author.name == conversations_logs[discord_thread.id]["message_author"]):
-                conversations_logs[discord_thread.id]["rating"] = user_rating
-                await discord_thread.send(GoogleTranslator(source='auto', target=text_language).translate(REVIEW_SUCCESS_MESSAGE))
+            if (1 <= user_rating <= 10) and (discord_message.author.name == thread_log["message_author"]):
+                conversation_store.set_rating(discord_thread.id, user_rating)
+                await discord_thread.send(await translate_message(REVIEW_SUCCESS_MESSAGE, text_language))
             else:
-                await discord_thread.send(GoogleTranslator(source='auto', target=text_language).translate(REVIEW_FAILURE_MESSAGE))
+                await discord_thread.send(await translate_message(REVIEW_FAILURE_MESSAGE, text_language))
         except ValueError:
-            await discord_thread.send(GoogleTranslator(source='auto', target=text_language).translate(REVIEW_FAILURE_MESSAGE))
-
-    return conversations_logs
+            await discord_thread.send(await translate_message(REVIEW_FAILURE_MESSAGE, text_language))
 
-def thread_message_counts(conversations_logs, discord_thread):
+def thread_message_counts(conversation_store, discord_thread):
     """
         Counts the number of user messages in a thread.
 
         Args:
-            conversations_logs (dict): The conversation log.
+            conversation_store (ConversationStore): The conversation store.
             discord_thread (discord.Thread): The thread for which to check number of user messages.
 
         Returns:
             user_messages (int): The number of user messages detected in thread.
         
         Raises:
-            KeyError if the discord_thread id is not logged in the conversation logs.
+            KeyError if the discord_thread id is not logged in the conversations.
     """
     try:
-        message_list = conversations_logs[discord_thread.id]["message_log"]
-        user_messages = sum([message["role"] == "user" for message in message_list])
+        user_messages = conversation_store.get_thread(discord_thread.id)["user_message_count"]
     except KeyError as e:
         raise KeyError("This thread id has not been logged in the conversations.") from e
 
     return user_messages
 
-def translate_error_message(language):
+async def translate_error_message(language):
     """
         Translate the bot's error message to a different language.
 
@@ -569,13 +818,27 @@ def translate_error_message(language):
         Returns:
             translated_error_message (str): The translated bot error message.
     """
-    try:
-        translated_error_message = GoogleTranslator(source='auto', target=language).translate(BOT_ERROR_MESSAGE)
-    except Exception:
-        translated_error_message = BOT_ERROR_MESSAGE
-        logging.exception("ERROR OCCURRED")
+    return await translate_message(BOT_ERROR_MESSAGE, language)
+
+@METRICS.timed("translate")
+async def translate_message(message, language, **placeholders):
+    """
+        Translate one of the bot's fixed messages using the translation cache.
 
-    return translated_error_message
+        Args:
+            message (str): The message template to translate, possibly with %(name)s placeholders.
+            language (str): The language code to serve as the translation target in GoogleTranslator.
+            placeholders: Values for the placeholders of *message*.
+
+        Returns:
+            translated_message (str): The translated message, or *message* if translation fails.
+    """
+    translated_message = TRANSLATION_CACHE.lookup(message, language, **placeholders)
+    METRICS.increment("cache_requests_total", cache="translation", result="miss" if translated_message is None else "hit")
+    if translated_message is None:
+        # only a cache miss needs the translator so keep it off the event loop
+        translated_message = await asyncio.to_thread(TRANSLATION_CACHE.translate, message, language, **placeholders)
+    return translated_message
 
 async def update_knowledge_files(discord_message):
     """
@@ -587,18 +850,8 @@ async def update_knowledge_files(discord_message):
     
     await discord_message.channel.send(KNOWLEDGE_UPDATED_NEEDED_MESSAGE)
     try:
-        
-        # delete the old kh2fmrando.json file since the gpt-crawler doesn't delete it
-        kh2rando_website_folder_path = os.path.join(".", "knowledge-files", "dynamic-files", "kh2rando-website")
-        if os.path.exists(kh2rando_website_folder_path):
-            for file_name in os.listdir(kh2rando_website_folder_path):
-                file_path = os.path.join(kh2rando_website_folder_path, file_name)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        else:
-            print("The folder does not exist.")
 
-        # Run gpt-crawler on kh2rando.com
+        # Run gpt-crawler on kh2rando.com (it rewrites its output and only downloads pages that changed)
         try:
             gpt_crawler_script = os.path.join(".", "knowledge-files", "gpt-crawler", "crawler", "main.py")
             stdout, stderr = await run_asyncio_task(gpt_crawler_script)
@@ -613,6 +866,8 @@ async def update_knowledge_files(discord_message):
 
         stdout, stderr = await run_asyncio_task("refresh_knowledge_files.py")
         print(f"Refresh Knowledge Files completed successfully.\nstdout: {stdout}\nstderr: {stderr}")
+        load_knowledge_file_manifest()
+        KNOWLEDGE_INDEX.load()
 
         # update the latest date of knowledge file update
         set_key('.env', 'LAST_KNOWLEDGE_FILE_UPDATE', dt.datetime.today().strftime('%m-%d-%Y'))
@@ -624,27 +879,17 @@ async def update_knowledge_files(discord_message):
         await discord_message.channel.send(KNOWLEDGE_UPDATE_FAILED_MESSAGE)
 
 
+@METRICS.timed("image_upload")
 async def upload_image_to_openai(openai_client, image_data, filename):
     """
-        Uploads an image to the OpenAI platform.
+        Uploads an image to the OpenAI platform straight from memory, reusing the upload of an identical image.
 
         Args:
-            openai_client (openai.OpenAI): The OpenAI client to upload images to.
+            openai_client (openai.AsyncOpenAI): The OpenAI client to upload images to.
             image_data (bytes): The bytes of an image from a discord message.
             filename (str): The filename of the image contained in *image_data*.
 
         Returns:
-            attached_images (list): A list of processed images in the discord message.
+            file_id (str): The OpenAI file id of the image.
     """
-    with tempfile.NamedTemporaryFile(delete=True, suffix=os.path.splitext(filename)[1]) as temp_file:
-        temp_file.write(image_data)
-        temp_file.flush()
-        temp_file.seek(0)
-        file_content = io.BytesIO(temp_file.read())
-        file_content.name = filename  # Assign a name to the BytesIO object
-        temp_file.close()
-
-        # Upload the file to OpenAI
-        file_response = openai_client.files.create(file=file_content, purpose="vision")
-
-        return file_response
+    return await IMAGE_UPLOAD_CACHE.upload(openai_client, image_data, filename)